@@ -2,46 +2,172 @@
 # -*-coding: utf-8 -*-
 
 """
-Usage: $ {1: program}.py
+Usage: $ {1: program}.py [update|baseline|jsonl|parquet|index|lookup|bench]
+
+    main.py                  Load new updatefiles into STORAGE_BACKEND (default)
+    main.py baseline         Load baseline files into STORAGE_BACKEND
+
+    STORAGE_BACKEND is arangodb (default), sqlite or files - see sample.env
+    main.py jsonl FILES...   Convert pubmed*.xml.gz files to compressed JSON Lines (no database)
+    main.py parquet FILES... Convert pubmed*.xml.gz files to Parquet (no database)
+    main.py index FILES...   Index pubmed files under PUBMED_DATA_DIR (article counts and offsets)
+    main.py lookup PMIDS...  Print converted records of PMIDs from the local mirror (no database)
+    main.py bench            Benchmark parse/convert/store on synthetic pubmed files
 """
 
+import argparse
 import logging
 
+import pm.logs
 import pm.processing
-import pm.settings as settings
 import pm.xml
 
-logging.basicConfig(filename="pubmed.log", level=logging.INFO)
 log = logging.getLogger("pubmed")
 
 
-# db.py should be finished
 # TODO xml.py and convert.py (should be merged to xml.py)
 # TODO processing.py (multi-processing code and queues)
 
 
+def get_args():
+
+    parser = argparse.ArgumentParser(description="Convert Pubmed XML to JSON")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser(
+        "update",
+        help="Load new updatefiles into STORAGE_BACKEND (default) - arangodb, sqlite, files",
+    )
+    subparsers.add_parser(
+        "baseline", help="Load baseline files into STORAGE_BACKEND - arangodb, sqlite, files"
+    )
+
+    jsonl_parser = subparsers.add_parser(
+        "jsonl", help="Convert pubmed xml files to compressed JSON Lines - no database needed"
+    )
+    jsonl_parser.add_argument("files", nargs="+", help="pubmed*.xml.gz files")
+    jsonl_parser.add_argument("--out-dir", default=".", help="Directory for the output shards")
+    jsonl_parser.add_argument("--compression", choices=["gzip", "zstd"], default="gzip")
+    jsonl_parser.add_argument(
+        "--processes", type=int, default=None, help="Default: NUMBER_OF_PROCESSORS"
+    )
+
+    parquet_parser = subparsers.add_parser(
+        "parquet", help="Convert pubmed xml files to Parquet - no database needed"
+    )
+    parquet_parser.add_argument("files", nargs="+", help="pubmed*.xml.gz files")
+    parquet_parser.add_argument("--out-dir", default=".", help="Directory for the Parquet files")
+    parquet_parser.add_argument(
+        "--partition",
+        choices=["file", "year"],
+        default="file",
+        help="One Parquet file per input file, or per input file under pub_year=YYYY/",
+    )
+    parquet_parser.add_argument(
+        "--processes", type=int, default=None, help="Default: NUMBER_OF_PROCESSORS"
+    )
+
+    index_parser = subparsers.add_parser(
+        "index", help="Index pubmed files under PUBMED_DATA_DIR without loading them"
+    )
+    index_parser.add_argument("files", nargs="+", help="pubmed*.xml.gz files")
+    index_parser.add_argument(
+        "--processes", type=int, default=None, help="Default: NUMBER_OF_PROCESSORS"
+    )
+
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="Print converted records of PMIDs from the local mirror - no database needed"
+    )
+    lookup_parser.add_argument("pmids", nargs="+")
+    lookup_parser.add_argument("--xml", action="store_true", help="Print the original XML")
+    lookup_parser.add_argument(
+        "--processes", type=int, default=None, help="Default: NUMBER_OF_PROCESSORS"
+    )
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="Benchmark parse/convert/store stages on synthetic pubmed files"
+    )
+    bench_parser.add_argument("--articles", type=int, default=10000, help="Articles per file")
+    bench_parser.add_argument("--files", type=int, default=1)
+    bench_parser.add_argument("--authors", type=int, default=6, help="Max authors per article")
+    bench_parser.add_argument("--mesh", type=int, default=12, help="Max MeSH terms per article")
+    bench_parser.add_argument("--structured-abstract-ratio", type=float, default=0.3)
+    bench_parser.add_argument("--book-ratio", type=float, default=0.01)
+    bench_parser.add_argument("--deletions", type=int, default=100, help="Deleted PMIDs per file")
+    bench_parser.add_argument(
+        "--stages",
+        nargs="+",
+        default=["parse", "convert", "store_jsonl"],
+        help="parse convert store_jsonl store_arangodb store_sqlite store_files",
+    )
+    bench_parser.add_argument("--out-dir", default="benchmarks", help="Results JSON directory")
+
+    return parser.parse_args()
+
+
 def main():
 
-    # pm.db.reset_databases()
-    # # pm.db.setup_databases()
+    args = get_args()
+
+    if args.command == "baseline":
+        pm.processing.load_baseline()
+
+    elif args.command == "jsonl":
+        import pm.export
+
+        pm.export.export_jsonl(
+            args.files, args.out_dir, compression=args.compression, processes=args.processes
+        )
+
+    elif args.command == "parquet":
+        import pm.export
+
+        pm.export.export_parquet(
+            args.files, args.out_dir, partition=args.partition, processes=args.processes
+        )
+
+    elif args.command == "index":
+        import pm.fileindex
+
+        pm.fileindex.index_files(args.files, processes=args.processes)
 
-    # pm.xml.parse_pubmed_file("baseline/pubmed19n0971.xml.gz")
-    # quit()
+    elif args.command == "lookup":
+        import json
 
-    # pm.xml.parse_baseline_file("baseline/pubmed19n0957.xml.gz")
-    # pm.xml.parse_baseline_file("baseline/pubmed19n0941.xml.gz")
+        import pm.lookup
 
-    # doc = pm.db.get_xml_doc("30525334")
-    # print(pm.db.xml_tostring(doc))
+        pm.lookup.update_index(processes=args.processes)
+        for pmid in args.pmids:
+            if args.xml:
+                raw_xml = pm.lookup.get_xml(pmid)
+                print(raw_xml.decode("utf-8") if raw_xml else f"PMID {pmid} not found")
+            else:
+                record = pm.lookup.get_record(pmid)
+                print(json.dumps(record, indent=2) if record else f"PMID {pmid} not found")
 
-    # quit()
+    elif args.command == "bench":
+        import pm.benchmark
 
-    # pm.xml.parse_xml(f"{settings.PUBMED_DATA_DIR}/baseline/pubmed19n0972.xml.gz")
-    # pm.db.xml_conn.commit()
+        shape = {
+            "articles": args.articles,
+            "files": args.files,
+            "authors": args.authors,
+            "mesh": args.mesh,
+            "structured_abstract_ratio": args.structured_abstract_ratio,
+            "book_ratio": args.book_ratio,
+            "deletions": args.deletions,
+        }
+        run = pm.benchmark.run_benchmark(shape, stages=args.stages, out_dir=args.out_dir)
+        for stage, result in run["results"].items():
+            print(
+                f"{stage:16} Articles/sec: {result['articles_sec']:10.0f}  "
+                f"MB/sec: {result['mb_sec']:7.1f}  Max RSS(MB): {result['max_rss_mb']:7.1f}"
+            )
 
-    # pm.processing.load_baseline()
-    pm.processing.load_updatefiles()
+    else:
+        pm.processing.load_updatefiles()
 
 
 if __name__ == "__main__":
+    pm.logs.setup_logging("pubmed.log")
     main()
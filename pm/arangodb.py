@@ -1,82 +1,241 @@
 import logging
+import os
+import threading
+import time
 
 import arango
+import pm.hashes
+import pm.manifest
 import pm.settings as settings
-import xxhash
+import pm.stats
+from arango.http import DefaultHTTPClient
+from requests.adapters import HTTPAdapter
 
 log = logging.getLogger()
 
 username = "root"
 password = ""
 
-client = arango.ArangoClient(hosts=settings.ARANGO_URL)
+COLLECTIONS = ("xml", "json", "processed_files", "checkpoints")
 
-sys_db = client.db("_system", username=username, password=password)
+# ArangoDB connection - made on first use, once per process, so importing this module
+#   needs no network and forked workers never share connections opened before the fork
+client = None
+pubmed_db = None
+db_pid = None
+schema_ready = False  # inherited by forked workers once the parent has set up the schema
+db_lock = threading.Lock()
 
-# Create a new database
-if not sys_db.has_database(settings.PUBMED_DB_NAME):
-    sys_db.create_database(
-        name=settings.PUBMED_DB_NAME,
-        users=[{"username": username, "password": password, "active": True}],
-    )
 
-pubmed_db = client.db(settings.PUBMED_DB_NAME, username=username, password=password)
+class PooledHTTPClient(DefaultHTTPClient):
+    """HTTP client whose session keeps a connection pool sized for the writer threads"""
 
+    def create_session(self, host):
 
-# xml collection
-if not pubmed_db.has_collection("xml"):
-    pubmed_db.create_collection("xml", index_bucket_count=64)
+        session = super().create_session(host)
 
-xml_coll = pubmed_db.collection("xml")
+        adapter = HTTPAdapter(
+            pool_connections=settings.ARANGO_POOL_SIZE, pool_maxsize=settings.ARANGO_POOL_SIZE
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
 
-# json collection
-if not pubmed_db.has_collection("json"):
-    pubmed_db.create_collection("json", index_bucket_count=64)
+        return session
 
-json_coll = pubmed_db.collection("json")
 
-# processed_files collection
-if not pubmed_db.has_collection("processed_files"):
-    pubmed_db.create_collection("processed_files", index_bucket_count=64)
+def setup_database():
+    """Create the pubmed database and collections if missing"""
 
-files_coll = pubmed_db.collection("processed_files")
+    global schema_ready
 
+    sys_db = client.db("_system", username=username, password=password)
 
-def add_xml(pmid: str, filename: str, xml_article_str: str):
+    # Create a new database
+    if not sys_db.has_database(settings.PUBMED_DB_NAME):
+        sys_db.create_database(
+            name=settings.PUBMED_DB_NAME,
+            users=[{"username": username, "password": password, "active": True}],
+        )
 
-    doc = {"_key": pmid, "filename": filename, "article": xml_article_str}
-    try:
-        xml_coll.insert(doc, overwrite=True, silent=True, return_old=False)
-    except arango.DocumentInsertError as e:
-        log.exception(f"Problem inserting Pubmed XML {pmid}  FN: {filename}")
+    db = client.db(settings.PUBMED_DB_NAME, username=username, password=password)
+    for coll_name in COLLECTIONS:
+        if not db.has_collection(coll_name):
+            db.create_collection(coll_name, index_bucket_count=64)
+
+    schema_ready = True
+
+
+def get_db():
+    """Get the pubmed database - connects on first use in each process"""
+
+    global client, pubmed_db, db_pid
+
+    with db_lock:
+        if pubmed_db is None or db_pid != os.getpid():
+            client = arango.ArangoClient(hosts=settings.ARANGO_URL, http_client=PooledHTTPClient())
+            if settings.ARANGO_SETUP_SCHEMA and not schema_ready:
+                setup_database()
+
+            pubmed_db = client.db(settings.PUBMED_DB_NAME, username=username, password=password)
+            db_pid = os.getpid()
+
+    return pubmed_db
+
+
+def get_collection(coll_name: str):
+
+    return get_db().collection(coll_name)
+
+
+def start():
+    """Nothing to start - each process connects on first use"""
+
+
+def target() -> str:
+    return f"arangodb {settings.ARANGO_URL} {settings.PUBMED_DB_NAME}"
+
+
+def stop():
+    pass
+
+
+def put_many(json_docs: list, xml_docs: list):
+
+    if xml_docs:
+        insert_xml_docs(xml_docs)
+
+    if json_docs:
+        insert_json_docs(json_docs)
 
 
-def add_json(pmid: str, article: dict):
+def insert_xml_docs(docs: list):
+    """Bulk insert xml docs - report per-record errors
+
+    A failed bulk insert is raised so the file is not marked done
+    """
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    try:
+        results = get_collection("xml").insert_many(docs, overwrite=True, return_old=False)
+    except arango.DocumentInsertError:
+        log.exception(f"Problem bulk inserting {len(docs)} Pubmed XML docs")
+        if settings.INSTRUMENT:
+            pm.stats.count("errors", len(docs))
+        raise
+    finally:
+        if settings.INSTRUMENT:
+            pm.stats.add_time("db_io", start)
+
+    for doc, result in zip(docs, results):
+        if isinstance(result, arango.ArangoError):
+            log.error(
+                f"Problem inserting Pubmed XML {doc['_key']}  FN: {doc['filename']}",
+                exc_info=result,
+            )
+            if settings.INSTRUMENT:
+                pm.stats.count("errors")
+
+
+def insert_json_docs(docs: list):
+    """Bulk insert json docs - report per-record errors
+
+    A failed bulk insert is raised so the file is not marked done. Content hashes of the
+    written docs are added to the local hash index
+    """
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
 
-    pmid = pmid
-    doc = {"_key": pmid, "article": article}
     try:
-        json_coll.insert(doc, overwrite=True)
-    except arango.DocumentInsertError as e:
-        log.exception(f"Problem inserting Pubmed JSON {pmid}  FN: {article['pubmed_xml_fn']}")
+        results = get_collection("json").insert_many(docs, overwrite=True)
+    except arango.DocumentInsertError:
+        log.exception(f"Problem bulk inserting {len(docs)} Pubmed JSON docs")
+        if settings.INSTRUMENT:
+            pm.stats.count("errors", len(docs))
+        raise
+    finally:
+        if settings.INSTRUMENT:
+            pm.stats.add_time("db_io", start)
+
+    written_hashes = []
+    for doc, result in zip(docs, results):
+        if isinstance(result, arango.ArangoError):
+            log.error(
+                f"Problem inserting Pubmed JSON {doc['_key']}  FN: {doc['article']['pubmed_xml_fn']}",
+                exc_info=result,
+            )
+            if settings.INSTRUMENT:
+                pm.stats.count("errors")
+        elif doc["hash"]:
+            written_hashes.append((doc["_key"], doc["hash"]))
+
+    if written_hashes:
+        pm.hashes.set_hashes(written_hashes)
+
+
+def delete_many(pmids: list) -> int:
+    """Bulk remove deleted PMIDs from the json and xml collections
+
+    Returns the number of json docs removed
+    """
+
+    if not pmids:
+        return 0
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    query = "FOR key IN @keys REMOVE key IN @@coll OPTIONS { ignoreErrors: true }"
+
+    deleted_cnt = 0
+    for coll_name in ("json", "xml"):
+        try:
+            cursor = get_db().aql.execute(query, bind_vars={"keys": pmids, "@coll": coll_name})
+        except arango.AQLQueryExecuteError as e:
+            log.exception(f"Problem deleting {len(pmids)} PMIDs from {coll_name}")
+            continue
+
+        if coll_name == "json":
+            deleted_cnt = cursor.statistics()["modified"]
+
+    if settings.INSTRUMENT:
+        pm.stats.add_time("db_io", start)
+
+    pm.hashes.delete_hashes(pmids)
+
+    return deleted_cnt
+
+
+def mark_file_done(doc: dict):
+
+    key = pm.manifest.file_key(doc["fn"])
+    get_collection("processed_files").insert(dict(doc, _key=key), overwrite=True)
+    get_collection("checkpoints").delete(key, ignore_missing=True)
+
+
+def set_checkpoint(doc: dict):
 
+    key = pm.manifest.file_key(doc["fn"])
+    get_collection("checkpoints").insert(dict(doc, _key=key), overwrite=True)
 
-def add_processed_filename(fn: str, article_cnt: int, duration: float):
 
-    _key = xxhash.xxh64(fn).hexdigest()
+def get_checkpoint(fn: str) -> dict:
 
-    doc = {"_key": _key, "fn": fn, "article_cnt": article_cnt, "duration": duration}
-    files_coll.insert(doc, overwrite=True)
+    return get_collection("checkpoints").get(pm.manifest.file_key(fn))
 
 
 def add_stats():
     pass
 
 
-def get_processed_files():
+def get_manifest() -> dict:
+    """Manifest fields of every processed file in one query - no full documents"""
 
-    processed_files = []
-    for doc in files_coll:
-        processed_files.append(doc["fn"])
+    query = "FOR doc IN processed_files RETURN [doc._key, doc.size, doc.mtime, doc.checksum]"
 
-    return processed_files
+    return {
+        key: {"size": size, "mtime": mtime, "checksum": checksum}
+        for key, size, mtime, checksum in get_db().aql.execute(query)
+    }
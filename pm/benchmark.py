@@ -0,0 +1,419 @@
+import datetime
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+import pm.settings as settings
+
+log = logging.getLogger()
+
+# Benchmarks for parse -> convert -> store using synthetic PubmedArticleSet files
+#
+#   Each stage is timed in its own (spawned) process so peak RSS is per stage.
+#   Results are saved as JSON so runs can be compared across commits.
+
+WORDS = (
+    "protein cell gene expression patient clinical study effect treatment analysis "
+    "cancer response model human tissue receptor activity mouse level disease risk"
+).split()
+
+ABSTRACT_LABELS = ("BACKGROUND", "METHODS", "RESULTS", "CONCLUSIONS")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+DEFAULT_SHAPE = {
+    "articles": 10000,  # articles per file
+    "files": 1,
+    "authors": 6,  # max authors per article
+    "mesh": 12,  # max MeSH headings per article
+    "chemicals": 4,  # max chemicals per article
+    "structured_abstract_ratio": 0.3,
+    "book_ratio": 0.01,
+    "deletions": 100,  # PMIDs in the DeleteCitation block at the end of each file
+    "seed": 1,
+}
+
+
+def words(rnd: random.Random, cnt: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(cnt))
+
+
+def pub_date_xml(rnd: random.Random) -> str:
+
+    year = rnd.randint(1950, 2020)
+    choice = rnd.random()
+    if choice < 0.6:
+        return (
+            f"<Year>{year}</Year><Month>{rnd.choice(MONTHS)}</Month><Day>{rnd.randint(1, 28)}</Day>"
+        )
+    elif choice < 0.8:
+        return f"<Year>{year}</Year><Month>{rnd.choice(MONTHS)}</Month>"
+    elif choice < 0.9:
+        return f"<Year>{year}</Year>"
+    else:
+        return f"<MedlineDate>{year} {rnd.choice(MONTHS)}-{rnd.choice(MONTHS)}</MedlineDate>"
+
+
+def authors_xml(rnd: random.Random, max_authors: int) -> str:
+
+    authors = []
+    for i in range(rnd.randint(1, max_authors)):
+        last_name = rnd.choice(WORDS).capitalize()
+        initials = rnd.choice("ABCDEFGHJKLMNPRSTW")
+        if rnd.random() < 0.8:
+            first_name = f"<ForeName>{rnd.choice(WORDS).capitalize()}</ForeName>"
+        else:
+            first_name = ""
+        authors.append(
+            f'<Author ValidYN="Y"><LastName>{last_name}</LastName>{first_name}<Initials>{initials}</Initials></Author>'
+        )
+
+    return "".join(authors)
+
+
+def abstract_xml(rnd: random.Random, structured: bool) -> str:
+
+    if structured:
+        texts = [
+            f'<AbstractText Label="{label}" NlmCategory="{label}">{words(rnd, 40)}</AbstractText>'
+            for label in ABSTRACT_LABELS
+        ]
+    else:
+        texts = [
+            f"<AbstractText>{words(rnd, 150)} <i>{words(rnd, 2)}</i> {words(rnd, 20)}</AbstractText>"
+        ]
+
+    return f"<Abstract>{''.join(texts)}</Abstract>"
+
+
+def article_xml(rnd: random.Random, pmid: int, shape: dict) -> str:
+
+    structured = rnd.random() < shape["structured_abstract_ratio"]
+
+    chemicals = "".join(
+        f'<Chemical><RegistryNumber>0</RegistryNumber><NameOfSubstance UI="D{rnd.randint(1, 99999):06d}">{escape(words(rnd, 2))}</NameOfSubstance></Chemical>'
+        for _ in range(rnd.randint(0, shape["chemicals"]))
+    )
+    if chemicals:
+        chemicals = f"<ChemicalList>{chemicals}</ChemicalList>"
+
+    mesh = "".join(
+        f'<MeshHeading><DescriptorName UI="D{rnd.randint(1, 99999):06d}" MajorTopicYN="N">{words(rnd, 2)}</DescriptorName></MeshHeading>'
+        for _ in range(rnd.randint(0, shape["mesh"]))
+    )
+    if mesh:
+        mesh = f"<MeshHeadingList>{mesh}</MeshHeadingList>"
+
+    return (
+        f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID>'
+        f'<Article PubModel="Print"><Journal><ISSN IssnType="Print">0000-0000</ISSN>'
+        f'<JournalIssue CitedMedium="Print"><Volume>1</Volume><Issue>1</Issue><PubDate>{pub_date_xml(rnd)}</PubDate></JournalIssue>'
+        f"<Title>Journal of {words(rnd, 2)}</Title><ISOAbbreviation>J {words(rnd, 1)}</ISOAbbreviation></Journal>"
+        f"<ArticleTitle>{words(rnd, 12)}.</ArticleTitle>{abstract_xml(rnd, structured)}"
+        f'<AuthorList CompleteYN="Y">{authors_xml(rnd, shape["authors"])}</AuthorList><Language>eng</Language>'
+        f'<PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType></PublicationTypeList>'
+        f"</Article>{chemicals}{mesh}</MedlineCitation>"
+        f'<PubmedData><PublicationStatus>ppublish</PublicationStatus><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId>'
+        f'<ArticleId IdType="doi">10.1000/{pmid}</ArticleId></ArticleIdList></PubmedData></PubmedArticle>\n'
+    )
+
+
+def book_xml(rnd: random.Random, pmid: int, shape: dict) -> str:
+
+    return (
+        f'<PubmedBookArticle><BookDocument><PMID Version="1">{pmid}</PMID>'
+        f'<ArticleIdList><ArticleId IdType="bookaccession">NBK{pmid}</ArticleId></ArticleIdList>'
+        f"<Book><Publisher><PublisherName>{words(rnd, 2)}</PublisherName></Publisher>"
+        f'<BookTitle book="b{pmid}">{words(rnd, 6)}</BookTitle><PubDate>{pub_date_xml(rnd)}</PubDate></Book>'
+        f'<ArticleTitle>{words(rnd, 8)}</ArticleTitle><AuthorList Type="authors">{authors_xml(rnd, shape["authors"])}</AuthorList>'
+        f'{abstract_xml(rnd, True)}<PublicationType UI="D016454">Review</PublicationType></BookDocument>'
+        f'<PubmedBookData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList></PubmedBookData></PubmedBookArticle>\n'
+    )
+
+
+def make_synthetic_file(path_fn: str, start_pmid: int, shape: dict) -> int:
+    """Write a synthetic gzipped PubmedArticleSet file - returns number of articles"""
+
+    rnd = random.Random(shape["seed"] + start_pmid)
+
+    with gzip.open(path_fn, "wt", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" ?>\n')
+        f.write(
+            '<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n'
+        )
+        f.write("<PubmedArticleSet>\n")
+
+        for pmid in range(start_pmid, start_pmid + shape["articles"]):
+            if rnd.random() < shape["book_ratio"]:
+                f.write(book_xml(rnd, pmid, shape))
+            else:
+                f.write(article_xml(rnd, pmid, shape))
+
+        if shape["deletions"]:
+            f.write("<DeleteCitation>")
+            for _ in range(shape["deletions"]):
+                f.write(
+                    f'<PMID Version="1">{rnd.randint(1, start_pmid + shape["articles"])}</PMID>'
+                )
+            f.write("</DeleteCitation>\n")
+
+        f.write("</PubmedArticleSet>\n")
+
+    return shape["articles"]
+
+
+def make_synthetic_files(data_dir: str, shape: dict) -> list:
+    """Create synthetic files as data_dir/baseline/pubmed00n0001.xml.gz ... - returns filenames"""
+
+    os.makedirs(f"{data_dir}/baseline", exist_ok=True)
+
+    filenames = []
+    for i in range(shape["files"]):
+        filename = f"baseline/pubmed00n{i + 1:04d}.xml.gz"
+        make_synthetic_file(f"{data_dir}/{filename}", i * shape["articles"] + 1, shape)
+        filenames.append(filename)
+
+    return filenames
+
+
+def uncompressed_size(path_fn: str) -> int:
+
+    size = 0
+    with gzip.open(path_fn, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                return size
+            size += len(chunk)
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Stages - each runs in its own process ######################################
+
+
+def stage_parse(data_dir: str, filenames: list) -> dict:
+    """Time splitting and parsing the records of the files without converting them"""
+
+    import pm.xml
+
+    article_cnt = 0
+    start = time.perf_counter()
+    for filename in filenames:
+        for elem, raw_xml in pm.xml.iter_pubmed_records(f"{data_dir}/{filename}"):
+            if elem.tag in pm.xml.ARTICLE_TAGS:
+                article_cnt += 1
+
+    return {"article_cnt": article_cnt, "seconds": time.perf_counter() - start}
+
+
+def stage_convert(data_dir: str, filenames: list) -> dict:
+    """Time convert_record only (parse time excluded) with a per-field breakdown"""
+
+    import pm.xml
+
+    article_cnt = 0
+    seconds = 0.0
+    timings = {}
+    for filename in filenames:
+        for elem, raw_xml in pm.xml.iter_pubmed_records(f"{data_dir}/{filename}"):
+            if elem.tag in pm.xml.ARTICLE_TAGS:
+                start = time.perf_counter()
+                pm.xml.convert_record(pm.xml.get_pmid(elem), elem, timings=timings)
+                seconds += time.perf_counter() - start
+                article_cnt += 1
+
+    return {"article_cnt": article_cnt, "seconds": seconds, "field_seconds": timings}
+
+
+def iter_converted(data_dir: str, filenames: list):
+    """Stream converted records - store stages time only their writes, so peak RSS is that
+    of converting and storing as production does, not of holding every record
+    """
+
+    import pm.xml
+
+    for filename in filenames:
+        yield from pm.xml.iter_converted_records(filename, path_fn=f"{data_dir}/{filename}")
+
+
+def stage_store_jsonl(data_dir: str, filenames: list) -> dict:
+    """Time writing converted records as gzipped JSON lines (conversion time excluded)"""
+
+    article_cnt = 0
+    seconds = 0.0
+    out_fn = f"{data_dir}/benchmark.jsonl.gz"
+    with gzip.open(out_fn, "wt", compresslevel=settings.EXPORT_GZIP_LEVEL) as f:
+        for pmid, record_dict, xml_record_str in iter_converted(data_dir, filenames):
+            start = time.perf_counter()
+            f.write(json.dumps(record_dict) + "\n")
+            seconds += time.perf_counter() - start
+            article_cnt += 1
+
+        start = time.perf_counter()
+    seconds += time.perf_counter() - start  # closing flushes the last gzip block
+
+    os.remove(out_fn)
+
+    return {"article_cnt": article_cnt, "seconds": seconds}
+
+
+def store_stage(backend: str, data_dir: str, filenames: list) -> dict:
+    """Time bulk writes of converted records through the storage backend (conversion time
+    excluded)
+    """
+
+    settings.STORAGE_BACKEND = backend
+    settings.PUBMED_DB_NAME = settings.BENCHMARK_DB_NAME
+    settings.SQLITE_DB_FN = f"{data_dir}/benchmark.db"
+    settings.SHARD_DIR = f"{data_dir}/shards"
+    settings.SKIP_UNCHANGED = False
+    settings.HASH_INDEX_FN = f"{data_dir}/benchmark_hashes.db"
+
+    import pm.storage as db
+
+    article_cnt = 0
+    seconds = 0.0
+    db.start()
+    for pmid, record_dict, xml_record_str in iter_converted(data_dir, filenames):
+        start = time.perf_counter()
+        if xml_record_str is not None:
+            db.add_xml(pmid, record_dict["pubmed_xml_fn"], xml_record_str)
+        db.add_json(pmid, record_dict)
+        seconds += time.perf_counter() - start
+        article_cnt += 1
+
+    start = time.perf_counter()
+    db.flush()
+    db.stop()
+    seconds += time.perf_counter() - start
+
+    return {"article_cnt": article_cnt, "seconds": seconds}
+
+
+def stage_store_arangodb(data_dir: str, filenames: list) -> dict:
+    """Store stage for the BENCHMARK_DB_NAME ArangoDB database"""
+
+    return store_stage("arangodb", data_dir, filenames)
+
+
+def stage_store_sqlite(data_dir: str, filenames: list) -> dict:
+    """Store stage for a SQLite database (single writer process) under data_dir"""
+
+    return store_stage("sqlite", data_dir, filenames)
+
+
+def stage_store_files(data_dir: str, filenames: list) -> dict:
+    """Store stage for PMID sharded files under data_dir"""
+
+    return store_stage("files", data_dir, filenames)
+
+
+STAGES = {
+    "parse": stage_parse,
+    "convert": stage_convert,
+    "store_jsonl": stage_store_jsonl,
+    "store_arangodb": stage_store_arangodb,
+    "store_sqlite": stage_store_sqlite,
+    "store_files": stage_store_files,
+}
+
+DEFAULT_STAGES = ("parse", "convert", "store_jsonl")
+
+
+def run_stage(stage: str, data_dir: str, filenames: list, result_queue):
+    """Run stage and put its result on result_queue
+
+    Runs in its own (non-daemon) process so storage stages can start writer processes
+    """
+
+    result = STAGES[stage](data_dir, filenames)
+    result["max_rss_mb"] = max_rss_mb()
+
+    result_queue.put(result)
+
+
+def git_commit() -> str:
+
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except Exception:
+        return ""
+
+
+def run_benchmark(shape: dict = None, stages: list = None, out_dir: str = "benchmarks") -> dict:
+    """Generate synthetic files, time each stage and save results as JSON
+
+    Returns the results - articles/sec, MB/sec (uncompressed XML) and peak RSS per stage
+    """
+
+    shape = {**DEFAULT_SHAPE, **(shape or {})}
+    stages = stages or DEFAULT_STAGES
+
+    data_dir = tempfile.mkdtemp(prefix="pubmed_benchmark_")
+    try:
+        filenames = make_synthetic_files(data_dir, shape)
+        xml_bytes = sum(uncompressed_size(f"{data_dir}/{filename}") for filename in filenames)
+        gz_bytes = sum(os.path.getsize(f"{data_dir}/{filename}") for filename in filenames)
+
+        results = {}
+        ctx = multiprocessing.get_context("spawn")
+        for stage in stages:
+            result_queue = ctx.Queue()
+            proc = ctx.Process(target=run_stage, args=(stage, data_dir, filenames, result_queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                raise RuntimeError(f"Benchmark stage {stage} failed - exit code {proc.exitcode}")
+            result = result_queue.get()
+
+            result["articles_sec"] = result["article_cnt"] / result["seconds"]
+            result["mb_sec"] = xml_bytes / 1_000_000 / result["seconds"]
+            results[stage] = result
+            log.info(
+                f"Benchmark {stage}: Articles/sec: {result['articles_sec']:.0f}  MB/sec: {result['mb_sec']:.1f}  Max RSS(MB): {result['max_rss_mb']:.1f}"
+            )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "shape": shape,
+        "xml_bytes": xml_bytes,
+        "gz_bytes": gz_bytes,
+        "results": results,
+    }
+
+    os.makedirs(out_dir, exist_ok=True)
+    out_fn = os.path.join(
+        out_dir,
+        f"benchmark_{run['timestamp'].replace(':', '')}_{run['git_commit'] or 'nogit'}.json",
+    )
+    with open(out_fn, "w") as f:
+        json.dump(run, f, indent=2)
+
+    log.info(f"Saved benchmark results to {out_fn}")
+
+    return run
@@ -1,18 +1,12 @@
-import copy
-import datetime
 import json
 import logging
-import re
-import xml.etree.ElementTree as ET
-from typing import Any, List, Mapping
+from typing import Any, Mapping
 
-from pm.arangodb import files_coll, json_coll, pubmed_db, xml_coll
-from lxml import etree
+import pm.dates
+import pm.lookup
 
 log = logging.getLogger(__name__)
 
-# TODO - problems converting date for PMIDs: 30479086, 15517475
-
 
 def node_text(node):
     """Needed for things like abstracts which have internal tags (see PMID:27822475)"""
@@ -31,43 +25,11 @@ def process_pub_date(pmid, year, mon, day, medline_date):
     """Create pub_date from what Pubmed provides in Journal PubDate entry
     """
 
-    if not year:
-        year = 1900
-
-    if medline_date:
-
-        match = re.search(r"\d{4,4}", medline_date)
-        if match:
-            year = match.group(0)
-
-        if int(year) < 1900:
-            year = 1900
-
-        if year and re.match("[a-zA-Z]+", mon):
-            try:
-                pub_date = datetime.datetime.strptime(f"{year}-{mon}-{day}", "%Y-%b-%d").strftime(
-                    "%Y-%m-%d"
-                )
-            except Exception as e:
-                pub_date = "1900-01-01"
-                log.error(f"Problem converting {year} {mon} {day} to pubdate for PMID:{pmid}")
-
-        elif year:
-            pub_date = f"{year}-{mon}-{day}"
-
-    else:
-        pub_date = None
-        if year and re.match("[a-zA-Z]+", mon):
-            try:
-                pub_date = datetime.datetime.strptime(f"{year}-{mon}-{day}", "%Y-%b-%d").strftime(
-                    "%Y-%m-%d"
-                )
-            except Exception as e:
-                pub_date = "1900-01-01"
-                log.error(f"Problem converting {year} {mon} {day} to pubdate for PMID:{pmid}")
-
-        elif year:
-            pub_date = f"{year}-{mon}-{day}"
+    pub_date, valid = pm.dates.normalize_pub_date(year, mon, day, medline_date)
+    if not valid:
+        log.warning(
+            f"Problem converting {year} {mon} {day} {medline_date} to pubdate for PMID:{pmid}"
+        )
 
     return pub_date
 
@@ -108,7 +70,7 @@ def parse_book_record(root) -> dict:
         iter(root.xpath(".//Journal/JournalIssue/PubDate/MedlineDate/text()")), None
     )
 
-    pub_date = process_pub_date(pub_year, pub_mon, pub_day, medline_date)
+    pub_date = process_pub_date(doc["pmid"], pub_year, pub_mon, pub_day, medline_date)
 
     doc["pub_date"] = pub_date
 
@@ -151,9 +113,6 @@ def parse_journal_article_record(root) -> dict:
 
     doc["title"] = next(iter(root.xpath(".//ArticleTitle/text()")), "")
 
-    # TODO https:.//stackoverflow.com/questions/4770191/lxml-etree-element-text-doesnt-return-the-entire-text-from-an-element
-    atext = next(iter(root.xpath(".//Abstract/AbstractText/text()")), "")
-
     for abstracttext in root.xpath(".//Abstract/AbstractText"):
         abstext = node_text(abstracttext)
 
@@ -205,59 +164,19 @@ def parse_journal_article_record(root) -> dict:
 
 
 def get_pubmed(pmid: str) -> Mapping[str, Any]:
-    """Get pubmed xml for pmid and convert to JSON
-
-    Remove MESH terms if they are duplicated in the compound term set
+    """Get pubmed record for pmid converted to JSON from the local mirror
 
-    ArticleDate vs PubDate gets complicated: https:.//www.nlm.nih.gov/bsd/licensee/elements_descriptions.html see <ArticleDate> and <PubDate>
-    Only getting pub_year at this point from the <PubDate> element.
+    Looks the PMID up in the pm.lookup index of PUBMED_DATA_DIR (run pm.lookup.update_index()
+    or main.py lookup first) instead of fetching it from Pubmed.
 
     Args:
         pmid: pubmed id number as a string
 
     Returns:
-        pubmed json
+        pubmed json - None if the PMID is not in the mirror
     """
 
-    doc = {
-        "abstract": "",
-        "pmid": pmid,
-        "title": "",
-        "authors": [],
-        "pub_date": "",
-        "joural_iso_title": "",
-        "journal_title": "",
-        "doi": "",
-        "compounds": [],
-        "mesh": [],
-    }
-
-    try:
-        pubmed_url = PUBMED_TMPL.replace("PMID", str(pmid))
-        r = get_url(pubmed_url)
-        content = r.content
-        log.debug(f"Getting Pubmed URL {pubmed_url}")
-        root = etree.fromstring(content)
-
-    except Exception as e:
-        log.error(
-            f"Bad Pubmed request, status: {r.status_code} error: {e}",
-            url=f'{PUBMED_TMPL.replace("PMID", pmid)}',
-        )
-        return {"doc": {}, "message": f"Cannot get PMID: {pubmed_url}"}
-
-    doc["pmid"] = root.xpath(".//PMID/text()")[0]
-    print("PMID", doc["pmid"])
-
-    if doc["pmid"] != pmid:
-        log.error("Requested PMID doesn't match record PMID", url=pubmed_url)
-
-    if root.find("PubmedArticle") is not None:
-        doc = parse_journal_article_record(doc, root)
-    elif root.find("PubmedBookArticle") is not None:
-        doc = parse_book_record(doc, root)
-
-    return doc
+    return pm.lookup.get_record(pmid)
 
 
 def xml_to_json(xml_doc) -> str:
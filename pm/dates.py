@@ -0,0 +1,107 @@
+import functools
+import re
+
+import pm.settings as settings
+
+# Publication date normalization - shared by pm.xml and pm.convert
+#
+#   PubDate has Year/Month/Day or a free text MedlineDate, e.g. "1998 Dec-1999 Jan",
+#   "2000 Spring", "1999 Nov 15-Dec 2". Months may be abbreviations, full names or numbers.
+#   The distinct inputs are few, so results are cached instead of using strptime per article.
+
+MONTH_NAMES = (
+    "january",
+    "february",
+    "march",
+    "april",
+    "may",
+    "june",
+    "july",
+    "august",
+    "september",
+    "october",
+    "november",
+    "december",
+)
+
+SEASONS = {"spring": "03", "summer": "06", "fall": "09", "autumn": "09", "winter": "12"}
+
+# Lowercase month token -> zero padded month number
+MONTHS = {"sept": "09", **SEASONS}
+for number, name in enumerate(MONTH_NAMES, start=1):
+    for token in (name, name[:3], str(number), f"{number:02d}"):
+        MONTHS[token] = f"{number:02d}"
+
+DAYS_IN_MONTH = dict(
+    zip(
+        (f"{number:02d}" for number in range(1, 13)),
+        (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    )
+)
+
+MEDLINE_DATE_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+")
+
+DEFAULT_YEAR = "1900"
+
+
+def days_in_month(year: int, month: str) -> int:
+
+    if month == "02" and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+
+    return DAYS_IN_MONTH[month]
+
+
+@functools.lru_cache(maxsize=settings.DATE_CACHE_SIZE)
+def normalize_pub_date(year: str, month: str, day: str, medline_date: str) -> tuple:
+    """Normalize PubDate parts to YYYY-MM-DD
+
+    Returns (pub_date, valid) - valid is False if any part could not be used as given.
+    Unusable parts fall back to 1900 for the year, January for the month and the 1st for
+    the day, and days past the end of the month are clamped to its last day.
+    MedlineDate uses the first year and the month (or season) and day that follow it.
+    """
+
+    valid = True
+
+    if medline_date:
+        year, month, day = None, None, None
+        tokens = MEDLINE_DATE_TOKEN_RE.findall(medline_date)
+        for idx, token in enumerate(tokens):
+            if len(token) == 4 and token.isdigit():
+                year = max(token, DEFAULT_YEAR)
+                following = tokens[idx + 1 : idx + 3]
+                if following and following[0].isalpha():
+                    month = following[0]
+                    if len(following) > 1 and following[1].isdigit() and len(following[1]) <= 2:
+                        day = following[1]
+                break
+
+        if year is None:
+            year, valid = DEFAULT_YEAR, False
+
+    if not year:
+        year = DEFAULT_YEAR
+    elif not (len(year) == 4 and year.isdigit()):
+        year, valid = DEFAULT_YEAR, False
+
+    if not month:
+        month = "01"
+    else:
+        month_number = MONTHS.get(month.strip().rstrip(".").lower())
+        if month_number is None:
+            month_number, valid = "01", False
+        month = month_number
+
+    if not day:
+        day = 1
+    elif day.isdigit():
+        day = int(day)
+    else:
+        day, valid = 1, False
+
+    last_day = days_in_month(int(year), month)
+    if not 1 <= day <= last_day:
+        day, valid = min(max(day, 1), last_day), False
+
+    return f"{year}-{month}-{day:02d}", valid
@@ -1,217 +1,386 @@
-import bz2
-import datetime
-import glob
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import sqlite3
-import xml.etree.cElementTree as ET  # C implementation of ElementTree
-from xml.etree.cElementTree import Element
+import threading
+import time
+from queue import Empty
 
-import pm.convert
+import pm.hashes
+import pm.manifest
 import pm.settings as settings
+import pm.stats
+import pm.xmlarchive
 
 log = logging.getLogger()
 
-xml_conn = sqlite3.connect(settings.XML_DB_FN)
-xml_cursor = xml_conn.cursor()
+# SQLite storage backend (STORAGE_BACKEND=sqlite) - no database service needed
+#
+#   Tables json, xml, processed_files and checkpoints in SQLITE_DB_FN, keyed on integer PMIDs.
+#   Writes are batched with executemany in one transaction per bulk write.
+#
+#   SQLite allows one writer at a time, so with several worker processes start_writer()
+#   (before forking the workers - see start()) starts a single writer process and the
+#   workers send it their bulk writes over writer_queue instead of competing for the lock.
+#   Messages are (op, items, reply) - reply is the sending end of a pipe for the writer to send
+#   the result of the write back on (see request), or None.
 
-json_conn = sqlite3.connect(settings.JSON_DB_FN)
-json_cursor = json_conn.cursor()
+# SQLite connection - opened on first use in each process (not at import or before a fork)
+conn = None
+conn_pid = None
+conn_lock = threading.RLock()  # shared by the pipeline writer threads
 
+writer_queue = None
+writer_process = None
 
-def setup_databases():
+WRITER_POLL_SECONDS = 60  # how often a process waiting on the writer checks that it is running
 
-    try:
-        setup_xml_db()
-    except Exception:
-        pass
 
-    try:
-        setup_json_db()
-    except Exception:
-        pass
+def get_conn() -> sqlite3.Connection:
 
+    global conn, conn_pid
 
-def setup_xml_db():
-    """For XML SQLite database"""
+    if conn is None or conn_pid != os.getpid():
+        conn = sqlite3.connect(settings.SQLITE_DB_FN, timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_MB * 1024}")
+        conn.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_MB * 1024 * 1024}")
+        setup_database(conn)
+        conn_pid = os.getpid()
 
-    # Create tables
-    xml_cursor.execute(
-        """CREATE TABLE IF NOT EXISTS pubmed_xml (pmid INTEGER PRIMARY KEY, doc text)"""
-    )
-    # xml_cursor.execute("""CREATE UNIQUE INDEX IF NOT EXISTS pmid_idx ON pubmed_xml (pmid)""")
+    return conn
 
-    xml_cursor.execute(
-        """CREATE TABLE IF NOT EXISTS pm_files_processed (filename text PRIMARY KEY)"""
-    )
-    # xml_cursor.execute(
-    #     """CREATE UNIQUE INDEX IF NOT EXISTS pmfiles_idx ON pm_files_processed (filename)"""
-    # )
-    xml_conn.commit()
 
+def setup_database(db: sqlite3.Connection):
+    """Create tables if missing"""
 
-def setup_json_db():
-    """For JSON SQLite database"""
+    with db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS json (pmid INTEGER PRIMARY KEY, hash TEXT, article TEXT NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS xml (pmid INTEGER PRIMARY KEY, filename TEXT, article TEXT NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS processed_files (fn TEXT PRIMARY KEY, article_cnt INTEGER, deleted_cnt INTEGER, skipped_cnt INTEGER, duration REAL, max_rss_mb REAL, doc TEXT)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints (fn TEXT PRIMARY KEY, article_cnt INTEGER, doc TEXT)"
+        )
 
-    # Create tables
-    json_cursor.execute(
-        """CREATE TABLE IF NOT EXISTS pubmed_json (pmid INTEGER PRIMARY KEY, doc_bz2 blob)"""
-    )
-    json_cursor.execute("""CREATE UNIQUE INDEX IF NOT EXISTS pmid_idx ON pubmed_json (pmid)""")
-    json_conn.commit()
 
+def reset_database():
+    """Drop all tables - e.g. before reloading the baseline - and clear the hash index"""
 
-def reset_processed_files():
-    sql = "DELETE FROM pm_files_processed"
-    xml_cursor.execute(sql)
-    xml_conn.commit()
+    with conn_lock, get_conn() as db:
+        for table in ("json", "xml", "processed_files", "checkpoints"):
+            db.execute(f"DROP TABLE IF EXISTS {table}")
 
+    setup_database(get_conn())
+    pm.hashes.clear()
 
-def reset_databases():
-    xml_cursor.execute("DROP TABLE IF EXISTS pubmed_xml ")
-    xml_cursor.execute("DROP TABLE IF EXISTS pm_files_processed")
-    json_cursor.execute("DROP TABLE IF EXISTS pubmed_json")
 
-    setup_databases()
+# Single writer process ##########################################################
 
 
-def get_processed_files():
-    sql = "SELECT filename FROM pm_files_processed"
-    xml_cursor.execute(sql)
-    return xml_cursor.fetchall()
+def start_writer():
+    """Start the writer process - call before starting the worker processes"""
 
+    global writer_queue, writer_process
 
-def compress_doc(doc: str) -> bytes:
-    try:
-        return bz2.compress(doc)
-    except Exception as e:
-        log.error(f"Cannot compress doc, error: {str(e)}")
+    writer_queue = multiprocessing.Queue(maxsize=settings.SQLITE_WRITER_QUEUE_SIZE)
+    writer_process = multiprocessing.Process(target=writer, args=(writer_queue,))
+    writer_process.start()
+
+
+def stop_writer():
+    """Wait for the writer process to finish everything queued"""
+
+    global writer_queue, writer_process
+
+    if writer_process is None:
+        return
+
+    writer_queue.put(None)
+    writer_process.join()
+
+    writer_queue, writer_process = None, None
+
+
+def writer(queue: multiprocessing.Queue):
+    """Apply queued writes in order - drains whatever is queued into one transaction
+
+    Once a transaction fails nothing more is applied - the error is sent to every process
+    waiting on a reply from then on, so no file is recorded as processed without its docs.
+    """
+
+    global writer_queue
+
+    writer_queue = None  # write directly from this process
+
+    error = None
+    finished = False
+    while not finished:
+        msg = queue.get()
+        if msg is None:
+            break
+
+        msgs = [msg]
+        doc_cnt = len(msg[1])
+        while doc_cnt < settings.SQLITE_TXN_DOCS:
+            try:
+                msg = queue.get_nowait()
+            except Empty:
+                break
+            if msg is None:
+                finished = True  # after writing what was drained
+                break
+            msgs.append(msg)
+            doc_cnt += len(msg[1])
+
+        if error is None:
+            try:
+                results = write_msgs(msgs)
+            except Exception as e:
+                log.exception(f"Problem writing {doc_cnt} docs to SQLite - error: {str(e)}")
+                error = e
+
+        if error is not None:
+            results = [error] * len(msgs)
+
+        # Everything queued before a reply has been applied - let the process waiting on it go
+        for (op, items, reply), result in zip(msgs, results):
+            if reply is not None:
+                reply.send(result)
+                reply.close()
+
+
+def write_msgs(msgs: list) -> list:
+    """Apply (op, items, reply) writes in one transaction
+
+    Returns the number of json docs each write deleted - None for writes other than deletes
+    """
+
+    results = []
+    written_hashes = []
+    with conn_lock, get_conn() as db:
+        for op, items, reply in msgs:
+            result = None
+            if op == "xml":
+                db.executemany(
+                    "INSERT OR REPLACE INTO xml (pmid, filename, article) VALUES (?, ?, ?)",
+                    [(int(doc["_key"]), doc["filename"], doc["article"]) for doc in items],
+                )
+            elif op == "json":
+                db.executemany(
+                    "INSERT OR REPLACE INTO json (pmid, hash, article) VALUES (?, ?, ?)",
+                    [
+                        (int(doc["_key"]), doc["hash"], json.dumps(doc["article"]))
+                        for doc in items
+                    ],
+                )
+                written_hashes.extend(
+                    (doc["_key"], doc["hash"]) for doc in items if doc["hash"]
+                )
+            elif op == "delete":
+                pmids = [(int(pmid),) for pmid in items]
+                result = db.executemany("DELETE FROM json WHERE pmid=?", pmids).rowcount
+                db.executemany("DELETE FROM xml WHERE pmid=?", pmids)
+            elif op == "processed_file":
+                for doc in items:
+                    db.execute(
+                        "INSERT OR REPLACE INTO processed_files (fn, article_cnt, deleted_cnt, skipped_cnt, duration, max_rss_mb, doc) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            doc["fn"],
+                            doc["article_cnt"],
+                            doc["deleted_cnt"],
+                            doc["skipped_cnt"],
+                            doc["duration"],
+                            doc["max_rss_mb"],
+                            json.dumps(doc),
+                        ),
+                    )
+                    db.execute("DELETE FROM checkpoints WHERE fn=?", (doc["fn"],))
+            elif op == "checkpoint":
+                db.executemany(
+                    "INSERT OR REPLACE INTO checkpoints (fn, article_cnt, doc) VALUES (?, ?, ?)",
+                    [(doc["fn"], doc["article_cnt"], json.dumps(doc)) for doc in items],
+                )
+            results.append(result)
+
+    # Hashes are recorded once the docs are committed
+    if written_hashes:
+        pm.hashes.set_hashes(written_hashes)
+
+    for op, items, reply in msgs:
+        if op == "delete":
+            pm.hashes.delete_hashes(items)
+
+    return results
+
+
+def write(op: str, items: list, wait: bool = False):
+    """Send write to the writer process if there is one, else write it here
+
+    Returns the number of json docs deleted by a delete - None for other writes, and when
+    sent to the writer process without waiting for it to be applied
+    """
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    if writer_queue is None:
+        result = write_msgs([(op, items, None)])[0]
+    elif wait:
+        result = request(op, items)
+    else:
+        writer_queue.put((op, items, None))
+        result = None
+
+    if settings.INSTRUMENT:
+        pm.stats.add_time("db_io", start)
+
+    return result
+
+
+def request(op: str, items: list):
+    """Send write to the writer process and wait for it to be applied - returns its result
+
+    Raises the writer's error if the write (or an earlier one) failed, and RuntimeError if
+    the writer process exits before replying
+    """
+
+    reader, sender = multiprocessing.Pipe(duplex=False)
+    writer_queue.put((op, items, sender))
+
+    # Forked workers inherit the writer's sentinel, which is ready once the writer has exited
+    while True:
+        ready = multiprocessing.connection.wait(
+            [reader, writer_process.sentinel], timeout=WRITER_POLL_SECONDS
+        )
+        if reader in ready:
+            result = reader.recv()
+            reader.close()
+            if isinstance(result, Exception):
+                raise result
+            return result
+        if ready:
+            raise RuntimeError("SQLite writer process exited before applying the writes")
+        log.info(f"Waiting on the SQLite writer process - {writer_queue.qsize()} writes queued")
 
 
-def decompress_doc(doc_bz2: bytes) -> str:
-    try:
-        return bz2.decompress(doc_bz2)
-    except Exception as e:
-        log.error(f"Cannot decompress doc_bz2, error: {str(e)}")
+def sync():
+    """Wait for the writer process to apply the writes this process has queued"""
 
+    if writer_queue is not None:
+        request("sync", [])
 
-def xml_tostring(doc: Element) -> str:
-    try:
-        # return ET.tostring(doc, "utf-8").decode("utf-8")  # convert from bytes to string
-        return ET.tostring(doc, "utf-8")
 
-    except Exception as e:
-        log.error(f"Cannot convert xml to string, error: {str(e)}")
+# Storage backend interface (see pm.storage) #####################################
 
 
-def xml_fromstring(doc: str) -> Element:
-    try:
-        return ET.fromstring(doc)
-    except Exception as e:
-        log.error(f"Cannot convert string to xml, error: {str(e)}")
+def start():
+    """Start the writer process if SQLITE_WRITER - before the worker processes are started"""
 
+    if settings.SQLITE_WRITER:
+        start_writer()
 
-def add_xml(pmid: int, doc: Element):
 
-    pmid = int(pmid)
+def stop():
+    stop_writer()
 
-    try:
-        doc_bz2 = compress_doc(xml_tostring(doc))
-        xml_cursor.execute(
-            "INSERT INTO pubmed_xml (pmid, doc_bz2) VALUES (:pmid, :doc_bz2)  ON CONFLICT (pmid) DO UPDATE SET doc_bz2=:doc_bz2",
-            {"pmid": pmid, "doc_bz2": doc_bz2},
-        )
-    except Exception as e:
-        print("Error", str(e))
 
+def target() -> str:
+    return f"sqlite {os.path.abspath(settings.SQLITE_DB_FN)}"
 
-def add_xml_fn(fn):
 
-    article_gen = pm.xml.parse_baseline_file_as_generator(fn)
-    xml_cursor.executemany(
-        "INSERT INTO pubmed_xml (pmid, doc) VALUES (?, ?) ON CONFLICT (pmid) DO NOTHING ",
-        article_gen,
-    )
+def put_many(json_docs: list, xml_docs: list):
+    """Bulk write docs - content hashes are added to the hash index once committed"""
 
-    add_xml_fn(fn)
-    commit_xml()
+    if xml_docs:
+        write("xml", xml_docs)
 
+    if json_docs:
+        write("json", json_docs)
 
-# def add_xml_fn(fn: str):
 
-#     try:
-#         xml_cursor.execute(
-#             "INSERT INTO pm_files_processed (fn) VALUES (:fn)", {"fn": fn},
-#         )
-#     except Exception as e:
-#         pass
+def delete_many(pmids: list) -> int:
+    """Bulk remove deleted PMIDs from the json and xml tables
 
+    Returns the number of json docs removed - waits for the writer process to apply the
+    delete when there is one
+    """
 
-def add_json(pmid: int, doc: str):
+    return write("delete", pmids, wait=True)
 
-    pmid = int(pmid)
 
-    try:
-        doc_bz2 = compress_doc(doc)
-        json_cursor.execute(
-            "INSERT INTO pubmed_xml (pmid, doc_bz2) VALUES (:pmid, :doc_bz2)  ON CONFLICT (pmid) DO UPDATE SET doc_bz2=:doc_bz2",
-            {"pmid": pmid, "doc_bz2": doc_bz2},
-        )
-    except Exception as e:
-        print("Error", str(e))
+def mark_file_done(doc: dict):
+    """Record the processed file - waits for the writer process to apply the file's writes
 
+    The next file checks its records against the hash index, which has to have this
+    file's deletes - otherwise a deleted PMID sent again unchanged would be skipped.
+    """
 
-def get_xml_doc(pmid: int) -> Element:
-    """Get xml doc and decompress it and convert back to XML Element object"""
+    write("processed_file", [doc])
+    sync()
 
-    pmid = int(pmid)
 
-    doc_bz2 = xml_cursor.execute("select doc_bz2 from pubmed_xml where pmid=?", (pmid,)).fetchone()
-    doc_bz2 = doc_bz2[0]
+def get_manifest() -> dict:
 
-    doc = xml_fromstring(decompress_doc(doc_bz2))
+    with conn_lock:
+        rows = get_conn().execute(
+            "SELECT fn, json_extract(doc, '$.size'), json_extract(doc, '$.mtime'), json_extract(doc, '$.checksum') FROM processed_files"
+        ).fetchall()
 
-    return doc
+    return {
+        pm.manifest.file_key(fn): {"size": size, "mtime": mtime, "checksum": checksum}
+        for fn, size, mtime, checksum in rows
+    }
 
 
-def get_json_doc(pmid):
-    """Get json doc and decompress it"""
+def set_checkpoint(doc: dict):
 
-    pmid = int(pmid)
+    write("checkpoint", [doc])
 
-    doc_bz2 = json_cursor.execute(
-        "select doc_bz2 from pubmed_json where pmid=?", (pmid,)
-    ).fetchone()
-    doc_bz2 = doc_bz2[0]
 
-    doc = decompress_doc(doc_bz2)
-    return doc
+def get_checkpoint(fn: str) -> dict:
 
+    with conn_lock:
+        row = get_conn().execute("SELECT doc FROM checkpoints WHERE fn=?", (fn,)).fetchone()
 
-def add_citation(pmid: int, xml_doc: Element):
+    if row:
+        return json.loads(row[0])
 
-    pmid = int(pmid)
 
-    json_doc = pm.convert.xml_to_json(xml_doc)
+# Reads ##########################################################################
 
-    add_xml(pmid, xml_doc)
-    add_json(pmid, json_doc)
 
+def get_json_doc(pmid: str) -> dict:
+    """Converted article - None if not stored"""
 
-def rm_pmid(pmid: int):
-    xml_cursor.execute("DELETE FROM pubmed WHERE pmid=?", (pmid,))
-    json_cursor.execute("DELETE FROM pubmed WHERE pmid=?", (pmid,))
+    with conn_lock:
+        row = get_conn().execute(
+            "SELECT article FROM json WHERE pmid=?", (int(pmid),)
+        ).fetchone()
 
+    if row:
+        return json.loads(row[0])
 
-def commit_xml():
-    xml_conn.commit()
 
+def get_xml_doc(pmid: str) -> str:
+    """Pubmed XML of the article - None if not stored"""
 
-def commit_json():
-    json_conn.commit()
+    if settings.XML_ARCHIVE:
+        return pm.xmlarchive.get_xml(pmid)
 
+    with conn_lock:
+        row = get_conn().execute(
+            "SELECT article FROM xml WHERE pmid=?", (int(pmid),)
+        ).fetchone()
 
-def commit_both():
-    commit_xml()
-    commit_json()
+    if row:
+        return row[0]
@@ -0,0 +1,338 @@
+import datetime
+import functools
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+
+import pm.logs
+import pm.settings as settings
+import pm.xml
+
+log = logging.getLogger()
+
+# Offline conversion of pubmed files to JSON Lines or Parquet - no database needed
+
+COMPRESSION_EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+
+def source_filename(path_fn: str) -> str:
+    """Name recorded as pubmed_xml_fn - relative to PUBMED_DATA_DIR if the file is under it"""
+
+    if settings.PUBMED_DATA_DIR:
+        data_dir = os.path.abspath(settings.PUBMED_DATA_DIR)
+        if os.path.abspath(path_fn).startswith(f"{data_dir}/"):
+            return os.path.relpath(path_fn, data_dir)
+
+    return os.path.basename(path_fn)
+
+
+def file_stem(path_fn: str) -> str:
+    """Input file name without extensions, e.g. pubmed20n0001"""
+
+    name = os.path.basename(path_fn)
+    for ext in (".gz", ".xml"):
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+
+    return name
+
+
+def output_filename(path_fn: str, out_dir: str, compression: str) -> str:
+    """Output shard for input file, e.g. out_dir/pubmed20n0001.jsonl.gz"""
+
+    return os.path.join(out_dir, f"{file_stem(path_fn)}{COMPRESSION_EXTENSIONS[compression]}")
+
+
+def open_output(out_fn: str, compression: str):
+    """Open compressed text file for writing"""
+
+    if compression == "gzip":
+        return gzip.open(out_fn, "wt", compresslevel=settings.EXPORT_GZIP_LEVEL)
+
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the zstandard package")
+
+        cctx = zstandard.ZstdCompressor(level=settings.EXPORT_ZSTD_LEVEL)
+        return zstandard.open(out_fn, "wt", cctx=cctx)
+
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def convert_file_to_jsonl(path_fn: str, out_dir: str, compression: str = "gzip") -> dict:
+    """Convert one pubmed xml file into a compressed JSON Lines shard
+
+    Deleted PMIDs (updatefiles) are written one per line to a .deleted.txt file next to the shard
+    """
+
+    start_time = datetime.datetime.now()
+
+    filename = source_filename(path_fn)
+    out_fn = output_filename(path_fn, out_dir, compression)
+    tmp_fn = f"{out_fn}.tmp"
+
+    pm.logs.take_issues()  # drop anything left over from a file that failed part way
+
+    article_cnt = 0
+    deleted_pmids = []
+    with open_output(tmp_fn, compression) as f:
+        for pmid, record_dict, xml_record_str in pm.xml.iter_converted_records(
+            filename, deleted_pmids, path_fn=path_fn
+        ):
+            f.write(json.dumps(record_dict) + "\n")
+            article_cnt += 1
+
+    os.replace(tmp_fn, out_fn)
+
+    write_deleted_pmids(os.path.join(out_dir, f"{file_stem(path_fn)}.deleted.txt"), deleted_pmids)
+
+    duration_sec = (datetime.datetime.now() - start_time).total_seconds()
+    pm.logs.log_issues(filename, pm.logs.take_issues())
+
+    return {
+        "fn": filename,
+        "out_fn": out_fn,
+        "article_cnt": article_cnt,
+        "deleted_cnt": len(deleted_pmids),
+        "duration_sec": duration_sec,
+    }
+
+
+def write_deleted_pmids(deleted_fn: str, deleted_pmids: list):
+    """Deleted PMIDs (updatefiles) one per line next to the output"""
+
+    if deleted_pmids:
+        with open(deleted_fn, "w") as f:
+            f.write("\n".join(deleted_pmids) + "\n")
+
+
+def export_files(files: list, convert, processes: int = None, label: str = "Export") -> int:
+    """Run convert(path_fn) over the files in parallel - returns the total article count"""
+
+    if processes is None:
+        processes = int(settings.NUMBER_OF_PROCESSORS)
+
+    # Largest first so one big file doesn't finish last on its own
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    if not files:
+        return 0
+
+    total_article_cnt = 0
+    total_start_time = datetime.datetime.now()
+    with multiprocessing.Pool(min(processes, len(files))) as pool:
+        for result in pool.imap_unordered(convert, files):
+            total_article_cnt += result["article_cnt"]
+            total_duration = (datetime.datetime.now() - total_start_time).total_seconds()
+            log.info(
+                f"{label}: {result['article_cnt']} Articles/sec: {result['article_cnt'] / result['duration_sec']}  Duration(sec): {result['duration_sec']} Total Articles/Sec: {total_article_cnt / total_duration} FN: {result['fn']}"
+            )
+
+    return total_article_cnt
+
+
+def export_jsonl(files: list, out_dir: str, compression: str = "gzip", processes: int = None):
+    """Convert pubmed files to JSON Lines shards in parallel - one shard per input file"""
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    convert = functools.partial(convert_file_to_jsonl, out_dir=out_dir, compression=compression)
+
+    return export_files(files, convert, processes=processes, label="JSONL")
+
+
+# Parquet #######################################################################
+
+
+# Directory name readers take as a null partition value - for records with no pub_date
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def get_pyarrow():
+    """(pyarrow, pyarrow.parquet) - Parquet export needs the optional pyarrow package"""
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export requires the pyarrow package")
+
+    return pyarrow, pyarrow.parquet
+
+
+def parquet_schema():
+    """Arrow schema of the converted records - list fields are native list/struct columns"""
+
+    pa, pq = get_pyarrow()
+
+    mesh_term = pa.struct([("id", pa.string()), ("name", pa.string())])
+
+    return pa.schema(
+        [
+            ("pmid", pa.int64()),
+            ("title", pa.string()),
+            ("abstract", pa.string()),
+            ("authors", pa.list_(pa.string())),
+            ("pub_date", pa.date32()),
+            ("pub_year", pa.int16()),
+            ("journal_title", pa.string()),
+            ("journal_iso_title", pa.string()),
+            ("article_types", pa.list_(pa.string())),
+            ("doi", pa.string()),
+            ("compounds", pa.list_(mesh_term)),
+            ("mesh", pa.list_(mesh_term)),
+            ("pubmed_xml_fn", pa.string()),
+        ]
+    )
+
+
+def parquet_row(record_dict: dict) -> dict:
+    """Record converted by pm.xml as a row of parquet_schema()"""
+
+    pub_date = None
+    if record_dict.get("pub_date"):
+        pub_date = datetime.date.fromisoformat(record_dict["pub_date"])
+
+    return {
+        "pmid": int(record_dict["pmid"]),
+        "title": record_dict.get("title"),
+        "abstract": record_dict.get("abstract"),
+        "authors": record_dict.get("authors"),
+        "pub_date": pub_date,
+        "pub_year": pub_date.year if pub_date else None,
+        "journal_title": record_dict.get("journal_title"),
+        "journal_iso_title": record_dict.get("journal_iso_title"),
+        "article_types": record_dict.get("article_types"),
+        "doi": record_dict.get("doi"),
+        "compounds": record_dict.get("compounds"),
+        "mesh": record_dict.get("mesh"),
+        "pubmed_xml_fn": record_dict.get("pubmed_xml_fn"),
+    }
+
+
+class ParquetPartitions:
+    """Row group writers for one input file - one output per partition
+
+    partition="file": out_dir/pubmed20n0001.parquet
+    partition="year": out_dir/pub_year=1998/pubmed20n0001.parquet (hive style - the pub_year
+                      column is only in the directory name, records without a pub_date
+                      are in pub_year=__HIVE_DEFAULT_PARTITION__)
+
+    Files are written as .tmp and renamed by close()
+    """
+
+    def __init__(self, path_fn: str, out_dir: str, partition: str):
+        self.pa, self.pq = get_pyarrow()
+        self.schema = parquet_schema()
+        if partition == "year":
+            self.schema = self.schema.remove(self.schema.get_field_index("pub_year"))
+        self.stem = file_stem(path_fn)
+        self.out_dir = out_dir
+        self.partition = partition
+        self.rows = {}  # partition key -> rows waiting for a row group
+        self.writers = {}  # partition key -> (out_fn, pyarrow.parquet.ParquetWriter)
+
+    def out_filename(self, key) -> str:
+
+        if self.partition == "year":
+            year = HIVE_NULL_PARTITION if key is None else key
+            return os.path.join(self.out_dir, f"pub_year={year}", f"{self.stem}.parquet")
+
+        return os.path.join(self.out_dir, f"{self.stem}.parquet")
+
+    def add(self, row: dict):
+
+        key = row["pub_year"] if self.partition == "year" else self.stem
+        rows = self.rows.setdefault(key, [])
+        rows.append(row)
+
+        if len(rows) >= settings.PARQUET_ROW_GROUP_SIZE:
+            self.write_row_group(key)
+
+    def write_row_group(self, key):
+
+        rows = self.rows.pop(key, None)
+        if not rows:
+            return
+
+        if key not in self.writers:
+            out_fn = self.out_filename(key)
+            os.makedirs(os.path.dirname(out_fn), exist_ok=True)
+            writer = self.pq.ParquetWriter(
+                f"{out_fn}.tmp", self.schema, compression=settings.PARQUET_COMPRESSION
+            )
+            self.writers[key] = (out_fn, writer)
+
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        self.writers[key][1].write_table(table)
+
+    def close(self) -> list:
+        """Write remaining rows and rename the finished files - returns their names"""
+
+        for key in list(self.rows):
+            self.write_row_group(key)
+
+        out_fns = []
+        for out_fn, writer in self.writers.values():
+            writer.close()
+            os.replace(f"{out_fn}.tmp", out_fn)
+            out_fns.append(out_fn)
+
+        return out_fns
+
+
+def convert_file_to_parquet(path_fn: str, out_dir: str, partition: str = "file") -> dict:
+    """Convert one pubmed xml file into Parquet row groups
+
+    Deleted PMIDs (updatefiles) are written one per line to out_dir/_deleted/<file>.txt -
+    outside the dataset, Arrow skips paths starting with _
+    """
+
+    start_time = datetime.datetime.now()
+
+    filename = source_filename(path_fn)
+
+    pm.logs.take_issues()  # drop anything left over from a file that failed part way
+
+    partitions = ParquetPartitions(path_fn, out_dir, partition)
+
+    article_cnt = 0
+    deleted_pmids = []
+    for pmid, record_dict, xml_record_str in pm.xml.iter_converted_records(
+        filename, deleted_pmids, path_fn=path_fn
+    ):
+        partitions.add(parquet_row(record_dict))
+        article_cnt += 1
+
+    out_fns = partitions.close()
+
+    if deleted_pmids:
+        os.makedirs(os.path.join(out_dir, "_deleted"), exist_ok=True)
+        deleted_fn = os.path.join(out_dir, "_deleted", f"{file_stem(path_fn)}.txt")
+        write_deleted_pmids(deleted_fn, deleted_pmids)
+
+    duration_sec = (datetime.datetime.now() - start_time).total_seconds()
+    pm.logs.log_issues(filename, pm.logs.take_issues())
+
+    return {
+        "fn": filename,
+        "out_fns": out_fns,
+        "article_cnt": article_cnt,
+        "deleted_cnt": len(deleted_pmids),
+        "duration_sec": duration_sec,
+    }
+
+
+def export_parquet(files: list, out_dir: str, partition: str = "file", processes: int = None):
+    """Convert pubmed files to Parquet in parallel - partitioned by input file or pub_year"""
+
+    get_pyarrow()  # fail before starting workers if pyarrow is missing
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    convert = functools.partial(convert_file_to_parquet, out_dir=out_dir, partition=partition)
+
+    return export_files(files, convert, processes=processes, label="Parquet")
@@ -0,0 +1,314 @@
+import array
+import bisect
+import datetime
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import zlib
+
+import pm.reader
+import pm.settings as settings
+import pm.xml
+
+log = logging.getLogger()
+
+# Per-file index (FILE_INDEX) - written whenever a pubmed file has been split into records
+#
+#   FILE_INDEX_DIR/<fn>.json  summary - article and deleted PMID counts, PMID range,
+#                             uncompressed size and the size/mtime of the file it describes
+#   FILE_INDEX_DIR/<fn>.idx   (pmid, offset, length) of each article in the decompressed file
+#                             as native int64 triples (array "q"), sorted by (pmid, offset)
+#                             for bisect lookups - PMIDs of DeleteCitation records have length 0
+#
+#   fn is the filename relative to PUBMED_DATA_DIR. Summaries drive largest-first scheduling
+#   and ETAs (estimate_articles), offsets let a single article be read without parsing the
+#   file (get_article_xml, pm.lookup).
+#
+#   Reads from a .gz start at the nearest of its seek points - zlib decompressor states saved
+#   every SEEK_POINT_BYTES of output by one pass over the file and kept for the last
+#   LOOKUP_SEEK_FILES files. An uncompressed .xml copy next to the .gz (gunzip -k) is read with
+#   a plain seek and is fastest.
+
+INDEX_VERSION = 3  # indexes written with another version are rebuilt
+SEEK_POINT_BYTES = 512 * 1024  # decompressed bytes between seek points of a .gz file
+SEEK_READ_BYTES = 16 * 1024  # compressed bytes read at a time from a .gz file
+PMID_RE = re.compile(rb"<PMID[^>]*>(\d+)</PMID>")  # first match is the citation PMID
+
+
+def index_filenames(fn: str) -> tuple:
+    """(summary, offsets) filenames of the index of fn"""
+
+    base_fn = os.path.join(settings.FILE_INDEX_DIR, fn)
+    return f"{base_fn}.json", f"{base_fn}.idx"
+
+
+def new_index() -> array.array:
+    return array.array("q")
+
+
+def add_record(index: array.array, tag: str, offset: int, raw_xml: bytes):
+    """Add a record split from the file (raw_xml may be a memoryview)"""
+
+    if tag in pm.xml.ARTICLE_TAGS:
+        match = PMID_RE.search(raw_xml)
+        pmid = int(match.group(1)) if match else 0
+        index.extend((pmid, offset, len(raw_xml)))
+    elif tag == "DeleteCitation":
+        for pmid in PMID_RE.findall(raw_xml):
+            index.extend((int(pmid), offset, 0))
+
+
+def write_index(fn: str, index: array.array, uncompressed_size: int):
+
+    pmids = [pmid for pmid, length in zip(index[0::3], index[2::3]) if length]
+    stat = os.stat(f"{settings.PUBMED_DATA_DIR}/{fn}")
+
+    summary = {
+        "version": INDEX_VERSION,
+        "fn": fn,
+        "article_cnt": len(pmids),
+        "deleted_cnt": len(index) // 3 - len(pmids),
+        "pmid_min": min(pmids) if pmids else None,
+        "pmid_max": max(pmids) if pmids else None,
+        "uncompressed_size": uncompressed_size,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    summary_fn, offsets_fn = index_filenames(fn)
+    os.makedirs(os.path.dirname(summary_fn), exist_ok=True)
+
+    triples = sorted(zip(index[0::3], index[1::3], index[2::3]))
+    index = array.array("q", (value for triple in triples for value in triple))
+
+    # Offsets first - a summary is only there once its offsets are complete
+    with open(f"{offsets_fn}.tmp", "wb") as f:
+        index.tofile(f)
+    os.replace(f"{offsets_fn}.tmp", offsets_fn)
+
+    with open(f"{summary_fn}.tmp", "w") as f:
+        json.dump(summary, f)
+    os.replace(f"{summary_fn}.tmp", summary_fn)
+
+
+def iter_indexed(fn: str, records):
+    """Pass through the records of pm.reader.iter_record_bytes and index them
+
+    The index of fn is written once all the records have been read
+    """
+
+    index = new_index()
+    while True:
+        try:
+            record = next(records)
+        except StopIteration as e:
+            uncompressed_size = e.value
+            break
+
+        add_record(index, *record)
+        yield record
+
+    write_index(fn, index, uncompressed_size)
+
+
+def index_spans(fn: str, data, spans: list):
+    """Index a file from the (tag, start, end) spans of its buffer (pm.reader.iter_record_spans)"""
+
+    index = new_index()
+    view = memoryview(data)
+    for tag, start, end in spans:
+        add_record(index, tag, start, view[start:end])
+    view.release()
+
+    write_index(fn, index, len(data))
+
+
+def index_file(fn: str) -> dict:
+    """Split and index fn without converting it - returns the summary"""
+
+    with pm.reader.open_pubmed_file(f"{settings.PUBMED_DATA_DIR}/{fn}") as f:
+        records = pm.reader.iter_record_bytes(f, settings.READ_AHEAD_BYTES)
+        for record in iter_indexed(fn, records):
+            pass
+
+    return load_summary(fn)
+
+
+def index_files(files: list, processes: int = None):
+    """Index pubmed files under PUBMED_DATA_DIR in parallel"""
+
+    fns = [os.path.relpath(path_fn, settings.PUBMED_DATA_DIR) for path_fn in files]
+
+    processes = min(processes or int(settings.NUMBER_OF_PROCESSORS), len(fns))
+    with multiprocessing.Pool(processes) as pool:
+        for summary in pool.imap_unordered(index_file, fns):
+            log.info(
+                f"Indexed {summary['fn']} Article_cnt: {summary['article_cnt']}  PMIDs: {summary['pmid_min']}-{summary['pmid_max']}  Deleted: {summary['deleted_cnt']}  Uncompressed(MB): {summary['uncompressed_size'] / 1_000_000:.1f}"
+            )
+
+
+def load_summary(fn: str) -> dict:
+    """Index summary of fn - None if there is no index or the file changed since it was indexed"""
+
+    summary_fn, offsets_fn = index_filenames(fn)
+    if not os.path.exists(summary_fn):
+        return None
+
+    with open(summary_fn) as f:
+        summary = json.load(f)
+
+    if summary.get("version") != INDEX_VERSION:
+        return None
+
+    stat = os.stat(f"{settings.PUBMED_DATA_DIR}/{fn}")
+    if stat.st_size != summary["size"] or stat.st_mtime != summary["mtime"]:
+        return None
+
+    return summary
+
+
+def estimate_articles(fns: list) -> dict:
+    """Article count of each file - from its index, or estimated from its compressed size
+
+    Sizes are converted using the articles per byte of the indexed files. Returns None
+    if none of the files are indexed.
+    """
+
+    summaries = {fn: load_summary(fn) for fn in fns}
+    indexed = [summary for summary in summaries.values() if summary]
+    if not indexed:
+        return None
+
+    articles_per_byte = sum(s["article_cnt"] for s in indexed) / max(
+        sum(s["size"] for s in indexed), 1
+    )
+
+    estimates = {}
+    for fn, summary in summaries.items():
+        if summary:
+            estimates[fn] = summary["article_cnt"]
+        else:
+            size = os.path.getsize(f"{settings.PUBMED_DATA_DIR}/{fn}")
+            estimates[fn] = int(size * articles_per_byte)
+
+    return estimates
+
+
+def load_offsets(fn: str) -> array.array:
+    """(pmid, offset, length) triples of the records in fn - length 0 for deleted PMIDs"""
+
+    offsets = array.array("q")
+    with open(index_filenames(fn)[1], "rb") as f:
+        offsets.frombytes(f.read())
+
+    return offsets
+
+
+def find_article(fn: str, pmid: int) -> tuple:
+    """(offset, length) of the last article for pmid in fn - None if it is not in the file
+    or is deleted after it
+    """
+
+    offsets = load_offsets(fn)
+    pmids = offsets[0::3]
+    idx = bisect.bisect_right(pmids, pmid) - 1  # triples of a PMID are in file order
+    if idx < 0 or pmids[idx] != pmid or offsets[3 * idx + 2] == 0:
+        return None
+
+    return offsets[3 * idx + 1], offsets[3 * idx + 2]
+
+
+def decompress(decompressor, data: bytes) -> tuple:
+    """(decompressor, output) - continues with a new decompressor after the end of a gzip member"""
+
+    output = decompressor.decompress(data)
+    while decompressor.eof and decompressor.unused_data:
+        data = decompressor.unused_data
+        decompressor = zlib.decompressobj(wbits=31)
+        output += decompressor.decompress(data)
+
+    return decompressor, output
+
+
+@functools.lru_cache(maxsize=settings.LOOKUP_SEEK_FILES)
+def seek_points(path_fn: str, size: int, mtime: float) -> tuple:
+    """([decompressed offset], [(compressed offset, decompressor)]) of a .gz file
+
+    size and mtime key the cache - a changed file gets new seek points
+    """
+
+    positions, points = [], []
+    decompressor = zlib.decompressobj(wbits=31)
+    position = compressed_position = 0
+    with open(path_fn, "rb") as f:
+        while True:
+            if not positions or position - positions[-1] >= SEEK_POINT_BYTES:
+                positions.append(position)
+                points.append((compressed_position, decompressor.copy()))
+
+            data = f.read(SEEK_READ_BYTES)
+            if not data:
+                break
+            compressed_position += len(data)
+            decompressor, output = decompress(decompressor, data)
+            position += len(output)
+
+    return positions, points
+
+
+def read_gzip(path_fn: str, offset: int, length: int) -> bytes:
+    """Bytes at offset in the decompressed .gz, decompressed from the nearest seek point"""
+
+    stat = os.stat(path_fn)
+    positions, points = seek_points(path_fn, stat.st_size, stat.st_mtime)
+    idx = bisect.bisect_right(positions, offset) - 1
+    position = positions[idx]
+    compressed_position, decompressor = points[idx]
+    decompressor = decompressor.copy()
+
+    buffer = bytearray()
+    with open(path_fn, "rb") as f:
+        f.seek(compressed_position)
+        while position + len(buffer) < offset + length:
+            data = f.read(SEEK_READ_BYTES)
+            if not data:
+                break
+            decompressor, output = decompress(decompressor, data)
+            buffer += output
+
+    return bytes(buffer[offset - position : offset - position + length])
+
+
+def read_article(fn: str, offset: int, length: int) -> bytes:
+    """Article bytes at offset in the decompressed file
+
+    Seeks in the uncompressed .xml if present, otherwise decompresses from the .gz seek point
+    before offset
+    """
+
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+
+    xml_fn = pm.reader.plain_xml_fn(path_fn)
+    if xml_fn:
+        with open(xml_fn, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    return read_gzip(path_fn, offset, length)
+
+
+def get_article_xml(fn: str, pmid: str) -> bytes:
+    """Original XML of a PMID's article in fn using the file's index - None if not found"""
+
+    if load_summary(fn) is None:
+        return None
+
+    location = find_article(fn, int(pmid))
+    if location is None:
+        return None
+
+    return read_article(fn, *location)
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import pm.settings as settings
+import pm.storage
+import xxhash
+
+log = logging.getLogger()
+
+# Local PMID -> content hash index (SQLite) used to skip unchanged records
+#   The hashes describe what is stored in one storage target (pm.storage.target() - backend
+#   and database/path), so each target has its own index file unless HASH_INDEX_FN is set.
+#   The index records its target and is cleared if it is opened for another target, when
+#   the database is reset, or when the target has no processed files (see pm.manifest).
+#   Connection is opened on first use in each process so it is never shared across a fork.
+#   It is shared by the threads of a process (pipeline writer threads) under index_lock.
+index_conn = None
+index_pid = None
+index_lock = threading.RLock()
+
+
+def hash_record(record_dict: dict, xml_record_str: str = None) -> tuple:
+    """(content hash, JSON size in bytes) of the stored content of a record
+
+    pubmed_xml_fn is left out so the same record re-sent in a later file hashes the same.
+    The size is of the JSON serialized for the hash - pass it to pm.storage.add_json so
+    the record is not serialized again to size the bulk write.
+    """
+
+    content = {k: v for k, v in record_dict.items() if k != "pubmed_xml_fn"}
+    content_json = json.dumps(content, sort_keys=True).encode("utf-8")
+    h = xxhash.xxh64(content_json)
+    if xml_record_str is not None:
+        h.update(xml_record_str.encode("utf-8"))
+
+    return h.hexdigest(), len(content_json)
+
+
+def content_hash(record_dict: dict, xml_record_str: str = None) -> str:
+    """Hash of the stored content of a record - see hash_record"""
+
+    return hash_record(record_dict, xml_record_str)[0]
+
+
+def index_filename() -> str:
+    """HASH_INDEX_FN - or a filename derived from the storage target"""
+
+    if settings.HASH_INDEX_FN:
+        return settings.HASH_INDEX_FN
+
+    target_key = xxhash.xxh64(pm.storage.target().encode("utf-8")).hexdigest()
+    return f"pubmed_hashes_{settings.STORAGE_BACKEND}_{target_key}.db"
+
+
+def get_index_conn() -> sqlite3.Connection:
+
+    global index_conn, index_pid
+
+    if index_conn is None or index_pid != os.getpid():
+        index_conn = sqlite3.connect(index_filename(), timeout=60, check_same_thread=False)
+        index_conn.execute("PRAGMA journal_mode=WAL")
+        index_conn.execute("PRAGMA synchronous=NORMAL")
+        index_conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes (pmid INTEGER PRIMARY KEY, hash TEXT NOT NULL)"
+        )
+        index_conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        check_target(index_conn)
+        index_conn.commit()
+        index_pid = os.getpid()
+
+    return index_conn
+
+
+def check_target(conn: sqlite3.Connection):
+    """Clear the index if its hashes were recorded for another storage target"""
+
+    target = pm.storage.target()
+    row = conn.execute("SELECT value FROM meta WHERE key='target'").fetchone()
+    if row and row[0] == target:
+        return
+
+    if conn.execute("SELECT 1 FROM hashes LIMIT 1").fetchone():
+        recorded = row[0] if row else "unknown"
+        log.warning(f"Content hash index was recorded for {recorded} - clearing it for {target}")
+        conn.execute("DELETE FROM hashes")
+
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('target', ?)", (target,))
+
+
+def clear():
+    """Remove all hashes - when the stored records are gone (e.g. the database is reset)"""
+
+    with index_lock, get_index_conn() as conn:
+        conn.execute("DELETE FROM hashes")
+
+
+def get_hash(pmid: str) -> str:
+
+    with index_lock:
+        row = get_index_conn().execute(
+            "SELECT hash FROM hashes WHERE pmid=?", (int(pmid),)
+        ).fetchone()
+    if row:
+        return row[0]
+
+
+def is_unchanged(pmid: str, record_hash: str) -> bool:
+    """Record was already written with the same content"""
+
+    return settings.SKIP_UNCHANGED and get_hash(pmid) == record_hash
+
+
+def set_hashes(pmid_hashes: list):
+    """Record hashes of written docs - list of (pmid, hash)"""
+
+    with index_lock, get_index_conn() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO hashes (pmid, hash) VALUES (?, ?)",
+            [(int(pmid), record_hash) for pmid, record_hash in pmid_hashes],
+        )
+
+
+def delete_hashes(pmids: list):
+
+    with index_lock, get_index_conn() as conn:
+        conn.executemany("DELETE FROM hashes WHERE pmid=?", [(int(pmid),) for pmid in pmids])
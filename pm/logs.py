@@ -0,0 +1,144 @@
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+import time
+from collections import Counter
+
+import pm.settings as settings
+
+log = logging.getLogger()
+
+# Worker logging
+#
+#   Every process logs through a QueueHandler into one multiprocessing queue, and a single
+#   QueueListener thread in the main process writes the log file. Forked workers inherit the
+#   handler. Repeated warnings and errors from the same call site are rate limited before they
+#   are queued - INFO lines (per-file progress and summaries) are always written.
+#
+#   Per-record data-quality problems (missing title, bad pub date, ...) are not logged at all -
+#   they are counted with issue() and reported once per file (see take_issues/log_issues).
+
+ISSUE_SAMPLE_SIZE = 5  # PMIDs kept per issue type as examples
+
+listener = None
+
+issue_counts = Counter()
+issue_samples = {}
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most LOG_RATE_LIMIT warnings per call site every LOG_RATE_INTERVAL seconds
+
+    Warnings here are WARNING and above - lower levels always pass. Call sites are
+    (filename, line) so messages built with f-strings still dedupe. The number of suppressed
+    records is added to the next record passed from that call site.
+    """
+
+    def __init__(self, limit: int, interval: float):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.sites = {}  # (pathname, lineno) -> [window_start, passed_cnt, suppressed_cnt]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+
+        if not self.limit or record.levelno < logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        site = self.sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+
+        if now - site[0] >= self.interval:
+            suppressed_cnt = site[2]
+            site[:] = [now, 0, 0]
+            if suppressed_cnt:
+                record.msg = f"{record.msg}  [{suppressed_cnt} similar messages suppressed]"
+
+        if site[1] >= self.limit:
+            site[2] += 1
+            return False
+
+        site[1] += 1
+        return True
+
+
+def setup_logging(filename: str, level: int = logging.INFO):
+    """Log from all processes through a queue to a single file writer
+
+    Call once in the main process before starting workers
+    """
+
+    global listener
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(queue, file_handler)
+    listener.start()
+    atexit.register(stop_logging)
+
+    queue_handler = logging.handlers.QueueHandler(queue)
+    queue_handler.addFilter(RateLimitFilter(settings.LOG_RATE_LIMIT, settings.LOG_RATE_INTERVAL))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+
+def stop_logging():
+    """Flush queued records to the log file"""
+
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def issue(name: str, pmid: str = None):
+    """Count a data-quality problem in the current record"""
+
+    issue_counts[name] += 1
+    if pmid is not None:
+        samples = issue_samples.setdefault(name, [])
+        if len(samples) < ISSUE_SAMPLE_SIZE:
+            samples.append(pmid)
+
+
+def take_issues() -> dict:
+    """Data-quality counts since the last take_issues() - {name: {"cnt": int, "pmids": [...]}}"""
+
+    issues = {
+        name: {"cnt": cnt, "pmids": issue_samples.get(name, [])}
+        for name, cnt in issue_counts.items()
+    }
+
+    issue_counts.clear()
+    issue_samples.clear()
+
+    return issues
+
+
+def merge_issues(total: dict, issues: dict) -> dict:
+
+    for name, entry in issues.items():
+        total_entry = total.setdefault(name, {"cnt": 0, "pmids": []})
+        total_entry["cnt"] += entry["cnt"]
+        total_entry["pmids"] = (total_entry["pmids"] + entry["pmids"])[:ISSUE_SAMPLE_SIZE]
+
+    return total
+
+
+def log_issues(filename: str, issues: dict):
+    """One log line with the data-quality counts of a file"""
+
+    if not issues:
+        return
+
+    summary = "  ".join(
+        f"{name}: {entry['cnt']} (e.g. PMIDs {', '.join(map(str, entry['pmids']))})"
+        for name, entry in sorted(issues.items())
+    )
+    log.warning(f"Data issues in {filename} - {summary}")
@@ -0,0 +1,176 @@
+import functools
+import glob
+import logging
+import os
+import sqlite3
+import threading
+
+import pm.fileindex
+import pm.settings as settings
+import pm.xml
+from lxml import etree as ET
+
+log = logging.getLogger()
+
+# Point lookups of single PMIDs from the local pubmed mirror in PUBMED_DATA_DIR - no database
+#
+#   LOOKUP_INDEX_FN is a SQLite index of PMID -> (file, start, length) of the latest version of
+#   each article. It is built from the per-file indexes (pm.fileindex) by applying the files in
+#   processing order - baseline, then updatefiles - so later versions replace earlier ones and
+#   DeleteCitation PMIDs are removed after the file's articles, as when loading the file.
+#   update_index() applies the files added to the mirror since it was last run.
+#
+#   get_record() reads the article's bytes at its offset and converts them. The last
+#   LOOKUP_CACHE_SIZE records looked up are kept in an LRU cache.
+
+FILE_PATTERNS = ("baseline/*.xml.gz", "updatefiles/*.xml.gz")  # in processing order
+
+# Lookup index connection - opened on first use in each process (not at import or before a fork)
+index_conn = None
+index_pid = None
+index_lock = threading.RLock()
+
+
+def get_index_conn() -> sqlite3.Connection:
+
+    global index_conn, index_pid
+
+    if index_conn is None or index_pid != os.getpid():
+        index_conn = sqlite3.connect(settings.LOOKUP_INDEX_FN, timeout=60, check_same_thread=False)
+        index_conn.execute("PRAGMA journal_mode=WAL")
+        index_conn.execute("PRAGMA synchronous=NORMAL")
+        index_conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, fn TEXT UNIQUE, size INTEGER, mtime REAL)"
+        )
+        index_conn.execute(
+            "CREATE TABLE IF NOT EXISTS pmids (pmid INTEGER PRIMARY KEY, file_id INTEGER, start INTEGER, length INTEGER)"
+        )
+        index_conn.commit()
+        index_pid = os.getpid()
+
+    return index_conn
+
+
+def mirror_files() -> list:
+    """Pubmed files under PUBMED_DATA_DIR in processing order, relative to PUBMED_DATA_DIR"""
+
+    files = []
+    for pattern in FILE_PATTERNS:
+        path_fns = glob.glob(f"{settings.PUBMED_DATA_DIR}/{pattern}")
+        files.extend(
+            sorted(os.path.relpath(path_fn, settings.PUBMED_DATA_DIR) for path_fn in path_fns)
+        )
+
+    return files
+
+
+def file_stat(fn: str) -> tuple:
+
+    stat = os.stat(f"{settings.PUBMED_DATA_DIR}/{fn}")
+    return stat.st_size, stat.st_mtime
+
+
+def apply_file(fn: str):
+    """Point the PMIDs of fn's articles at it and remove its deleted PMIDs"""
+
+    summary = pm.fileindex.load_summary(fn)
+    offsets = pm.fileindex.load_offsets(fn)
+    records = list(zip(offsets[0::3], offsets[1::3], offsets[2::3]))
+
+    with index_lock, get_index_conn() as conn:
+        file_id = conn.execute(
+            "INSERT INTO files (fn, size, mtime) VALUES (?, ?, ?)",
+            (fn, summary["size"], summary["mtime"]),
+        ).lastrowid
+        conn.executemany(
+            "INSERT OR REPLACE INTO pmids (pmid, file_id, start, length) VALUES (?, ?, ?, ?)",
+            [(pmid, file_id, start, length) for pmid, start, length in records if length],
+        )
+        conn.executemany(
+            "DELETE FROM pmids WHERE pmid=?",
+            [(pmid,) for pmid, start, length in records if not length],
+        )
+
+
+def update_index(processes: int = None) -> int:
+    """Apply files added to the mirror to the lookup index - returns the number of files applied
+
+    The index is rebuilt if a file already applied changed or is gone, or a new file comes
+    before them. Files without a current per-file index are indexed first, in parallel.
+    """
+
+    files = mirror_files()
+
+    with index_lock:
+        applied = get_index_conn().execute(
+            "SELECT fn, size, mtime FROM files ORDER BY file_id"
+        ).fetchall()
+
+    if applied != [(fn, *file_stat(fn)) for fn in files[: len(applied)]]:
+        log.info(f"Rebuilding lookup index {settings.LOOKUP_INDEX_FN}")
+        with index_lock, get_index_conn() as conn:
+            conn.execute("DELETE FROM pmids")
+            conn.execute("DELETE FROM files")
+        applied = []
+
+    new_files = files[len(applied) :]
+    if not new_files:
+        return 0
+
+    unindexed = [fn for fn in new_files if pm.fileindex.load_summary(fn) is None]
+    if unindexed:
+        path_fns = [f"{settings.PUBMED_DATA_DIR}/{fn}" for fn in unindexed]
+        pm.fileindex.index_files(path_fns, processes=processes)
+
+    for fn in new_files:
+        apply_file(fn)
+        log.info(f"Applied {fn} to the lookup index")
+
+    cached_record.cache_clear()
+
+    return len(new_files)
+
+
+def get_location(pmid: str) -> tuple:
+    """(fn, start, length) of the latest version of pmid's article - None if not in the mirror"""
+
+    with index_lock:
+        return get_index_conn().execute(
+            "SELECT fn, start, length FROM pmids JOIN files USING (file_id) WHERE pmid=?",
+            (int(pmid),),
+        ).fetchone()
+
+
+def get_xml(pmid: str) -> bytes:
+    """Original XML of pmid's article from the mirror - None if not in the mirror"""
+
+    location = get_location(pmid)
+    if location is None:
+        return None
+
+    return pm.fileindex.read_article(*location)
+
+
+@functools.lru_cache(maxsize=settings.LOOKUP_CACHE_SIZE)
+def cached_record(pmid: int) -> dict:
+
+    location = get_location(pmid)
+    if location is None:
+        return None
+
+    fn, start, length = location
+    raw_xml = pm.fileindex.read_article(fn, start, length)
+    pmid, record_dict, xml_record_str = pm.xml.convert_xml_record(
+        ET.fromstring(raw_xml), filename=fn, raw_xml=raw_xml
+    )
+
+    return record_dict
+
+
+def get_record(pmid: str) -> dict:
+    """Converted record of pmid from the mirror - None if not in the mirror
+
+    Records are cached and shared between calls - copy one before changing it
+    """
+
+    return cached_record(int(pmid))
@@ -0,0 +1,100 @@
+import glob
+import logging
+import os
+
+import pm.hashes
+import pm.settings as settings
+import pm.storage as db
+import xxhash
+
+log = logging.getLogger()
+
+# Manifest of processed pubmed files
+#
+#   Each processed file is recorded (see pm.storage.mark_file_done) under the xxhash of its
+#   filename relative to PUBMED_DATA_DIR, e.g. baseline/pubmed20n0001.xml.gz, with its size,
+#   mtime and a checksum of its contents. A file is skipped on later runs if its size and
+#   mtime are unchanged, or if its checksum is unchanged when only the mtime differs
+#   (e.g. downloaded again). Files whose contents changed are processed again.
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def file_key(fn: str) -> str:
+    """Manifest key of a relative pubmed filename"""
+
+    return xxhash.xxh64(fn.encode("utf-8")).hexdigest()
+
+
+def relative_fn(path_fn: str) -> str:
+    """Filename relative to PUBMED_DATA_DIR, e.g. updatefiles/pubmed20n1016.xml.gz"""
+
+    return os.path.relpath(path_fn, settings.PUBMED_DATA_DIR)
+
+
+def file_checksum(path_fn: str) -> str:
+    """xxhash of the file contents"""
+
+    h = xxhash.xxh64()
+    with open(path_fn, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def file_entry(fn: str) -> dict:
+    """Size, mtime and checksum of a relative pubmed filename - stored when it is processed"""
+
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+    stat = os.stat(path_fn)
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "checksum": file_checksum(path_fn)}
+
+
+def load() -> dict:
+    """Manifest of processed files - file_key -> {"size", "mtime", "checksum"}"""
+
+    return db.get_manifest()
+
+
+def is_processed(manifest: dict, fn: str) -> bool:
+    """The file was processed and its contents have not changed since"""
+
+    entry = manifest.get(file_key(fn))
+    if entry is None:
+        return False
+
+    if entry["size"] is None:
+        return True  # processed before sizes were recorded
+
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+    stat = os.stat(path_fn)
+    if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+        return True
+
+    if stat.st_size == entry["size"] and file_checksum(path_fn) == entry["checksum"]:
+        return True
+
+    log.info(f"Contents of {fn} changed since it was processed - processing it again")
+    return False
+
+
+def unprocessed_files(pattern: str) -> list:
+    """Relative filenames matching the glob pattern under PUBMED_DATA_DIR not processed yet"""
+
+    manifest = load()
+
+    # Nothing processed in this store (new or reset database) - no stored record to skip
+    if not manifest and settings.SKIP_UNCHANGED:
+        pm.hashes.clear()
+
+    files = []
+    for path_fn in glob.glob(f"{settings.PUBMED_DATA_DIR}/{pattern}"):
+        fn = relative_fn(path_fn)
+        if is_processed(manifest, fn):
+            log.info(f"Already processed {fn}")
+            continue
+        files.append(fn)
+
+    return files
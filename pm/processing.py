@@ -1,85 +1,158 @@
 import datetime
-import glob
+import gzip
+import json
 import logging
 import multiprocessing
+import os
+import re
+import shutil
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from multiprocessing import Process, Queue
 
-import pm.arangodb as db
+import pm.fileindex
+import pm.hashes
+import pm.logs
+import pm.manifest
+import pm.reader
 import pm.settings as settings
+import pm.split
+import pm.stats
+import pm.storage as db
 import pm.xml
-from pm.arangodb import files_coll, json_coll, pubmed_db, xml_coll
+from lxml import etree as ET
 
 log = logging.getLogger()
 
-# Create queues
-baseline_queue = Queue()
-done_queue = Queue()
 
+def eta_msg(estimated_article_cnt: int, total_article_cnt: int, total_articles_sec: float) -> str:
+    """Estimated time to finish from the indexed article counts - empty if there is no estimate"""
 
-def finished_tasks(done_queue: Queue):
-    """Write finished tasks to file"""
+    if not estimated_article_cnt or not total_articles_sec:
+        return ""
+
+    remaining_cnt = max(estimated_article_cnt - total_article_cnt, 0)
+    eta = datetime.timedelta(seconds=int(remaining_cnt / total_articles_sec))
+    return f" ETA: {eta} ({remaining_cnt} articles left)"
+
+
+def finished_tasks(done_queue: Queue, file_cnt: int, estimated_article_cnt: int = None):
+    """Write finished tasks to file and log aggregate throughput as each file finishes
+
+    Runs until it gets the None sentinel from load_baseline
+    """
 
     total_article_cnt = 0
+    finished_file_cnt = 0
     total_start_time = datetime.datetime.now()
+    total_stats = pm.stats.new_total()
     with open("processed_files.txt", "a") as f:
-        while True:
-            time.sleep(300)
-            while not done_queue.empty():
-                d = done_queue.get()
-                article_cnt = d["article_cnt"]
-                fn = d["fn"]
-                duration = d["duration_sec"]
+        for d in iter(done_queue.get, None):
+            article_cnt = d["article_cnt"]
+            fn = d["fn"]
+            duration = d["duration_sec"]
 
-                f.write(f"{fn}\n")
-                f.flush()
-                # Log throughput
-                total_duration = (datetime.datetime.now() - total_start_time).total_seconds()
+            pm.stats.merge(total_stats, d["stats"])
+            pm.stats.write(total_stats)
 
-                total_articles_sec = total_article_cnt / total_duration
-                msg = f"Baseline: {article_cnt} Articles/sec: {article_cnt/duration}  Duration(sec): {duration} Estimated Total Articles/Sec: {total_articles_sec} FN: {fn}"
-                f.write(f"{msg}\n")
-                log.info(msg)
+            total_article_cnt += article_cnt
+            finished_file_cnt += 1
 
+            f.write(f"{fn}\n")
 
-def load_baseline_queue(baseline_queue):
+            # Log throughput
+            total_duration = (datetime.datetime.now() - total_start_time).total_seconds()
 
-    processed_files = db.get_processed_files()
+            total_articles_sec = total_article_cnt / total_duration if total_duration else 0
+            articles_sec = article_cnt / duration if duration else 0
+            msg = f"Baseline: {article_cnt} Articles/sec: {articles_sec}  Duration(sec): {duration} Total Articles/Sec: {total_articles_sec} Files: {finished_file_cnt}/{file_cnt} FN: {fn}"
+            msg += eta_msg(estimated_article_cnt, total_article_cnt, total_articles_sec)
+            f.write(f"{msg}\n")
+            f.flush()
+            log.info(msg)
 
-    files = sorted(glob.glob(f"{settings.PUBMED_DATA_DIR}/baseline/*.gz"))
-    for fn in files:
-        fn = fn.replace(f"{settings.PUBMED_DATA_DIR}/", "")
-        if fn in processed_files:
-            log.info(f"Already processed {fn}")
-            continue
 
+def load_baseline_queue(baseline_queue: Queue) -> tuple:
+    """Queue unprocessed baseline files - largest first to cut down the tail of the run
+
+    Files are sized by their article counts from pm.fileindex (estimated for files not
+    indexed yet), or by their compressed size if none are indexed.
+
+    Returns (number of files queued, estimated number of articles - None without an index)
+    """
+
+    files = pm.manifest.unprocessed_files("baseline/*.gz")
+
+    estimates = pm.fileindex.estimate_articles(files) if settings.FILE_INDEX else None
+    if estimates:
+        files.sort(key=lambda fn: estimates[fn], reverse=True)
+        estimated_article_cnt = sum(estimates.values())
+        log.info(f"Queued {len(files)} baseline files  Estimated articles: {estimated_article_cnt}")
+    else:
+        files.sort(key=lambda fn: os.path.getsize(f"{settings.PUBMED_DATA_DIR}/{fn}"), reverse=True)
+        estimated_article_cnt = None
+
+    for fn in files:
         baseline_queue.put(fn)
 
+    return len(files), estimated_article_cnt
+
 
-def pubmed_file_worker(task_queue, done_queue):
-    """Process pubmed files"""
+def pubmed_file_worker(task_queue: Queue, done_queue: Queue):
+    """Process pubmed files until the None sentinel is received"""
 
-    while not task_queue.empty():
-        fn = task_queue.get()
+    for fn in iter(task_queue.get, None):
         log.info(f"Starting to process {fn}")
-        article_cnt, duration_sec = pm.xml.parse_pubmed_file(fn)
-        if article_cnt:
-            done_queue.put({"article_cnt": article_cnt, "fn": fn, "duration_sec": duration_sec})
+        try:
+            article_cnt, duration_sec = pm.xml.parse_pubmed_file(fn)
+        except Exception as e:
+            log.exception(f"Problem processing {fn} - error: {str(e)}")
+            if settings.INSTRUMENT:
+                pm.stats.count("errors")
+            continue
+
+        # Also for files without articles (delete-only, resumed or skipped) - counts the file
+        #   and takes its stats
+        done_queue.put(
+            {
+                "article_cnt": article_cnt,
+                "fn": fn,
+                "duration_sec": duration_sec,
+                "stats": pm.stats.take(),
+            }
+        )
 
 
 def load_baseline():
 
+    if settings.PIPELINED:
+        return load_baseline_pipelined()
+
+    baseline_queue = Queue()
+    done_queue = Queue()
+
     # Load task_queue
-    load_baseline_queue(baseline_queue)
+    file_cnt, estimated_article_cnt = load_baseline_queue(baseline_queue)
+
+    number_of_processes = min(int(settings.NUMBER_OF_PROCESSORS), file_cnt)
+
+    # One sentinel per worker so each exits once the files run out
+    for i in range(number_of_processes):
+        baseline_queue.put(None)
 
     procs = []
 
+    db.start()
+
     # Store finished files in a state file
-    finished_proc = Process(target=finished_tasks, args=(done_queue,))
+    finished_proc = Process(
+        target=finished_tasks, args=(done_queue, file_cnt, estimated_article_cnt)
+    )
     finished_proc.start()
 
     # Start pubmed baseline processing
-    for i in range(int(settings.NUMBER_OF_PROCESSORS)):
+    for i in range(number_of_processes):
         log.info(f"Starting pubmed processor {i}")
         proc = Process(target=pubmed_file_worker, args=(baseline_queue, done_queue))
         procs.append(proc)
@@ -92,29 +165,508 @@ def load_baseline():
     log.info("Finished processing baseline files")
 
     # Wait until the done_queue is completed
+    done_queue.put(None)
     finished_proc.join()
 
+    db.stop()
+
+
+def pipeline_parser(file_queue: Queue, article_queue: Queue, doc_queue: Queue):
+    """Pipeline stage 1: split files into batches of raw article bytes for the converters
+
+    Articles are split out of the decompressed bytes without being parsed (see
+    pm.reader.iter_record_bytes) - the converters parse them and store the original bytes
+    with STORE_XML and XML_CAPTURE=raw.
+
+    Sends {"fn", "article_cnt", "deleted_pmids", "start_time"} to the writer when a file is parsed
+    """
+
+    for fn in iter(file_queue.get, None):
+        log.info(f"Starting to parse {fn}")
+        start_time = datetime.datetime.now()
+        path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+
+        article_cnt = 0
+        deleted_pmids = []
+        batch = []
+        error = False
+        try:
+            with pm.reader.open_pubmed_file(path_fn) as f:
+                if settings.INSTRUMENT:
+                    f = pm.stats.TimedReader(f)
+
+                records = pm.reader.iter_record_bytes(f, settings.READ_AHEAD_BYTES)
+                if settings.FILE_INDEX:
+                    records = pm.fileindex.iter_indexed(fn, records)
+
+                for tag, offset, raw_xml in records:
+                    if tag in pm.xml.ARTICLE_TAGS:
+                        article_cnt += 1
+                        batch.append(raw_xml)
+                        if len(batch) >= settings.PIPELINE_BATCH_SIZE:
+                            article_queue.put((fn, batch))
+                            batch = []
+                    elif tag == "DeleteCitation":
+                        deleted_pmids.extend(pm.xml.process_deletions(ET.fromstring(raw_xml)))
+                    else:
+                        log.warning(f"{fn} has the {tag} tag and is not being processed")
+        except Exception as e:
+            log.exception(f"Problem parsing {fn} - error: {str(e)}")
+            error = True
+
+        if batch:
+            article_queue.put((fn, batch))
+
+        doc_queue.put(
+            {
+                "fn": fn,
+                "article_cnt": article_cnt,
+                "deleted_pmids": deleted_pmids,
+                "start_time": start_time,
+                "error": error,
+                "stats": pm.stats.take(),
+            }
+        )
+
+
+def pipeline_converter(article_queue: Queue, doc_queue: Queue):
+    """Pipeline stage 2: convert batches of article bytes into docs for the writer"""
+
+    for fn, batch in iter(article_queue.get, None):
+        docs = []
+        for article_bytes in batch:
+            if settings.INSTRUMENT:
+                article_start = time.perf_counter()
+                pm.stats.count("articles")
+
+            try:
+                record = ET.fromstring(article_bytes)
+                if settings.INSTRUMENT:
+                    pm.stats.add_time("xml_parse", article_start)
+                pmid, record_dict, xml_record_str = pm.xml.convert_xml_record(
+                    record, filename=fn, raw_xml=article_bytes
+                )
+            except Exception as e:
+                log.exception(f"Problem converting article from {fn} - error: {str(e)}")
+                if settings.INSTRUMENT:
+                    pm.stats.count("errors")
+                continue
+
+            if settings.INSTRUMENT:
+                start = time.perf_counter()
+
+            record_hash = pm.hashes.content_hash(record_dict, xml_record_str)
+
+            if settings.INSTRUMENT:
+                pm.stats.add_time("serialize", start)
+                pm.stats.add_latency(article_start)
+
+            if pm.hashes.is_unchanged(pmid, record_hash):
+                continue
+
+            docs.append((pmid, record_dict, xml_record_str, record_hash))
+
+        doc_queue.put((fn, len(batch), docs, pm.stats.take(), pm.logs.take_issues()))
+
+    doc_queue.put(None)
+
+
+def pipeline_writer(
+    doc_queue: Queue, converter_cnt: int, file_cnt: int, estimated_article_cnt: int = None
+):
+    """Pipeline stage 3: bulk insert docs using a pool of writer threads
+
+    A file is marked as processed once all of its articles are converted and written.
+    Runs until every converter has sent its None sentinel.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=settings.WRITER_THREADS)
+    futures = {}  # future -> files with docs in its write
+    json_docs, xml_docs, doc_fns = [], [], set()
+
+    def wait_for_writes():
+        nonlocal futures
+        for future in wait(futures).done:
+            if future.exception() is not None:
+                log.error("Problem writing docs", exc_info=future.exception())
+                for fn in futures[future]:
+                    files[fn]["write_error"] = True
+        futures = {}
+
+    def submit_docs():
+        nonlocal json_docs, xml_docs, doc_fns
+        if json_docs or xml_docs:
+            futures[executor.submit(db.put_many, json_docs, xml_docs)] = doc_fns
+            json_docs, xml_docs, doc_fns = [], [], set()
+
+    def new_file_state():
+        return {"converted_cnt": 0, "written_cnt": 0, "issues": {}, "write_error": False}
+
+    files = {}  # fn -> {"converted_cnt": int, "written_cnt": int, "article_cnt": int, ...}
+    total_article_cnt = 0
+    finished_file_cnt = 0
+    finished_converter_cnt = 0
+    total_start_time = datetime.datetime.now()
+    total_stats = pm.stats.new_total()
+
+    with open("processed_files.txt", "a") as f:
+        while finished_converter_cnt < converter_cnt:
+            msg = doc_queue.get()
+            if msg is None:
+                finished_converter_cnt += 1
+                continue
+
+            if isinstance(msg, dict):  # Parser finished with file
+                fn = msg["fn"]
+                pm.stats.merge(total_stats, msg.pop("stats"))
+                files.setdefault(fn, new_file_state()).update(msg)
+            else:
+                fn, converted_cnt, docs, stats, issues = msg
+                pm.stats.merge(total_stats, stats)
+                state = files.setdefault(fn, new_file_state())
+                pm.logs.merge_issues(state["issues"], issues)
+                state["converted_cnt"] += converted_cnt
+                state["written_cnt"] += len(docs)
+                if docs:
+                    doc_fns.add(fn)
+                for pmid, record_dict, xml_record_str, record_hash in docs:
+                    json_docs.append(db.json_doc(pmid, record_dict, record_hash))
+                    if xml_record_str is not None:
+                        xml_docs.append(db.xml_doc(pmid, fn, xml_record_str))
+
+                if len(json_docs) + len(xml_docs) >= settings.BULK_DOC_COUNT:
+                    submit_docs()
+
+            finished_files = [
+                fn
+                for fn, state in files.items()
+                if "article_cnt" in state and state["converted_cnt"] >= state["article_cnt"]
+            ]
+            if not finished_files:
+                continue
+
+            # Everything for these files is converted - write it out before marking them done
+            submit_docs()
+            wait_for_writes()
+
+            pm.stats.merge(total_stats, pm.stats.take())
+            pm.stats.write(total_stats)
+
+            for fn in finished_files:
+                state = files.pop(fn)
+                if state["error"]:
+                    log.error(f"Not marking {fn} as processed due to parsing error")
+                    continue
+                if state["write_error"]:
+                    log.error(f"Not marking {fn} as processed due to write error")
+                    continue
+
+                deleted_cnt = db.delete_many(state["deleted_pmids"])
+
+                article_cnt = state["article_cnt"]
+                skipped_cnt = article_cnt - state["written_cnt"]
+                duration = (datetime.datetime.now() - state["start_time"]).total_seconds()
+                pm.logs.log_issues(fn, state["issues"])
+                db.mark_file_done(
+                    fn,
+                    article_cnt,
+                    duration,
+                    deleted_cnt=deleted_cnt,
+                    skipped_cnt=skipped_cnt,
+                    issues=state["issues"],
+                )
+
+                total_article_cnt += article_cnt
+                finished_file_cnt += 1
+                total_duration = (datetime.datetime.now() - total_start_time).total_seconds()
+                total_articles_sec = total_article_cnt / total_duration
+
+                f.write(f"{fn}\n")
+                msg = f"Pipeline: {article_cnt} Written: {state['written_cnt']} Skipped: {skipped_cnt} Articles/sec: {article_cnt/duration}  Duration(sec): {duration} Total Articles/Sec: {total_articles_sec} Files: {finished_file_cnt}/{file_cnt} FN: {fn}"
+                msg += eta_msg(estimated_article_cnt, total_article_cnt, total_articles_sec)
+                f.write(f"{msg}\n")
+                f.flush()
+                log.info(msg)
+
+    submit_docs()
+    wait_for_writes()
+    executor.shutdown()
+
+    pm.stats.merge(total_stats, pm.stats.take())
+    pm.stats.write(total_stats)
+
+
+def load_baseline_pipelined():
+    """Process baseline with separate parser, converter and writer stages
+
+    Stages are connected by bounded queues so a slow stage applies backpressure
+    to the ones feeding it.
+    """
+
+    file_queue = Queue()
+    article_queue = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    doc_queue = Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+
+    file_cnt, estimated_article_cnt = load_baseline_queue(file_queue)
+
+    parser_cnt = min(settings.PIPELINE_PARSERS, file_cnt)
+    converter_cnt = int(settings.NUMBER_OF_PROCESSORS)
+
+    for i in range(parser_cnt):
+        file_queue.put(None)
+
+    db.start()
+
+    writer_proc = Process(
+        target=pipeline_writer, args=(doc_queue, converter_cnt, file_cnt, estimated_article_cnt)
+    )
+    writer_proc.start()
+
+    converter_procs = []
+    for i in range(converter_cnt):
+        proc = Process(target=pipeline_converter, args=(article_queue, doc_queue))
+        converter_procs.append(proc)
+        proc.start()
+
+    parser_procs = []
+    for i in range(parser_cnt):
+        log.info(f"Starting pubmed parser {i}")
+        proc = Process(target=pipeline_parser, args=(file_queue, article_queue, doc_queue))
+        parser_procs.append(proc)
+        proc.start()
+
+    for proc in parser_procs:
+        proc.join()
+
+    log.info("Finished parsing baseline files")
+
+    # All articles are queued - stop the converters once they drain the queue
+    for i in range(converter_cnt):
+        article_queue.put(None)
+
+    for proc in converter_procs:
+        proc.join()
+
+    writer_proc.join()
+
+    db.stop()
+
+    log.info("Finished processing baseline files")
+
 
 def load_updatefiles():
 
-    processed_files = db.get_processed_files()
+    if settings.PARALLEL_UPDATES:
+        return load_updatefiles_parallel()
 
-    files = sorted(glob.glob(f"{settings.PUBMED_DATA_DIR}/updatefiles/*.gz"))
+    files = sorted(pm.manifest.unprocessed_files("updatefiles/*.gz"))
 
     log.info("Starting to process updatefiles")
 
+    db.start()
+
+    total_stats = pm.stats.new_total()
     with open("processed_files.txt", "a") as f:
         for fn in files:
-            if fn in processed_files:
-                log.info("Skipping already processed file: {fn}")
-                continue
-            fn = fn.replace(f"{settings.PUBMED_DATA_DIR}/", "")
-            article_cnt, duration_sec = pm.xml.parse_pubmed_file(fn)
+            if settings.SPLIT_PROCESSES:
+                article_cnt, duration_sec = pm.split.parse_pubmed_file(fn)
+            else:
+                article_cnt, duration_sec = pm.xml.parse_pubmed_file(fn)
 
-            msg = f"UpdateFiles: {article_cnt} Articles/sec: {article_cnt/duration_sec}  Duration(sec): {duration_sec}  FN: {fn}"
+            articles_sec = article_cnt / duration_sec if duration_sec else 0
+            msg = f"UpdateFiles: {article_cnt} Articles/sec: {articles_sec}  Duration(sec): {duration_sec}  FN: {fn}"
             f.write(f"{msg}\n")
             log.info(msg)
 
+            pm.stats.merge(total_stats, pm.stats.take())
+            pm.stats.write(total_stats)
+
+    db.stop()
+
+
+def updatefile_sequence(fn: str) -> tuple:
+    """Ordering key for pubmed files, e.g. (20, 1016) for updatefiles/pubmed20n1016.xml.gz"""
+
+    match = re.search(r"pubmed(\d+)n(\d+)\.xml", fn)
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def spool_updatefile(fn: str, spool_dir: str) -> dict:
+    """Convert updatefile to a gzipped JSON lines spool file
+
+    Returns the PMIDs added and deleted by the file so the latest version of each PMID
+    can be resolved across files before anything is written.
+    """
+
+    start_time = datetime.datetime.now()
+
+    spool_fn = os.path.join(spool_dir, os.path.basename(fn).replace(".xml.gz", ".jsonl.gz"))
+
+    pm.logs.take_issues()  # drop anything left over from a file that failed part way
+
+    pmids = []
+    deleted_pmids = []
+    with gzip.open(spool_fn, "wt", compresslevel=1) as f:
+        for pmid, record_dict, xml_record_str in pm.xml.iter_converted_records(fn, deleted_pmids):
+            f.write(json.dumps([pmid, record_dict, xml_record_str]) + "\n")
+            pmids.append(int(pmid))
+
+    duration_sec = (datetime.datetime.now() - start_time).total_seconds()
+    log.info(f"Spooled {fn} Article_cnt: {len(pmids)}  Duration(sec): {duration_sec}")
+    issues = pm.logs.take_issues()
+    pm.logs.log_issues(fn, issues)
+
+    return {
+        "fn": fn,
+        "spool_fn": spool_fn,
+        "pmids": pmids,
+        "deleted_pmids": [int(pmid) for pmid in deleted_pmids],
+        "duration_sec": duration_sec,
+        "stats": pm.stats.take(),
+        "issues": issues,
+    }
+
+
+def write_spooled_updatefile(spooled: dict, write_pmids: set, delete_pmids: list) -> dict:
+    """Write the records from a spool file that are the latest version of their PMID
+
+    The file is not marked as processed here - the result has the mark_file_done arguments
+    """
+
+    start_time = datetime.datetime.now()
+    fn = spooled["fn"]
+
+    written_cnt = 0
+    skipped_cnt = 0
+    with gzip.open(spooled["spool_fn"], "rt") as f:
+        for line in f:
+            pmid, record_dict, xml_record_str = json.loads(line)
+            if int(pmid) not in write_pmids:
+                continue
+
+            record_hash, doc_size = pm.hashes.hash_record(record_dict, xml_record_str)
+            if pm.hashes.is_unchanged(pmid, record_hash):
+                skipped_cnt += 1
+                continue
+
+            if xml_record_str is not None:
+                db.add_xml(pmid, fn, xml_record_str)
+            db.add_json(pmid, record_dict, record_hash, doc_size)
+            written_cnt += 1
+
+    db.flush()
+    deleted_cnt = db.delete_many([str(pmid) for pmid in delete_pmids])
+
+    xml_archive = db.flush_xml_archive(fn) if settings.XML_ARCHIVE else None
+
+    duration_sec = (
+        spooled["duration_sec"] + (datetime.datetime.now() - start_time).total_seconds()
+    )
+
+    os.remove(spooled["spool_fn"])
+
+    return {
+        "fn": fn,
+        "article_cnt": len(spooled["pmids"]),
+        "written_cnt": written_cnt,
+        "skipped_cnt": skipped_cnt,
+        "deleted_cnt": deleted_cnt,
+        "duration_sec": duration_sec,
+        "issues": spooled["issues"],
+        "xml_archive": xml_archive,
+        "stats": pm.stats.take(),
+    }
+
+
+def load_updatefiles_parallel():
+    """Process updatefiles in parallel with the same end state as processing them in order
+
+    1. Parse and convert all new updatefiles in parallel into spool files
+    2. Resolve each PMID to the latest file (by file sequence) that adds or deletes it -
+       deletions in a file are applied after its articles, so they win within a file
+    3. Write from the spool files in parallel - each PMID is written or deleted by one file only
+    4. Mark the files as processed in file sequence order once every file has been written -
+       if any write fails none are marked, so the whole batch is resolved again next run
+    """
+
+    files = pm.manifest.unprocessed_files("updatefiles/*.gz")
+    files.sort(key=updatefile_sequence)
+
+    if not files:
+        log.info("No new updatefiles to process")
+        return
+
+    log.info(f"Starting to process {len(files)} updatefiles in parallel")
+
+    spool_dir = tempfile.mkdtemp(prefix="pubmed_spool_", dir=settings.SPOOL_DIR)
+    total_stats = pm.stats.new_total()
+    number_of_processes = min(int(settings.NUMBER_OF_PROCESSORS), len(files))
+
+    db.start()
+
+    try:
+        with multiprocessing.Pool(number_of_processes) as pool:
+            spooled_files = pool.starmap(spool_updatefile, [(fn, spool_dir) for fn in files])
+
+            # Latest file to touch each PMID - spooled_files is in file sequence order
+            latest = {}
+            for idx, spooled in enumerate(spooled_files):
+                pm.stats.merge(total_stats, spooled.pop("stats"))
+                for pmid in spooled["pmids"]:
+                    latest[pmid] = (idx, "add")
+                for pmid in spooled["deleted_pmids"]:
+                    latest[pmid] = (idx, "delete")
+
+            write_tasks = [(spooled, set(), []) for spooled in spooled_files]
+            for pmid, (idx, action) in latest.items():
+                if action == "add":
+                    write_tasks[idx][1].add(pmid)
+                else:
+                    write_tasks[idx][2].append(pmid)
+            del latest
+
+            results = {}
+            try:
+                for result in pool.imap_unordered(_write_spooled_updatefile, write_tasks):
+                    results[result["fn"]] = result
+                    pm.stats.merge(total_stats, result.pop("stats"))
+                    pm.stats.write(total_stats)
+            except Exception:
+                log.error(
+                    f"Problem writing updatefiles - none of the {len(files)} are marked processed"
+                )
+                raise
+
+            # Let the workers exit normally rather than be terminated by the with block -
+            #   anything they queued for a storage writer process is flushed on exit
+            pool.close()
+            pool.join()
+
+        with open("processed_files.txt", "a") as f:
+            for fn in files:
+                result = results[fn]
+                db.mark_file_done(
+                    fn,
+                    result["article_cnt"],
+                    result["duration_sec"],
+                    deleted_cnt=result["deleted_cnt"],
+                    skipped_cnt=result["skipped_cnt"],
+                    issues=result["issues"],
+                    xml_archive=result["xml_archive"],
+                )
+
+                msg = f"UpdateFiles: {result['article_cnt']} Written: {result['written_cnt']} Skipped: {result['skipped_cnt']} Deleted: {result['deleted_cnt']} Duration(sec): {result['duration_sec']}  FN: {fn}"
+                f.write(f"{msg}\n")
+                f.flush()
+                log.info(msg)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        db.stop()
+
+
+def _write_spooled_updatefile(args: tuple) -> dict:
+    return write_spooled_updatefile(*args)
+
 
 # # Multiprocessing Example Code ################################################
 # multiprocessing.set_start_method("spawn")
@@ -0,0 +1,221 @@
+import contextlib
+import gzip
+import logging
+import mmap
+import os
+import queue
+import re
+import threading
+
+import pm.settings as settings
+
+log = logging.getLogger()
+
+# Input layer for pubmed files - used by pm.xml.iter_pubmed_records
+#
+#   An uncompressed .xml next to the .xml.gz (e.g. from gunzip -k) is memory mapped and
+#   parsed instead. Otherwise the .gz is decompressed with python-isal (FAST_GZIP, if it is
+#   installed) or gzip in a background thread that reads READ_AHEAD_BYTES chunks ahead of
+#   the parser - zlib and isal release the GIL while decompressing, so decompression and
+#   parsing overlap.
+#
+#   Records can also be split out of the decompressed bytes without building a tree -
+#   a literal "<PubmedArticle" can only be a tag since "<" is escaped in XML text.
+
+RECORD_START_RE = re.compile(
+    rb"<(PubmedArticle|PubmedBookArticle|DeleteCitation|DeleteDocument)[\s>]"
+)
+MAX_START_TAG_LEN = 32  # longer than any record start tag matched by RECORD_START_RE
+
+
+class ReadAheadReader:
+    """Read a file in chunks in a background thread
+
+    read() returns at most one chunk, like a raw file read. Exceptions raised reading
+    the file are raised by read() once the chunks before them have been returned.
+    """
+
+    def __init__(self, f, chunk_size: int, chunk_cnt: int):
+
+        self.f = f
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=chunk_cnt)
+        self.chunk = b""
+        self.offset = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+
+        try:
+            while not self.closed:
+                chunk = self.f.read(self.chunk_size)
+                self.chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self.error = e
+            self.chunks.put(b"")
+
+    def read(self, size: int = -1) -> bytes:
+
+        if size < 0:
+            return b"".join(iter(lambda: self.read(self.chunk_size), b""))
+
+        if self.offset >= len(self.chunk):
+            if self.eof:
+                return b""
+
+            self.chunk = self.chunks.get()
+            self.offset = 0
+            if not self.chunk:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+                return b""
+
+        if self.offset == 0 and size >= len(self.chunk):
+            self.offset = len(self.chunk)
+            return self.chunk
+
+        data = self.chunk[self.offset : self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+    def close(self):
+
+        self.closed = True
+        while self.thread.is_alive():  # unblock the reader thread if the queue is full
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def plain_xml_fn(path_fn: str) -> str:
+    """Uncompressed XML to read for path_fn - None if there is only the .gz"""
+
+    if not path_fn.endswith(".gz"):
+        return path_fn
+
+    xml_fn = path_fn[: -len(".gz")]
+    if os.path.exists(xml_fn) and os.path.getsize(xml_fn):
+        return xml_fn
+
+
+def open_gzip(path_fn: str):
+
+    if settings.FAST_GZIP:
+        try:
+            from isal import igzip
+
+            return igzip.open(path_fn, "rb")
+        except ImportError:
+            pass
+
+    return gzip.open(path_fn, "rb")
+
+
+@contextlib.contextmanager
+def open_pubmed_file(path_fn: str):
+    """Binary file object with the XML of a pubmed file (.xml.gz, or .xml if present)"""
+
+    xml_fn = plain_xml_fn(path_fn)
+    if xml_fn:
+        with open(xml_fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            yield m
+        return
+
+    f = open_gzip(path_fn)
+    if settings.READ_AHEAD:
+        f = ReadAheadReader(f, settings.READ_AHEAD_BYTES, settings.READ_AHEAD_CHUNKS)
+
+    with f:
+        yield f
+
+
+@contextlib.contextmanager
+def pubmed_file_buffer(path_fn: str):
+    """Whole XML of a pubmed file - memory mapped .xml if present, else the decompressed bytes"""
+
+    xml_fn = plain_xml_fn(path_fn)
+    if xml_fn:
+        with open(xml_fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield m
+        return
+
+    with open_gzip(path_fn) as f:
+        yield f.read()
+
+
+def iter_record_spans(data):
+    """Yield (tag, start, end) of each top-level record in a pubmed file buffer
+
+    data is bytes or an mmap - anything with find() that re can search
+    """
+
+    pos = 0
+    while True:
+        match = RECORD_START_RE.search(data, pos)
+        if match is None:
+            return
+
+        tag = match.group(1)
+        end_tag = b"</" + tag + b">"
+        end = data.find(end_tag, match.end())
+        if end == -1:
+            raise ValueError(f"No {end_tag.decode()} for the record at byte {match.start()}")
+
+        pos = end + len(end_tag)
+        yield tag.decode(), match.start(), pos
+
+
+def iter_record_bytes(f, chunk_size: int):
+    """Yield (tag, offset, record bytes) of each top-level record read from a binary file object
+
+    The original bytes of the record as they are in the file, at offset in the decompressed
+    stream. Returns the number of bytes read (the uncompressed size) once exhausted.
+    """
+
+    data = b""
+    base = 0  # offset of data[0] in the stream
+    pos = 0
+    eof = False
+    while True:
+        match = RECORD_START_RE.search(data, pos)
+        if match is not None:
+            tag = match.group(1)
+            end_tag = b"</" + tag + b">"
+            end = data.find(end_tag, match.end())
+            if end != -1:
+                pos = end + len(end_tag)
+                yield tag.decode(), base + match.start(), data[match.start() : pos]
+                continue
+
+        if eof:
+            if match is not None:
+                raise ValueError(f"No {end_tag.decode()} for the last {tag.decode()} record")
+            return base + len(data)
+
+        # Keep the unfinished record - or the end of the data in case it has part of a start tag
+        keep = match.start() if match is not None else max(pos, len(data) - MAX_START_TAG_LEN)
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        base += keep
+        data = data[keep:] + chunk
+        pos = 0
@@ -25,5 +25,105 @@ NUMBER_OF_PROCESSORS = os.getenv("NUMBER_OF_PROCESSORS", default=10)
 PUBMED_DATA_DIR = os.getenv("PUBMED_DATA_DIR")
 
 ARANGO_URL = os.getenv("ARANGO_URL")
+ARANGO_POOL_SIZE = int(os.getenv("ARANGO_POOL_SIZE", default=10))  # HTTP connections per process
+ARANGO_SETUP_SCHEMA = set_bool(os.getenv("ARANGO_SETUP_SCHEMA", default=True), default=True)
 PUBMED_DB_NAME = os.getenv("PUBMED_DB_NAME", default="pubmed")
 STORE_XML = set_bool(os.getenv("STORE_XML", default=False))
+
+# STORE_XML capture: raw stores the original bytes of each article from the input file,
+#   serialize serializes the parsed article again (with an XML declaration)
+XML_CAPTURE = os.getenv("XML_CAPTURE", default="raw")
+
+# Bulk writes - flush buffered docs at this many docs or bytes
+BULK_DOC_COUNT = int(os.getenv("BULK_DOC_COUNT", default=500))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", default=8_000_000))
+
+# Input files - decompress .gz input in a background thread READ_AHEAD_BYTES chunks ahead of
+#   the parser, with python-isal if FAST_GZIP and it is installed
+READ_AHEAD = set_bool(os.getenv("READ_AHEAD", default=True), default=True)
+READ_AHEAD_BYTES = int(os.getenv("READ_AHEAD_BYTES", default=1_048_576))
+READ_AHEAD_CHUNKS = int(os.getenv("READ_AHEAD_CHUNKS", default=8))
+FAST_GZIP = set_bool(os.getenv("FAST_GZIP", default=True), default=True)
+
+# Convert each updatefile with this many processes (serial updatefile processing, 0 = off) -
+#   the decompressed file is split on article boundaries and batches of articles are converted
+#   in a forked process pool
+SPLIT_PROCESSES = int(os.getenv("SPLIT_PROCESSES", default=0))
+SPLIT_BATCH_SIZE = int(os.getenv("SPLIT_BATCH_SIZE", default=200))
+
+# Index each file as it is split into records - summary (article counts, PMID range) and the
+#   offset of each article in FILE_INDEX_DIR, used to schedule the largest files first and
+#   to read single articles (pm.fileindex)
+FILE_INDEX = set_bool(os.getenv("FILE_INDEX", default=True), default=True)
+FILE_INDEX_DIR = os.getenv("FILE_INDEX_DIR", default="pubmed_index")
+
+# Point lookups of single PMIDs from the local mirror (pm.lookup) - PMID -> file offset index
+#   and the number of converted records kept in its LRU cache
+LOOKUP_INDEX_FN = os.getenv("LOOKUP_INDEX_FN", default="pubmed_lookup.db")
+LOOKUP_CACHE_SIZE = int(os.getenv("LOOKUP_CACHE_SIZE", default=10_000))
+# Number of .gz files whose seek points (pm.fileindex) are kept - about 8MB per 100MB of XML
+LOOKUP_SEEK_FILES = int(os.getenv("LOOKUP_SEEK_FILES", default=8))
+
+# Record the position reached in each file with its bulk writes so a restarted run
+#   skips the articles already written (serial baseline and updatefile processing)
+CHECKPOINTS = set_bool(os.getenv("CHECKPOINTS", default=True), default=True)
+
+# Pipelined processing - parser processes feed a pool of NUMBER_OF_PROCESSORS converters
+#   and a writer process with WRITER_THREADS bulk insert threads over bounded queues
+PIPELINED = set_bool(os.getenv("PIPELINED", default=False))
+PIPELINE_PARSERS = int(os.getenv("PIPELINE_PARSERS", default=2))
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", default=100))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", default=64))
+WRITER_THREADS = int(os.getenv("WRITER_THREADS", default=4))
+
+# Parse and convert updatefiles in parallel, then write only the latest version of each PMID
+PARALLEL_UPDATES = set_bool(os.getenv("PARALLEL_UPDATES", default=False))
+SPOOL_DIR = os.getenv("SPOOL_DIR", default=None)  # converted updatefiles are spooled here
+
+# Skip records whose content hash matches the hash recorded when they were last written
+#   The hash index is per storage target - pubmed_hashes_<backend>_<target hash>.db unless
+#   HASH_INDEX_FN is set (it is cleared if used for another target)
+SKIP_UNCHANGED = set_bool(os.getenv("SKIP_UNCHANGED", default=True), default=True)
+HASH_INDEX_FN = os.getenv("HASH_INDEX_FN", default=None)
+
+# Offline JSON Lines export compression levels
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", default=6))
+EXPORT_ZSTD_LEVEL = int(os.getenv("EXPORT_ZSTD_LEVEL", default=3))
+
+# Database used by the benchmark store_arangodb stage (main.py bench)
+BENCHMARK_DB_NAME = os.getenv("BENCHMARK_DB_NAME", default="pubmed_benchmark")
+
+# Opt-in stage timers, counters and latency histograms - merged across processes into STATS_FN
+INSTRUMENT = set_bool(os.getenv("INSTRUMENT", default=False))
+STATS_FN = os.getenv("STATS_FN", default="pubmed_stats.json")
+
+# Log records from the same call site allowed through per interval (0 = no limit)
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", default=10))
+LOG_RATE_INTERVAL = float(os.getenv("LOG_RATE_INTERVAL", default=60))
+
+# Distinct (year, month, day, medline_date) publication dates kept by the date normalizer
+DATE_CACHE_SIZE = int(os.getenv("DATE_CACHE_SIZE", default=65536))
+
+# Store Pubmed XML (STORE_XML) in a zstd dictionary compressed SQLite archive instead of ArangoDB
+XML_ARCHIVE = set_bool(os.getenv("XML_ARCHIVE", default=False))
+XML_ARCHIVE_FN = os.getenv("XML_ARCHIVE_FN", default="pubmed_xml.db")
+XML_ZSTD_LEVEL = int(os.getenv("XML_ZSTD_LEVEL", default=3))
+XML_DICT_SIZE = int(os.getenv("XML_DICT_SIZE", default=112_640))
+XML_DICT_SAMPLES = int(os.getenv("XML_DICT_SAMPLES", default=2000))  # articles to train on
+
+# SQLite storage backend (pm.db)
+SQLITE_DB_FN = os.getenv("SQLITE_DB_FN", default="pubmed.db")
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", default=256))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", default=1024))
+SQLITE_TXN_DOCS = int(os.getenv("SQLITE_TXN_DOCS", default=20000))  # writer process batches
+SQLITE_WRITER_QUEUE_SIZE = int(os.getenv("SQLITE_WRITER_QUEUE_SIZE", default=64))
+
+# Storage backend: arangodb, sqlite (pm.db) or files (PMID range sharded JSON lines, pm.shards)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", default="arangodb")
+SQLITE_WRITER = set_bool(os.getenv("SQLITE_WRITER", default=True), default=True)
+SHARD_DIR = os.getenv("SHARD_DIR", default="pubmed_shards")
+SHARD_PMID_RANGE = int(os.getenv("SHARD_PMID_RANGE", default=1_000_000))
+
+# Parquet export (main.py parquet) - rows per row group and column compression
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP_SIZE", default=50_000))
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", default="zstd")
@@ -0,0 +1,191 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+
+import pm.hashes
+import pm.manifest
+import pm.settings as settings
+import pm.stats
+
+log = logging.getLogger()
+
+# Sharded local file backend (STORAGE_BACKEND=files)
+#
+#   Docs are appended as JSON lines to files sharded by PMID range under SHARD_DIR:
+#     json/00030.jsonl  PMIDs 30,000,000 - 30,999,999 with SHARD_PMID_RANGE=1_000_000
+#     xml/00030.jsonl
+#   Deletes are appended as {"_key": pmid, "deleted": true}. The last line for a PMID wins
+#   (see iter_shard). Each bulk write is one locked append per shard, so any number of
+#   worker processes can write at the same time.
+#   Processed files and checkpoints are appended to processed_files.jsonl and checkpoints.jsonl
+
+# Open shard files - file descriptors are per process so they are reopened after a fork
+shard_fds = {}
+shard_fds_pid = None
+
+
+def shard_filename(kind: str, shard: int) -> str:
+    return os.path.join(settings.SHARD_DIR, kind, f"{shard:05d}.jsonl")
+
+
+def processed_files_filename() -> str:
+    return os.path.join(settings.SHARD_DIR, "processed_files.jsonl")
+
+
+def checkpoints_filename() -> str:
+    return os.path.join(settings.SHARD_DIR, "checkpoints.jsonl")
+
+
+def get_fd(path_fn: str) -> int:
+
+    global shard_fds_pid
+
+    if shard_fds_pid != os.getpid():
+        shard_fds.clear()
+        shard_fds_pid = os.getpid()
+
+    if path_fn not in shard_fds:
+        os.makedirs(os.path.dirname(path_fn), exist_ok=True)
+        shard_fds[path_fn] = os.open(path_fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    return shard_fds[path_fn]
+
+
+def append_lines(path_fn: str, lines: list):
+    """Append lines to the file in one write under an exclusive lock"""
+
+    data = "".join(lines).encode("utf-8")
+
+    fd = get_fd(path_fn)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def append_sharded(kind: str, docs: list):
+    """Group docs by PMID shard and append each group to its shard file"""
+
+    shards = {}
+    for doc in docs:
+        shard = int(doc["_key"]) // settings.SHARD_PMID_RANGE
+        shards.setdefault(shard, []).append(json.dumps(doc) + "\n")
+
+    for shard, lines in shards.items():
+        append_lines(shard_filename(kind, shard), lines)
+
+
+def start():
+    os.makedirs(settings.SHARD_DIR, exist_ok=True)
+
+
+def target() -> str:
+    return f"files {os.path.abspath(settings.SHARD_DIR)}"
+
+
+def stop():
+    pass
+
+
+def put_many(json_docs: list, xml_docs: list):
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    if xml_docs:
+        append_sharded("xml", xml_docs)
+
+    if json_docs:
+        append_sharded("json", json_docs)
+        pm.hashes.set_hashes(
+            [(doc["_key"], doc["hash"]) for doc in json_docs if doc["hash"]]
+        )
+
+    if settings.INSTRUMENT:
+        pm.stats.add_time("db_io", start)
+
+
+def delete_many(pmids: list) -> int:
+    """Append delete markers - returns the number of PMIDs (existing docs are not checked)"""
+
+    tombstones = [{"_key": str(pmid), "deleted": True} for pmid in pmids]
+    append_sharded("json", tombstones)
+    append_sharded("xml", tombstones)
+
+    pm.hashes.delete_hashes(pmids)
+
+    return len(pmids)
+
+
+def mark_file_done(doc: dict):
+
+    append_lines(processed_files_filename(), [json.dumps(doc) + "\n"])
+    append_lines(checkpoints_filename(), [json.dumps({"fn": doc["fn"], "deleted": True}) + "\n"])
+
+
+def get_manifest() -> dict:
+    """Last line for each processed file wins"""
+
+    if not os.path.exists(processed_files_filename()):
+        return {}
+
+    manifest = {}
+    with open(processed_files_filename()) as f:
+        for line in f:
+            doc = json.loads(line)
+            manifest[pm.manifest.file_key(doc["fn"])] = {
+                "size": doc.get("size"),
+                "mtime": doc.get("mtime"),
+                "checksum": doc.get("checksum"),
+            }
+
+    return manifest
+
+
+def set_checkpoint(doc: dict):
+
+    append_lines(checkpoints_filename(), [json.dumps(doc) + "\n"])
+
+
+def get_checkpoint(fn: str) -> dict:
+    """Last checkpoint line for fn - None if there is none or the file was marked done"""
+
+    if not os.path.exists(checkpoints_filename()):
+        return None
+
+    checkpoint = None
+    with open(checkpoints_filename()) as f:
+        for line in f:
+            doc = json.loads(line)
+            if doc["fn"] == fn:
+                checkpoint = doc
+
+    if checkpoint and not checkpoint.get("deleted"):
+        return checkpoint
+
+
+def iter_shard(path_fn: str):
+    """Latest version of each doc in a shard file - deleted PMIDs are left out"""
+
+    docs = {}
+    with open(path_fn) as f:
+        for line in f:
+            doc = json.loads(line)
+            docs[doc["_key"]] = doc
+
+    for doc in docs.values():
+        if not doc.get("deleted"):
+            yield doc
+
+
+def iter_docs(kind: str = "json"):
+    """Latest version of every stored doc, shard by shard"""
+
+    for path_fn in sorted(glob.glob(os.path.join(settings.SHARD_DIR, kind, "*.jsonl"))):
+        yield from iter_shard(path_fn)
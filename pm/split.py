@@ -0,0 +1,173 @@
+import datetime
+import logging
+import multiprocessing
+import time
+
+import pm.fileindex
+import pm.hashes
+import pm.logs
+import pm.reader
+import pm.settings as settings
+import pm.stats
+import pm.storage as db
+import pm.xml
+from lxml import etree as ET
+
+log = logging.getLogger()
+
+# Parallel conversion of one pubmed file (SPLIT_PROCESSES)
+#
+#   The whole decompressed file is scanned for the byte spans of its top-level records
+#   without building a tree (see pm.reader.iter_record_spans). Forked pool workers inherit
+#   the file buffer, so only (start, end) offsets are sent to them and each article is parsed
+#   from a zero-copy memoryview slice.
+#   Results come back in file order and are written from this process.
+
+# File buffer and name in the pool workers - inherited from the parent at fork
+buffer = None
+buffer_filename = None
+
+CONVERT_ERROR = "error"  # in place of the doc of an article that could not be converted
+
+
+def convert_spans(spans: list) -> tuple:
+    """Convert the articles at (start, end) spans of the file buffer - runs in the pool
+
+    Returns (docs, stats, issues) - docs has (pmid, record_dict, xml_record_str, record_hash,
+    doc_size) for each span, None for unchanged articles and CONVERT_ERROR for articles that
+    could not be converted
+    """
+
+    view = memoryview(buffer)
+
+    docs = []
+    for start, end in spans:
+        if settings.INSTRUMENT:
+            article_start = time.perf_counter()
+            pm.stats.count("articles")
+
+        try:
+            raw_xml = view[start:end]
+            record = ET.fromstring(raw_xml)
+            if settings.INSTRUMENT:
+                pm.stats.add_time("xml_parse", article_start)
+            pmid, record_dict, xml_record_str = pm.xml.convert_xml_record(
+                record, filename=buffer_filename, raw_xml=raw_xml
+            )
+        except Exception as e:
+            log.exception(f"Problem converting article from {buffer_filename} - error: {str(e)}")
+            if settings.INSTRUMENT:
+                pm.stats.count("errors")
+            docs.append(CONVERT_ERROR)
+            continue
+
+        record_hash, doc_size = pm.hashes.hash_record(record_dict, xml_record_str)
+
+        if settings.INSTRUMENT:
+            pm.stats.add_latency(article_start)
+
+        if pm.hashes.is_unchanged(pmid, record_hash):
+            docs.append(None)
+            continue
+
+        docs.append((pmid, record_dict, xml_record_str, record_hash, doc_size))
+
+    view.release()
+
+    return docs, pm.stats.take(), pm.logs.take_issues()
+
+
+def iter_batches(spans: list):
+
+    for idx in range(0, len(spans), settings.SPLIT_BATCH_SIZE):
+        yield spans[idx : idx + settings.SPLIT_BATCH_SIZE]
+
+
+def parse_pubmed_file(filename: str) -> tuple:
+    """Parse a pubmed file with SPLIT_PROCESSES processes - same results as pm.xml.parse_pubmed_file
+
+    Returns (article_cnt, duration_sec)
+    """
+
+    global buffer, buffer_filename
+
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{filename}"
+
+    start_time = datetime.datetime.now()
+
+    pm.logs.take_issues()  # drop anything left over from a file that failed part way
+
+    checkpoint = db.get_checkpoint(filename)
+    resumed_cnt = checkpoint["article_cnt"] if checkpoint else 0
+
+    with pm.reader.pubmed_file_buffer(path_fn) as data:
+        spans = list(pm.reader.iter_record_spans(data))
+        if settings.FILE_INDEX:
+            pm.fileindex.index_spans(filename, data, spans)
+
+        article_spans = []
+        deleted_pmids = []
+        for tag, start, end in spans:
+            if tag in pm.xml.ARTICLE_TAGS:
+                article_spans.append((start, end))
+            elif tag == "DeleteCitation":
+                deleted_pmids.extend(pm.xml.process_deletions(ET.fromstring(data[start:end])))
+            else:
+                log.warning(f"{filename} has the {tag} tag and is not being processed")
+
+        if resumed_cnt:
+            log.info(
+                f"Resuming {filename} after article {resumed_cnt}  Last PMID written: {checkpoint['pmid']}  Checkpoint: {checkpoint['updated']}"
+            )
+
+        article_cnt = resumed_cnt
+        skipped_cnt = 0
+        error_cnt = 0
+        issues = {}
+
+        # Fork so the workers share the file buffer instead of having it pickled to them
+        buffer, buffer_filename = data, filename
+        try:
+            ctx = multiprocessing.get_context("fork")
+            with ctx.Pool(settings.SPLIT_PROCESSES) as pool:
+                batches = iter_batches(article_spans[resumed_cnt:])
+                for docs, stats, batch_issues in pool.imap(convert_spans, batches):
+                    pm.stats.absorb(stats)
+                    pm.logs.merge_issues(issues, batch_issues)
+                    for doc in docs:
+                        article_cnt += 1
+                        if doc is None:
+                            skipped_cnt += 1
+                        elif doc == CONVERT_ERROR:
+                            error_cnt += 1
+                        else:
+                            pmid, record_dict, xml_record_str, record_hash, doc_size = doc
+                            if xml_record_str is not None:
+                                db.add_xml(pmid, filename, xml_record_str)
+                            db.add_json(pmid, record_dict, record_hash, doc_size)
+                        db.set_position(filename, article_cnt)
+        finally:
+            buffer, buffer_filename = None, None
+
+    db.flush()  # write out remaining buffered docs before marking file as processed
+    deleted_cnt = db.delete_many(deleted_pmids)
+
+    duration_sec = (datetime.datetime.now() - start_time).total_seconds()
+    log.info(
+        f"Parsed {filename} with {settings.SPLIT_PROCESSES} processes Article_cnt: {article_cnt}  Written: {article_cnt - resumed_cnt - skipped_cnt - error_cnt}  Skipped: {skipped_cnt}  Errors: {error_cnt}  Resumed: {resumed_cnt}  Deleted: {deleted_cnt}/{len(deleted_pmids)}"
+    )
+    pm.logs.merge_issues(issues, pm.logs.take_issues())
+    pm.logs.log_issues(filename, issues)
+    db.mark_file_done(
+        filename,
+        article_cnt,
+        duration_sec,
+        max_rss_mb=pm.xml.max_rss_mb(),
+        deleted_cnt=deleted_cnt,
+        skipped_cnt=skipped_cnt,
+        error_cnt=error_cnt,
+        issues=issues,
+        resumed_cnt=resumed_cnt,
+    )
+
+    return article_cnt, duration_sec
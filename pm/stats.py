@@ -0,0 +1,142 @@
+import datetime
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+import pm.settings as settings
+
+log = logging.getLogger()
+
+# Opt-in (INSTRUMENT=true) per-process stage timers, counters and article latency histogram
+#
+#   Instrumented code checks settings.INSTRUMENT before timing anything so the cost when
+#   turned off is one attribute lookup. Workers send take() snapshots with their results
+#   and the collecting process merges them and writes them to STATS_FN.
+
+STAGES = ("gzip_read", "xml_parse", "extract", "pub_date", "serialize", "db_io")
+
+HISTOGRAM_BUCKETS = 32  # bucket n counts article latencies of [2**(n-1), 2**n) microseconds
+
+stage_seconds = Counter()
+counts = Counter()  # articles, bytes, errors
+latency_histogram = [0] * HISTOGRAM_BUCKETS
+
+
+def add_time(stage: str, start: float) -> float:
+    """Add time since start (time.perf_counter) to the stage - returns the new start time"""
+
+    now = time.perf_counter()
+    stage_seconds[stage] += now - start
+    return now
+
+
+def count(name: str, cnt: int = 1):
+
+    counts[name] += cnt
+
+
+def add_latency(start: float):
+    """Record latency of one article"""
+
+    usec = int((time.perf_counter() - start) * 1_000_000)
+    latency_histogram[min(usec.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+
+def take() -> dict:
+    """Snapshot of this process's stats since the last take() - None if not instrumenting"""
+
+    if not settings.INSTRUMENT:
+        return None
+
+    snapshot = {
+        "pid": os.getpid(),
+        "seconds": dict(stage_seconds),
+        "counts": dict(counts),
+        "latency_us_log2": list(latency_histogram),
+    }
+
+    stage_seconds.clear()
+    counts.clear()
+    latency_histogram[:] = [0] * HISTOGRAM_BUCKETS
+
+    return snapshot
+
+
+def absorb(snapshot: dict):
+    """Add a snapshot taken in a helper process (e.g. pm.split workers) to this process's stats"""
+
+    if not snapshot:
+        return
+
+    stage_seconds.update(snapshot["seconds"])
+    counts.update(snapshot["counts"])
+    latency_histogram[:] = [a + b for a, b in zip(latency_histogram, snapshot["latency_us_log2"])]
+
+
+def merge(total: dict, snapshot: dict) -> dict:
+    """Merge process snapshot into total - keeps the totals and a per-worker breakdown"""
+
+    if not snapshot:
+        return total
+
+    worker = total["workers"].setdefault(
+        str(snapshot["pid"]),
+        {"seconds": {}, "counts": {}, "latency_us_log2": [0] * HISTOGRAM_BUCKETS},
+    )
+
+    for target in (total, worker):
+        for stage, seconds in snapshot["seconds"].items():
+            target["seconds"][stage] = target["seconds"].get(stage, 0.0) + seconds
+        for name, cnt in snapshot["counts"].items():
+            target["counts"][name] = target["counts"].get(name, 0) + cnt
+        target["latency_us_log2"] = [
+            a + b for a, b in zip(target["latency_us_log2"], snapshot["latency_us_log2"])
+        ]
+
+    return total
+
+
+def new_total() -> dict:
+
+    return {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "seconds": {},
+        "counts": {},
+        "latency_us_log2": [0] * HISTOGRAM_BUCKETS,
+        "workers": {},
+    }
+
+
+def write(total: dict):
+    """Write merged stats to STATS_FN and log a one line summary"""
+
+    if not settings.INSTRUMENT:
+        return
+
+    total["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+
+    tmp_fn = f"{settings.STATS_FN}.tmp"
+    with open(tmp_fn, "w") as f:
+        json.dump(total, f, indent=2)
+    os.replace(tmp_fn, settings.STATS_FN)
+
+    seconds = "  ".join(f"{stage}: {total['seconds'].get(stage, 0.0):.1f}" for stage in STAGES)
+    log.info(f"Stats: {total['counts']}  Seconds - {seconds}")
+
+
+class TimedReader:
+    """File wrapper that times reads (waiting on decompression) and counts the bytes read"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size: int = -1) -> bytes:
+
+        start = time.perf_counter()
+        data = self.f.read(size)
+        add_time("gzip_read", start)
+        counts["bytes"] += len(data)
+
+        return data
@@ -0,0 +1,290 @@
+import datetime
+import importlib
+import json
+import logging
+import time
+
+import pm.manifest
+import pm.settings as settings
+import pm.stats
+import pm.xmlarchive
+
+log = logging.getLogger()
+
+# Storage backends - selected with STORAGE_BACKEND
+#
+#   Parsing code writes through this module, which buffers docs into bulk writes and hands
+#   them to the backend module. Each backend module has:
+#
+#     put_many(json_docs, xml_docs)   bulk write docs built by json_doc()/xml_doc()
+#     delete_many(pmids) -> int       remove PMIDs, returns the number of json docs removed
+#     mark_file_done(doc)             record a processed file (doc built by mark_file_done)
+#     get_manifest() -> dict          processed files - pm.manifest.file_key(fn) -> entry
+#                                     with the "size", "mtime" and "checksum" of the file
+#     set_checkpoint(doc)             record the position reached in a file (see flush)
+#     get_checkpoint(fn) -> dict      last checkpoint of a file not yet marked done - or None
+#     start() / stop()                called in the main process around the worker processes
+#     target() -> str                 where docs are stored, e.g. "sqlite /data/pubmed.db" -
+#                                     the content hash index is kept per target (pm.hashes)
+#
+#   Backends may write asynchronously (writer threads or a writer process) as long as
+#   everything written before mark_file_done is stored before the file is marked done,
+#   and everything written before set_checkpoint is stored before the checkpoint.
+#   mark_file_done removes the file's checkpoint.
+
+BACKENDS = {"arangodb": "pm.arangodb", "sqlite": "pm.db", "files": "pm.shards"}
+
+backend = None
+
+
+def get_backend():
+    """Backend module for STORAGE_BACKEND - imported on first use"""
+
+    global backend
+
+    if backend is None:
+        if settings.STORAGE_BACKEND not in BACKENDS:
+            raise ValueError(
+                f"Unknown STORAGE_BACKEND: {settings.STORAGE_BACKEND} - use one of {', '.join(BACKENDS)}"
+            )
+        backend = importlib.import_module(BACKENDS[settings.STORAGE_BACKEND])
+
+    return backend
+
+
+def start():
+    get_backend().start()
+
+
+def target() -> str:
+    """Storage target - backend and database/path the docs are written to"""
+
+    return get_backend().target()
+
+
+def stop():
+    get_backend().stop()
+
+
+# Bulk write buffers - flushed when BULK_DOC_COUNT or BULK_MAX_BYTES is reached
+#   and at the end of each file (see flush()). Only add_json flushes, so an article's
+#   xml doc (added first) and json doc are always in the same bulk write.
+xml_buffer = []
+json_buffer = []
+buffer_bytes = 0
+
+# Mid-file checkpoints (CHECKPOINTS) - articles of the file being parsed that have been
+#   handed to add_xml/add_json, recorded with the bulk write that flushes them. article_cnt
+#   counts from the start of the file, including articles passed over on resume.
+position = None  # (fn, article_cnt)
+checkpoint_cnt = 0  # article_cnt of the last checkpoint recorded
+checkpoint_pmid = False  # last PMID of a flush still to be checkpointed - False if none
+
+
+def xml_doc(pmid: str, filename: str, xml_article_str: str) -> dict:
+    return {"_key": pmid, "filename": filename, "article": xml_article_str}
+
+
+def json_doc(pmid: str, article: dict, record_hash: str = None) -> dict:
+    return {"_key": pmid, "article": article, "hash": record_hash}
+
+
+def add_xml(pmid: str, filename: str, xml_article_str: str):
+    """Buffer an article's xml doc - call before add_json for the article"""
+
+    global buffer_bytes
+
+    xml_buffer.append(xml_doc(pmid, filename, xml_article_str))
+    buffer_bytes += len(xml_article_str)
+
+
+def add_json(pmid: str, article: dict, record_hash: str = None, doc_size: int = None):
+    """Buffer an article's json doc - flush if the buffers are full
+
+    doc_size is the JSON size of the article from pm.hashes.hash_record - the article is
+    serialized to measure it if not given
+    """
+
+    global buffer_bytes
+
+    if doc_size is None:
+        if settings.INSTRUMENT:
+            start = time.perf_counter()
+
+        doc_size = len(json.dumps(article))
+
+        if settings.INSTRUMENT:
+            pm.stats.add_time("serialize", start)
+
+    json_buffer.append(json_doc(pmid, article, record_hash))
+    buffer_bytes += doc_size
+
+    if (
+        len(xml_buffer) + len(json_buffer) >= settings.BULK_DOC_COUNT
+        or buffer_bytes >= settings.BULK_MAX_BYTES
+    ):
+        flush()
+
+
+def flush():
+    """Write all buffered docs
+
+    The flush is checkpointed by the next set_position() - a flush from add_json happens
+    before the position of the article being added is set.
+    """
+
+    global xml_buffer, json_buffer, buffer_bytes, checkpoint_pmid
+
+    if xml_buffer or json_buffer:
+        last_pmid = json_buffer[-1]["_key"] if json_buffer else None
+        put_many(json_buffer, xml_buffer)
+        xml_buffer, json_buffer = [], []
+        checkpoint_pmid = last_pmid
+
+    buffer_bytes = 0
+
+
+def set_position(fn: str, article_cnt: int):
+    """Record that the first article_cnt articles of fn have been handed to add_xml/add_json
+
+    Call after each article so a checkpoint never covers an article that is only partly
+    buffered. Runs of unchanged (skipped) articles are checkpointed every BULK_DOC_COUNT
+    articles since nothing is flushed for them.
+    """
+
+    global position
+
+    position = (fn, article_cnt)
+
+    if checkpoint_pmid is not False:
+        save_checkpoint(checkpoint_pmid)
+    elif (
+        not xml_buffer
+        and not json_buffer
+        and article_cnt - checkpoint_cnt >= settings.BULK_DOC_COUNT
+    ):
+        save_checkpoint()
+
+
+def save_checkpoint(last_pmid: str = None):
+    """Record the current position - after the docs flushed for it"""
+
+    global checkpoint_cnt, checkpoint_pmid
+
+    checkpoint_pmid = False
+
+    if not settings.CHECKPOINTS or position is None:
+        return
+
+    # Articles held back for XML dictionary training are not stored yet
+    if settings.XML_ARCHIVE and pm.xmlarchive.samples:
+        return
+
+    fn, article_cnt = position
+    get_backend().set_checkpoint(
+        {
+            "fn": fn,
+            "article_cnt": article_cnt,
+            "pmid": last_pmid,
+            "updated": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+    )
+    checkpoint_cnt = article_cnt
+
+
+def get_checkpoint(fn: str) -> dict:
+    """Checkpoint left by an unfinished run over fn - None if there is none"""
+
+    global position, checkpoint_cnt, checkpoint_pmid
+
+    checkpoint = None
+    if settings.CHECKPOINTS:
+        checkpoint = get_backend().get_checkpoint(fn)
+
+    position = None
+    checkpoint_cnt = checkpoint["article_cnt"] if checkpoint else 0
+    checkpoint_pmid = False
+
+    return checkpoint
+
+
+def put_many(json_docs: list, xml_docs: list):
+    """Bulk write docs - xml docs go to the compressed XML archive with XML_ARCHIVE"""
+
+    if xml_docs and settings.XML_ARCHIVE:
+        pm.xmlarchive.put_docs(xml_docs)
+        xml_docs = []
+
+    get_backend().put_many(json_docs, xml_docs)
+
+
+def delete_many(pmids: list) -> int:
+    """Remove deleted PMIDs - returns the number of json docs removed"""
+
+    if not pmids:
+        return 0
+
+    if settings.XML_ARCHIVE:
+        pm.xmlarchive.delete_pmids(pmids)
+
+    return get_backend().delete_many(pmids)
+
+
+def mark_file_done(
+    fn: str,
+    article_cnt: int,
+    duration: float,
+    max_rss_mb: float = None,
+    deleted_cnt: int = 0,
+    skipped_cnt: int = 0,
+    error_cnt: int = 0,
+    issues: dict = None,
+    resumed_cnt: int = 0,
+    xml_archive: dict = None,
+):
+    """Record that everything in the file has been written - removes its checkpoint
+
+    xml_archive is the report of flush_xml_archive() if the file was written by another
+    process - by default the XML archive is flushed here
+    """
+
+    global position, checkpoint_cnt
+
+    position = None
+    checkpoint_cnt = 0
+
+    if settings.XML_ARCHIVE and xml_archive is None:
+        xml_archive = flush_xml_archive(fn)
+
+    doc = {
+        "fn": fn,
+        **pm.manifest.file_entry(fn),
+        "article_cnt": article_cnt,
+        "deleted_cnt": deleted_cnt,
+        "skipped_cnt": skipped_cnt,
+        "error_cnt": error_cnt,
+        "resumed_cnt": resumed_cnt,
+        "duration": duration,
+        "max_rss_mb": max_rss_mb,
+        "issues": issues or {},
+        "xml_archive": xml_archive,
+    }
+    get_backend().mark_file_done(doc)
+
+
+def flush_xml_archive(fn: str) -> dict:
+    """Write articles held back in the XML archive - returns its report for the file"""
+
+    pm.xmlarchive.flush()
+    xml_archive = pm.xmlarchive.take_report()
+    log.info(
+        f"XML archive: {xml_archive['docs']} docs  Bytes: {xml_archive['raw_bytes']} -> {xml_archive['stored_bytes']}  Ratio: {xml_archive['ratio']}  FN: {fn}"
+    )
+
+    return xml_archive
+
+
+def get_manifest() -> dict:
+    """Processed files - see pm.manifest"""
+
+    return get_backend().get_manifest()
@@ -1,14 +1,18 @@
 import datetime
-import gzip
 import logging
-import re
+import resource
 import time
 
-import pm.arangodb as db
+import pm.dates
+import pm.fileindex
+import pm.hashes
+import pm.logs
+import pm.reader
 import pm.settings as settings
+import pm.stats
+import pm.storage as db
 from lxml import etree as ET
 from lxml.etree import Element
-from pm.arangodb import files_coll, json_coll, pubmed_db, xml_coll
 
 log = logging.getLogger()
 
@@ -17,6 +21,34 @@ log = logging.getLogger()
 
 # print etree.tostring(xml_root, pretty_print=True)
 
+ARTICLE_TAGS = ("PubmedArticle", "PubmedBookArticle")
+
+# Precompiled XPath expressions for convert_record - anchored on the record
+#   structure from the DTD so no descendant (.//) scans are needed
+
+PMID_XP = ET.XPath("MedlineCitation/PMID/text()|BookDocument/PMID/text()")
+
+# PubmedArticle
+ARTICLE_XP = ET.XPath("MedlineCitation/Article")
+ARTICLE_TITLE_XP = ET.XPath("ArticleTitle/text()")
+ABSTRACT_TEXT_XP = ET.XPath("Abstract/AbstractText")
+PUBLICATION_TYPE_XP = ET.XPath("PublicationTypeList/PublicationType")
+AUTHOR_XP = ET.XPath("AuthorList/Author")
+JOURNAL_XP = ET.XPath("Journal")
+JOURNAL_TITLE_XP = ET.XPath("Title/text()")
+JOURNAL_ISO_TITLE_XP = ET.XPath("ISOAbbreviation/text()")
+PUB_DATE_XP = ET.XPath("JournalIssue/PubDate")
+DOI_XP = ET.XPath('PubmedData/ArticleIdList/ArticleId[@IdType="doi"]/text()')
+CHEMICAL_XP = ET.XPath("MedlineCitation/ChemicalList/Chemical/NameOfSubstance")
+MESH_XP = ET.XPath("MedlineCitation/MeshHeadingList/MeshHeading/DescriptorName")
+
+# PubmedBookArticle
+BOOK_DOCUMENT_XP = ET.XPath("BookDocument")
+BOOK_TITLE_XP = ET.XPath("Book/BookTitle/text()")
+BOOK_PUBLICATION_TYPE_XP = ET.XPath("PublicationType")
+BOOK_PUB_DATE_XP = ET.XPath("Book/PubDate")
+BOOK_DOI_XP = ET.XPath('ArticleIdList/ArticleId[@IdType="doi"]/text()')
+
 
 def first_true(iterable, default=False, pred=None):
     """Returns the first true value in the iterable.
@@ -32,7 +64,8 @@ def first_true(iterable, default=False, pred=None):
     return next(filter(pred, iterable), default)
 
 
-def process_deletions(deletions: Element):
+def process_deletions(deletions: Element) -> list:
+    """Get the deleted PMIDs - they are removed in bulk once the file's articles are written"""
 
     # Check out /sdata/pubmed/updatefiles/pubmed19n1302.xml.gz for this example
     # <DeleteCitation>
@@ -40,72 +73,248 @@ def process_deletions(deletions: Element):
     #   <PMID Version="1">29604678</PMID>
     #   <PMID Version="1">31283596</PMID>
     # </DeleteCitation>
-    pass  # TODO
+    return [pmid.text for pmid in deletions.iterchildren("PMID")]
+
+
+def max_rss_mb() -> float:
+    """Memory high-water mark (peak RSS) of this process in MB"""
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def iter_pubmed_records(path_fn: str, filename: str = None, skip_articles: int = 0):
+    """Stream (record, raw_xml) for the top-level records of a pubmed file
+
+    Each record is split out of the decompressed bytes (see pm.reader.iter_record_bytes)
+    and parsed on its own - raw_xml has its original bytes, stored with XML_CAPTURE=raw.
+    The file is indexed (FILE_INDEX) as FILENAME relative to PUBMED_DATA_DIR if given.
+    The first skip_articles articles are passed over unparsed (resuming from a checkpoint).
+    """
+
+    with pm.reader.open_pubmed_file(path_fn) as f:
+        if settings.INSTRUMENT:
+            f = pm.stats.TimedReader(f)
+
+        records = pm.reader.iter_record_bytes(f, settings.READ_AHEAD_BYTES)
+        if filename and settings.FILE_INDEX:
+            records = pm.fileindex.iter_indexed(filename, records)
+
+        for tag, offset, raw_xml in records:
+            if skip_articles and tag in ARTICLE_TAGS:
+                skip_articles -= 1
+                continue
+
+            if settings.INSTRUMENT:
+                start = time.perf_counter()
+
+            record = ET.fromstring(raw_xml)
+
+            if settings.INSTRUMENT:
+                pm.stats.add_time("xml_parse", start)
+
+            yield record, raw_xml
 
 
 def parse_pubmed_file(filename: str) -> int:
-    """Parse baseline and updatefiles"""
+    """Parse baseline and updatefiles
+
+    Resumes after the articles covered by the file's checkpoint (see pm.storage.flush) -
+    they are passed over without being parsed. Deletions are collected from the whole file.
+    """
 
     path_fn = f"{settings.PUBMED_DATA_DIR}/{filename}"
 
     start_time = datetime.datetime.now()
 
-    article_cnt = 0
-    with gzip.open(path_fn, "rb") as f:
-        context = ET.iterparse(f, events=("start", "end"))  # turn it into an iterator
-        context = iter(context)
-        for event, elem in context:
-            if event == "end" and elem.tag in ["PubmedArticle", "PubmedBookArticle"]:
-                article_cnt += 1
-
-                # if article_cnt > 1000:
-                #     quit()
+    pm.logs.take_issues()  # drop anything left over from a file that failed part way
+
+    checkpoint = db.get_checkpoint(filename)
+    resumed_cnt = 0
+    if checkpoint:
+        resumed_cnt = checkpoint["article_cnt"]
+        log.info(
+            f"Resuming {filename} after article {resumed_cnt}  Last PMID written: {checkpoint['pmid']}  Checkpoint: {checkpoint['updated']}"
+        )
+
+    article_cnt = resumed_cnt
+    skipped_cnt = 0
+    error_cnt = 0
+    deleted_pmids = []
+    records = iter_pubmed_records(path_fn, filename=filename, skip_articles=resumed_cnt)
+    for elem, raw_xml in records:
+        if elem.tag in ARTICLE_TAGS:
+            article_cnt += 1
+            written = process_xml_record(elem, filename=filename, raw_xml=raw_xml)
+            if written is None:
+                error_cnt += 1
+            elif not written:
+                skipped_cnt += 1
+            db.set_position(filename, article_cnt)
+        elif elem.tag == "DeleteCitation":
+            deleted_pmids.extend(process_deletions(elem))
+        else:
+            log.warning(f"{filename} has the {elem.tag} tag and is not being processed")
 
-                process_xml_record(elem, filename=filename)
-                elem.clear()
-            elif event == "end" and elem.tag == "DeleteCitation":
-                process_deletions(elem)
-            elif event == "end" and elem.tag in ["DeleteDocument", "BookDocument"]:
-                log.warning(f"{filename} has the {elem.tag} tag and is not being processed")
+    db.flush()  # write out remaining buffered docs before marking file as processed
+    deleted_cnt = db.delete_many(deleted_pmids)
 
     end_time = datetime.datetime.now()
     duration_sec = (end_time - start_time).total_seconds()
-    db.add_processed_filename(filename, article_cnt, duration_sec)
+    rss_mb = max_rss_mb()
+    log.info(
+        f"Parsed {filename} Article_cnt: {article_cnt}  Written: {article_cnt - resumed_cnt - skipped_cnt - error_cnt}  Skipped: {skipped_cnt}  Errors: {error_cnt}  Resumed: {resumed_cnt}  Deleted: {deleted_cnt}/{len(deleted_pmids)}  Max RSS(MB): {rss_mb:.1f}"
+    )
+    issues = pm.logs.take_issues()
+    pm.logs.log_issues(filename, issues)
+    db.mark_file_done(
+        filename,
+        article_cnt,
+        duration_sec,
+        max_rss_mb=rss_mb,
+        deleted_cnt=deleted_cnt,
+        skipped_cnt=skipped_cnt,
+        error_cnt=error_cnt,
+        issues=issues,
+        resumed_cnt=resumed_cnt,
+    )
 
     return article_cnt, duration_sec
 
 
-def process_xml_record(record: Element, filename: str = ""):
-    """Save to Pubmed XML sqlite database
+def iter_converted_records(filename: str, deleted_pmids: list = None, path_fn: str = None):
+    """Stream converted records of a pubmed file without storing them
 
-    article: the <PubmedArticle> element
+    Yields (pmid, record_dict, xml_record_str) - deleted PMIDs are appended to deleted_pmids
+
+    path_fn defaults to filename under PUBMED_DATA_DIR - the file is indexed if it is there
     """
 
-    citation = record.find("MedlineCitation")
-    pmid = citation.find("PMID").text
+    index_fn = None
+    if path_fn is None:
+        path_fn = f"{settings.PUBMED_DATA_DIR}/{filename}"
+        index_fn = filename
+
+    for elem, raw_xml in iter_pubmed_records(path_fn, filename=index_fn):
+        if elem.tag in ARTICLE_TAGS:
+            yield convert_xml_record(elem, filename=filename, raw_xml=raw_xml)
+        elif elem.tag == "DeleteCitation":
+            if deleted_pmids is not None:
+                deleted_pmids.extend(process_deletions(elem))
+        else:
+            log.warning(f"{filename} has the {elem.tag} tag and is not being processed")
+
+
+def get_pmid(record: Element) -> str:
+    """Get PMID from PubmedArticle or PubmedBookArticle"""
+
+    return next(iter(PMID_XP(record)), None)
+
+
+def convert_xml_record(record: Element, filename: str = "", raw_xml: bytes = None) -> tuple:
+    """Convert record to the docs to store
+
+    Returns (pmid, record_dict, xml_record_str) - xml_record_str is None unless STORE_XML
+
+    raw_xml is the original bytes of the record (bytes or memoryview) - with XML_CAPTURE=raw
+    it is stored as is instead of serializing the record again
+    """
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+        pub_date_seconds = pm.stats.stage_seconds["pub_date"]
+
+    pmid = get_pmid(record)
 
     record_dict = convert_record(pmid, record)
     record_dict["pubmed_xml_fn"] = filename
-    # print(xml_record_str)
-    import json
 
-    # print("DumpVar:\n", json.dumps(record_dict, indent=4))
+    if settings.INSTRUMENT:
+        # Field extraction excludes the pub_date time recorded by process_pub_date
+        pub_date_seconds = pm.stats.stage_seconds["pub_date"] - pub_date_seconds
+        start = pm.stats.add_time("extract", start + pub_date_seconds)
+
+    xml_record_str = None
+    if settings.STORE_XML:
+        if raw_xml is not None and settings.XML_CAPTURE == "raw":
+            xml_record_str = str(raw_xml, "utf-8")
+        else:
+            xml_record = ET.tostring(record, xml_declaration=True, with_tail=False)
+            xml_record_str = xml_record.decode("utf-8")
+
+        if settings.INSTRUMENT:
+            pm.stats.add_time("serialize", start)
+
+    return pmid, record_dict, xml_record_str
+
+
+def process_xml_record(record: Element, filename: str = "", raw_xml: bytes = None) -> bool:
+    """Convert and save Pubmed record to database
+
+    article: the <PubmedArticle> element
+    raw_xml: original bytes of the record if it was split from the file (see convert_xml_record)
+
+    Returns True if the record is written, False if it is skipped because its content hash is
+    unchanged and None if it could not be converted or added
+    """
+
+    if settings.INSTRUMENT:
+        article_start = time.perf_counter()
+        pm.stats.count("articles")
+
+    try:
+        pmid, record_dict, xml_record_str = convert_xml_record(
+            record, filename=filename, raw_xml=raw_xml
+        )
+    except Exception as e:
+        log.exception(f"Problem converting article from {filename} - error: {str(e)}")
+        if settings.INSTRUMENT:
+            pm.stats.count("errors")
+        return None
+
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    record_hash, doc_size = pm.hashes.hash_record(record_dict, xml_record_str)
 
-    # print(pmid, prettify(article))
+    if settings.INSTRUMENT:
+        pm.stats.add_time("serialize", start)
+
+    if pm.hashes.is_unchanged(pmid, record_hash):
+        return False
 
     try:
-        if settings.STORE_XML:
-            xml_record_str = ET.tostring(record, xml_declaration=True).decode("utf-8")
+        if xml_record_str is not None:
             db.add_xml(pmid, filename, xml_record_str)
-        db.add_json(pmid, record_dict)
+        db.add_json(pmid, record_dict, record_hash, doc_size)
     except Exception as e:
         log.exception(f"Problem adding PMID: {pmid} from {filename} - error: {str(e)}")
+        if settings.INSTRUMENT:
+            pm.stats.count("errors")
+        return None
+
+    if settings.INSTRUMENT:
+        pm.stats.add_latency(article_start)
+
+    return True
+
+
+def record_timing(timings: dict, field: str, start: float) -> float:
+    """Add time since start to the field timing - returns the new start time"""
+
+    now = time.perf_counter()
+    timings[field] = timings.get(field, 0.0) + now - start
+    return now
+
 
+def convert_record(pmid: str, root: Element, timings: dict = None) -> dict:
+    """Convert pubmed article from xml to dict
 
-def convert_record(pmid: str, root: Element) -> dict:
-    """Convert pubmed article from xml to dict"""
+    Uses the precompiled XPath expressions anchored on MedlineCitation/Article
+    (or BookDocument) instead of descendant (.//) scans of the whole record.
 
-    """Parse Pubmed Journal Article record"""
+    If a timings dict is passed in, the seconds spent on each field are added to it
+    """
 
     doc = {
         "pmid": "",
@@ -123,60 +332,138 @@ def convert_record(pmid: str, root: Element) -> dict:
 
     doc["pmid"] = pmid
 
+    if timings is not None:
+        start = time.perf_counter()
+
+    article = next(iter(ARTICLE_XP(root)), None)
+    if article is None:
+        return convert_book_record(doc, root, timings=timings)
+
     # Get Title
-    iterable = [
-        root.xpath(".//Article/ArticleTitle/text()"),
-        root.xpath(".//Article/BookTitle/text()"),
-    ]
-    title = first_true(iterable, default="")
+    title = ARTICLE_TITLE_XP(article)
     if not title:
-        log.warning(f"Missing title for pmid: {pmid}")
+        pm.logs.issue("missing_title", pmid)
     else:
         doc["title"] = title[0]
 
+    if timings is not None:
+        start = record_timing(timings, "title", start)
+
     # Get Abstract
-    doc["abstract"] = get_abstract(root.find(".//MedlineCitation/Article"))
+    doc["abstract"] = get_abstract(article)
+
+    if timings is not None:
+        start = record_timing(timings, "abstract", start)
 
     # Get Publication types
-    for pub_type in root.xpath(".//Article/PublicationTypeList/PublicationType"):
+    for pub_type in PUBLICATION_TYPE_XP(article):
         doc["article_types"].append(pub_type.text)
 
+    if timings is not None:
+        start = record_timing(timings, "article_types", start)
+
     # Get Authors
-    doc["authors"] = []
-    for author in root.xpath(".//Author"):
-        last_name = next(iter(author.xpath("LastName/text()")), "")
-        first_name = next(iter(author.xpath("ForeName/text()")), "")
-        initials = next(iter(author.xpath("Initials/text()")), "")
-        if not first_name and initials:
-            first_name = initials
-        doc["authors"].append(f"{last_name}, {first_name}")
+    doc["authors"] = get_authors(AUTHOR_XP(article))
+
+    if timings is not None:
+        start = record_timing(timings, "authors", start)
 
     # Get Pub Date
-    doc["pub_date"] = process_pub_date(root)
+    journal = next(iter(JOURNAL_XP(article)), None)
+    pub_date_elem = next(iter(PUB_DATE_XP(journal)), None) if journal is not None else None
+    doc["pub_date"] = process_pub_date(pmid, pub_date_elem)
+
+    if timings is not None:
+        start = record_timing(timings, "pub_date", start)
 
     # Get metadata
-    doc["journal_title"] = next(iter(root.xpath(".//Journal/Title/text()")), "")
-    doc["journal_iso_title"] = next(iter(root.xpath(".//Journal/ISOAbbreviation/text()")), "")
-    doc["doi"] = next(iter(root.xpath('.//ArticleId[@IdType="doi"]/text()')), None)
+    if journal is not None:
+        doc["journal_title"] = next(iter(JOURNAL_TITLE_XP(journal)), "")
+        doc["journal_iso_title"] = next(iter(JOURNAL_ISO_TITLE_XP(journal)), "")
+    doc["doi"] = next(iter(DOI_XP(root)), None)
+
+    if timings is not None:
+        start = record_timing(timings, "journal_doi", start)
 
     # Get compound list
     doc["compounds"] = []
-    for chem in root.xpath(".//ChemicalList/Chemical/NameOfSubstance"):
+    for chem in CHEMICAL_XP(root):
         doc["compounds"].append({"id": f"MESH:{chem.get('UI')}", "name": chem.text})
 
     compounds = [cmpd["id"] for cmpd in doc["compounds"]]
 
     # Get MESH list - minus anything in the compound list
     doc["mesh"] = []
-    for mesh in root.xpath(".//MeshHeading/DescriptorName"):
+    for mesh in MESH_XP(root):
         mesh_id = mesh.get("UI")
         if mesh_id in compounds:
             continue
         doc["mesh"].append({"id": f"MESH:{mesh_id}", "name": mesh.text})
 
+    if timings is not None:
+        start = record_timing(timings, "compounds_mesh", start)
+
+    return doc
+
+
+def convert_book_record(doc: dict, root: Element, timings: dict = None) -> dict:
+    """Convert PubmedBookArticle - fields come from BookDocument instead of MedlineCitation"""
+
+    pmid = doc["pmid"]
+
+    if timings is not None:
+        start = time.perf_counter()
+
+    book_doc = next(iter(BOOK_DOCUMENT_XP(root)), None)
+    if book_doc is None:
+        pm.logs.issue("missing_article", pmid)
+        return doc
+
+    # Chapters have an ArticleTitle, whole books only have the BookTitle
+    iterable = [ARTICLE_TITLE_XP(book_doc), BOOK_TITLE_XP(book_doc)]
+    title = first_true(iterable, default="")
+    if not title:
+        pm.logs.issue("missing_title", pmid)
+    else:
+        doc["title"] = title[0]
+
+    doc["abstract"] = get_abstract(book_doc)
+
+    for pub_type in BOOK_PUBLICATION_TYPE_XP(book_doc):
+        doc["article_types"].append(pub_type.text)
+
+    doc["authors"] = get_authors(AUTHOR_XP(book_doc))
+
+    doc["pub_date"] = process_pub_date(pmid, next(iter(BOOK_PUB_DATE_XP(book_doc)), None))
+
+    doc["doi"] = next(iter(BOOK_DOI_XP(book_doc)), None)
+
+    if timings is not None:
+        start = record_timing(timings, "book", start)
+
     return doc
 
 
+def get_authors(authors: list) -> list:
+    """Format Author elements as 'LastName, ForeName' (or Initials if no ForeName)"""
+
+    results = []
+    for author in authors:
+        last_name, first_name, initials = "", "", ""
+        for child in author:
+            if child.tag == "LastName":
+                last_name = child.text or ""
+            elif child.tag == "ForeName":
+                first_name = child.text or ""
+            elif child.tag == "Initials":
+                initials = child.text or ""
+        if not first_name and initials:
+            first_name = initials
+        results.append(f"{last_name}, {first_name}")
+
+    return results
+
+
 def node_text(node):
     """Needed for things like abstracts which have internal tags (see PMID:27822475)"""
 
@@ -191,12 +478,13 @@ def node_text(node):
 
 
 def get_abstract(root):
+    """Get abstract from the Article (or BookDocument) element"""
 
     # TODO https:.//stackoverflow.com/questions/4770191/lxml-etree-element-text-doesnt-return-the-entire-text-from-an-element
     # atext = next(iter(root.xpath(".//Abstract/AbstractText/text()")), "")
 
     abstract = ""
-    for abstracttext in root.xpath(".//Abstract/AbstractText"):
+    for abstracttext in ABSTRACT_TEXT_XP(root):
         abstext = node_text(abstracttext)
 
         label = abstracttext.get("Label", None)
@@ -208,56 +496,31 @@ def get_abstract(root):
     return abstract.rstrip()
 
 
-def process_pub_date(root):
+def process_pub_date(pmid: str, pub_date_elem: Element):
     """Create pub_date from what Pubmed provides in Journal PubDate entry
     """
 
-    year = next(iter(root.xpath(".//Journal/JournalIssue/PubDate/Year/text()")), None)
-    mon = next(iter(root.xpath(".//Journal/JournalIssue/PubDate/Month/text()")), "Jan")
-    day = next(iter(root.xpath(".//Journal/JournalIssue/PubDate/Day/text()")), "01")
-    medline_date = next(
-        iter(root.xpath(".//Journal/JournalIssue/PubDate/MedlineDate/text()")), None
-    )
-
-    if not year:
-        year = 1900
-
-    if medline_date:
-
-        match = re.search(r"\d{4,4}", medline_date)
-        if match:
-            year = match.group(0)
-
-        if int(year) < 1900:
-            year = 1900
-
-        if year and re.match("[a-zA-Z]+", mon):
-            try:
-                pub_date = datetime.datetime.strptime(f"{year}-{mon}-{day}", "%Y-%b-%d").strftime(
-                    "%Y-%m-%d"
-                )
-            except Exception as e:
-                pub_date = "1900-01-01"
-                pmid = root.xpath(".//MedlineCitation/PMID/text()")
-                log.error(f"Problem converting {year} {mon} {day} to pubdate for PMID:{pmid}")
-
-        elif year:
-            pub_date = f"{year}-{mon}-{day}"
-
-    else:
-        pub_date = None
-        if year and re.match("[a-zA-Z]+", mon):
-            try:
-                pub_date = datetime.datetime.strptime(f"{year}-{mon}-{day}", "%Y-%b-%d").strftime(
-                    "%Y-%m-%d"
-                )
-            except Exception as e:
-                pub_date = "1900-01-01"
-                pmid = root.xpath(".//MedlineCitation/PMID/text()")
-                log.error(f"Problem converting {year} {mon} {day} to pubdate for PMID:{pmid}")
-
-        elif year:
-            pub_date = f"{year}-{mon}-{day}"
+    if settings.INSTRUMENT:
+        start = time.perf_counter()
+
+    year, mon, day, medline_date = None, None, None, None
+    if pub_date_elem is not None:
+        for child in pub_date_elem:
+            if child.tag == "Year":
+                year = child.text
+            elif child.tag == "Month":
+                mon = child.text
+            elif child.tag == "Day":
+                day = child.text
+            elif child.tag == "MedlineDate":
+                medline_date = child.text
+
+    pub_date, valid = pm.dates.normalize_pub_date(year, mon, day, medline_date)
+    if not valid:
+        pm.logs.issue("bad_pub_date", pmid)
+
+    if settings.INSTRUMENT:
+        pm.stats.add_time("pub_date", start)
 
     return pub_date
 
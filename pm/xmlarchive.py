@@ -0,0 +1,230 @@
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+import pm.settings as settings
+import pm.stats
+
+log = logging.getLogger()
+
+# Pubmed XML archive (XML_ARCHIVE=true) - used instead of the ArangoDB xml collection
+#
+#   Each article is compressed on its own with a zstd dictionary trained on PubMed XML and
+#   stored in SQLite keyed on the integer PMID. Small documents compress poorly on their own
+#   (see the bz2 attempt in pm.db), the dictionary supplies the shared markup.
+#
+#   The dictionary is trained from the first XML_DICT_SAMPLES articles written if the archive
+#   has none yet, and stored in the archive so every process and later reads use the same one.
+
+conn = None
+conn_pid = None
+conn_lock = threading.RLock()  # shared by the pipeline writer threads
+
+compressor = None  # (dict_id, zstandard.ZstdCompressor)
+decompressors = {}  # dict_id -> zstandard.ZstdDecompressor
+samples = []  # (pmid, filename, xml bytes) held back until a dictionary exists
+
+# Since the last take_report()
+report = {"docs": 0, "raw_bytes": 0, "stored_bytes": 0}
+
+
+def get_zstandard():
+
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("XML_ARCHIVE requires the zstandard package")
+
+    return zstandard
+
+
+def get_conn() -> sqlite3.Connection:
+    """Archive connection - opened on first use in each process"""
+
+    global conn, conn_pid, compressor
+
+    if conn is None or conn_pid != os.getpid():
+        conn = sqlite3.connect(settings.XML_ARCHIVE_FN, timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, dict BLOB NOT NULL, created TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS xml (pmid INTEGER PRIMARY KEY, dict_id INTEGER NOT NULL, filename TEXT, doc BLOB NOT NULL)"
+        )
+        conn.commit()
+        conn_pid = os.getpid()
+        compressor = None
+        decompressors.clear()
+        samples.clear()
+
+    return conn
+
+
+def load_dictionary(dict_id: int):
+
+    row = get_conn().execute("SELECT dict FROM dictionaries WHERE id=?", (dict_id,)).fetchone()
+    return get_zstandard().ZstdCompressionDict(row[0])
+
+
+def get_compressor() -> tuple:
+    """(dict_id, compressor) for the newest dictionary - None if there is no dictionary yet"""
+
+    global compressor
+
+    if compressor is None:
+        dict_id = get_conn().execute("SELECT max(id) FROM dictionaries").fetchone()[0]
+        if dict_id is None:
+            return None
+
+        cctx = get_zstandard().ZstdCompressor(
+            level=settings.XML_ZSTD_LEVEL, dict_data=load_dictionary(dict_id)
+        )
+        compressor = (dict_id, cctx)
+
+    return compressor
+
+
+def get_decompressor(dict_id: int):
+    """dict_id 0 is for articles compressed without a dictionary"""
+
+    if dict_id not in decompressors:
+        if dict_id == 0:
+            decompressors[dict_id] = get_zstandard().ZstdDecompressor()
+        else:
+            decompressors[dict_id] = get_zstandard().ZstdDecompressor(
+                dict_data=load_dictionary(dict_id)
+            )
+
+    return decompressors[dict_id]
+
+
+def train_dictionary(xml_samples: list) -> tuple:
+    """Train a dictionary from xml samples (bytes) and store it - returns get_compressor()
+
+    Processes racing to create the first dictionary all use the one that was stored first
+    """
+
+    global compressor
+
+    zstd_dict = get_zstandard().train_dictionary(settings.XML_DICT_SIZE, xml_samples)
+
+    db = get_conn()
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        if db.execute("SELECT max(id) FROM dictionaries").fetchone()[0] is None:
+            db.execute(
+                "INSERT INTO dictionaries (dict, created) VALUES (?, ?)",
+                (zstd_dict.as_bytes(), datetime.datetime.now().isoformat(timespec="seconds")),
+            )
+            log.info(
+                f"Trained {len(zstd_dict.as_bytes())} byte XML dictionary from {len(xml_samples)} articles"
+            )
+
+    compressor = None
+    return get_compressor()
+
+
+def put_docs(docs: list):
+    """Compress and store xml docs (as built by pm.storage.xml_doc) in one transaction"""
+
+    with conn_lock:
+        get_conn()
+        samples.extend(
+            (int(doc["_key"]), doc["filename"], doc["article"].encode("utf-8")) for doc in docs
+        )
+
+        if get_compressor() is None:
+            if len(samples) < settings.XML_DICT_SAMPLES:
+                return  # hold back until there are enough articles to train on
+
+            try:
+                train_dictionary([xml for pmid, filename, xml in samples])
+            except get_zstandard().ZstdError:
+                log.exception(f"Problem training XML dictionary from {len(samples)} articles")
+
+        write_samples()
+
+
+def write_samples():
+    """Compress and write the held back articles - without a dictionary if there is none"""
+
+    dict_id, cctx = get_compressor() or (
+        0,
+        get_zstandard().ZstdCompressor(level=settings.XML_ZSTD_LEVEL),
+    )
+
+    rows = []
+    raw_bytes, stored_bytes = 0, 0
+    for pmid, filename, xml in samples:
+        doc = cctx.compress(xml)
+        rows.append((pmid, dict_id, filename, doc))
+        raw_bytes += len(xml)
+        stored_bytes += len(doc)
+
+    with get_conn() as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO xml (pmid, dict_id, filename, doc) VALUES (?, ?, ?, ?)", rows
+        )
+
+    samples.clear()
+
+    report["docs"] += len(rows)
+    report["raw_bytes"] += raw_bytes
+    report["stored_bytes"] += stored_bytes
+
+    if settings.INSTRUMENT:
+        pm.stats.count("xml_raw_bytes", raw_bytes)
+        pm.stats.count("xml_stored_bytes", stored_bytes)
+
+
+def flush():
+    """Write articles held back for dictionary training
+
+    Called at the end of each file - with too few articles to train on they are
+    compressed without a dictionary
+    """
+
+    with conn_lock:
+        if samples:
+            write_samples()
+
+
+def delete_pmids(pmids: list):
+    """Remove archived articles - and articles held back for dictionary training"""
+
+    deleted = {int(pmid) for pmid in pmids}
+
+    with conn_lock, get_conn() as db:
+        samples[:] = [sample for sample in samples if sample[0] not in deleted]
+        db.executemany("DELETE FROM xml WHERE pmid=?", [(pmid,) for pmid in deleted])
+
+
+def get_xml(pmid: str) -> str:
+    """Decompressed Pubmed XML of the article - None if not archived"""
+
+    with conn_lock:
+        row = get_conn().execute(
+            "SELECT dict_id, doc FROM xml WHERE pmid=?", (int(pmid),)
+        ).fetchone()
+        if row is None:
+            return None
+
+        return get_decompressor(row[0]).decompress(row[1]).decode("utf-8")
+
+
+def take_report() -> dict:
+    """Docs, bytes and compression ratio written since the last take_report()"""
+
+    with conn_lock:
+        result = dict(report)
+        report.update({"docs": 0, "raw_bytes": 0, "stored_bytes": 0})
+
+    result["ratio"] = None
+    if result["stored_bytes"]:
+        result["ratio"] = round(result["raw_bytes"] / result["stored_bytes"], 2)
+
+    return result
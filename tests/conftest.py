@@ -0,0 +1,87 @@
+import gzip
+import json
+
+import pm.db
+import pm.hashes
+import pm.lookup
+import pm.settings as settings
+import pm.storage
+import pytest
+
+ARTICLE = """<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{pmid}</PMID><Article PubModel="Print"><Journal><JournalIssue><PubDate><Year>2001</Year><Month>Feb</Month><Day>3</Day></PubDate></JournalIssue><Title>Journal of Things</Title><ISOAbbreviation>J Things</ISOAbbreviation></Journal><ArticleTitle>{title}</ArticleTitle><Abstract><AbstractText Label="BACKGROUND">Background</AbstractText><AbstractText Label="RESULTS">Results</AbstractText></Abstract></Article></MedlineCitation><PubmedData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList></PubmedData></PubmedArticle>"""
+
+BOOK = """<PubmedBookArticle><BookDocument><PMID Version="1">{pmid}</PMID><Book><BookTitle book="x">{title}</BookTitle><PubDate><Year>2010</Year></PubDate></Book><Abstract><AbstractText>Book abstract</AbstractText></Abstract></BookDocument><PubmedBookData><ArticleIdList><ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList></PubmedBookData></PubmedBookArticle>"""
+
+
+def pubmed_xml(pmids: list, deletes: list = (), title: str = "Title {pmid}") -> bytes:
+    """Pubmed file XML with an article for each PMID (every 5th a book) then the deletes"""
+
+    parts = ['<?xml version="1.0" ?>\n<PubmedArticleSet>\n']
+    for idx, pmid in enumerate(pmids):
+        template = BOOK if idx % 5 == 4 else ARTICLE
+        parts.append(template.format(pmid=pmid, title=title.format(pmid=pmid)) + "\n")
+    if deletes:
+        pmid_tags = "".join(f'<PMID Version="1">{pmid}</PMID>' for pmid in deletes)
+        parts.append(f"<DeleteCitation>{pmid_tags}</DeleteCitation>\n")
+    parts.append("</PubmedArticleSet>\n")
+
+    return "".join(parts).encode("utf-8")
+
+
+def stored_pmids() -> list:
+    """PMIDs in the SQLite json table"""
+
+    return [pmid for pmid, in pm.db.get_conn().execute("SELECT pmid FROM json ORDER BY pmid")]
+
+
+def processed_file(fn: str) -> dict:
+    """SQLite processed_files doc of fn"""
+
+    row = pm.db.get_conn().execute("SELECT doc FROM processed_files WHERE fn=?", (fn,)).fetchone()
+    return json.loads(row[0])
+
+
+@pytest.fixture
+def pubmed_env(tmp_path, monkeypatch):
+    """Settings for a local mirror and SQLite storage under tmp_path - returns a file writer"""
+
+    data_dir = tmp_path / "pubmed"
+    (data_dir / "baseline").mkdir(parents=True)
+    (data_dir / "updatefiles").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    for name, value in {
+        "PUBMED_DATA_DIR": str(data_dir),
+        "FILE_INDEX": True,
+        "FILE_INDEX_DIR": str(tmp_path / "index"),
+        "LOOKUP_INDEX_FN": str(tmp_path / "lookup.db"),
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_DB_FN": str(tmp_path / "pubmed.db"),
+        "SQLITE_WRITER": False,
+        "HASH_INDEX_FN": str(tmp_path / "hashes.db"),
+        "SKIP_UNCHANGED": True,
+        "CHECKPOINTS": True,
+        "BULK_DOC_COUNT": 10,
+        "STORE_XML": False,
+        "XML_ARCHIVE": False,
+        "INSTRUMENT": False,
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+
+    # Module state from other tests - connections are reopened on first use
+    monkeypatch.setattr(pm.storage, "backend", None)
+    monkeypatch.setattr(pm.storage, "xml_buffer", [])
+    monkeypatch.setattr(pm.storage, "json_buffer", [])
+    monkeypatch.setattr(pm.db, "conn", None)
+    monkeypatch.setattr(pm.hashes, "index_conn", None)
+    monkeypatch.setattr(pm.lookup, "index_conn", None)
+    pm.lookup.cached_record.cache_clear()
+
+    def write_file(fn: str, pmids: list, deletes: list = (), title: str = "Title {pmid}"):
+        with gzip.open(data_dir / fn, "wb") as f:
+            f.write(pubmed_xml(pmids, deletes, title))
+        return fn
+
+    yield write_file
+
+    pm.storage.stop()
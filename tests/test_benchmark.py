@@ -0,0 +1,38 @@
+import collections
+import json
+
+import pm.benchmark
+import pm.xml
+
+
+def test_synthetic_files(tmp_path):
+    shape = dict(pm.benchmark.DEFAULT_SHAPE, articles=200, files=2, book_ratio=0.1, deletions=5)
+
+    filenames = pm.benchmark.make_synthetic_files(str(tmp_path), shape)
+    assert filenames == ["baseline/pubmed00n0001.xml.gz", "baseline/pubmed00n0002.xml.gz"]
+
+    tags = collections.Counter()
+    pmids = []
+    for elem, raw_xml in pm.xml.iter_pubmed_records(f"{tmp_path}/{filenames[1]}"):
+        tags[elem.tag] += 1
+        if elem.tag in pm.xml.ARTICLE_TAGS:
+            pmids.append(pm.xml.get_pmid(elem))
+
+    assert tags["PubmedArticle"] + tags["PubmedBookArticle"] == 200
+    assert tags["PubmedBookArticle"] > 0
+    assert tags["DeleteCitation"] == 1
+    assert pmids == [str(pmid) for pmid in range(201, 401)]
+
+
+def test_run_benchmark(tmp_path):
+    shape = {"articles": 50, "deletions": 2}
+
+    results = pm.benchmark.run_benchmark(
+        shape, ["parse", "store_jsonl"], out_dir=str(tmp_path / "results")
+    )
+
+    (out_fn,) = (tmp_path / "results").iterdir()
+    assert json.loads(out_fn.read_text()) == results
+    for stage in ("parse", "store_jsonl"):
+        assert results["results"][stage]["article_cnt"] == 50
+        assert results["results"][stage]["max_rss_mb"] > 0
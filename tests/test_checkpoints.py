@@ -0,0 +1,51 @@
+import pm.settings as settings
+import pm.storage
+import pm.xml
+import pytest
+
+from conftest import processed_file, stored_pmids
+
+
+def test_resume_from_checkpoint(pubmed_env, monkeypatch):
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", range(1, 51), deletes=[3])
+
+    process_xml_record = pm.xml.process_xml_record
+    processed = []
+    preempt_pmids = ["25"]  # first run only
+
+    def preempted(record, **kwargs):
+        pmid = pm.xml.convert_xml_record(record)[0]
+        if pmid in preempt_pmids:
+            preempt_pmids.clear()
+            raise RuntimeError("preempted")
+        processed.append(pmid)
+        return process_xml_record(record, **kwargs)
+
+    monkeypatch.setattr(pm.xml, "process_xml_record", preempted)
+    with pytest.raises(RuntimeError):
+        pm.xml.parse_pubmed_file(fn)
+    monkeypatch.setattr(pm.storage, "json_buffer", [])  # lost with the process
+
+    # The checkpoint covers the articles of the last bulk write - no more and no less
+    checkpoint = pm.storage.get_backend().get_checkpoint(fn)
+    assert checkpoint["article_cnt"] == 20
+    assert checkpoint["pmid"] == "20"
+    assert stored_pmids() == list(range(1, 21))
+
+    processed.clear()
+    assert pm.xml.parse_pubmed_file(fn)[0] == 50
+
+    assert processed == [str(pmid) for pmid in range(21, 51)]
+    assert processed_file(fn)["resumed_cnt"] == 20
+    assert stored_pmids() == [pmid for pmid in range(1, 51) if pmid != 3]
+    assert pm.storage.get_backend().get_checkpoint(fn) is None
+
+
+def test_resume_skips_parsing(pubmed_env):
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", range(1, 11), deletes=[2])
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+
+    records = list(pm.xml.iter_pubmed_records(path_fn, skip_articles=7))
+
+    assert [pm.xml.get_pmid(record) for record, raw_xml in records[:-1]] == ["8", "9", "10"]
+    assert records[-1][0].tag == "DeleteCitation"
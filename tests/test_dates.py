@@ -0,0 +1,38 @@
+from pm.dates import normalize_pub_date
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "parts, expected",
+    [
+        (("2001", "Feb", "3", None), ("2001-02-03", True)),
+        (("2001", "February", "03", None), ("2001-02-03", True)),
+        (("2001", "2", None, None), ("2001-02-01", True)),
+        (("2001", "Sept.", None, None), ("2001-09-01", True)),
+        (("2003", "Spring", None, None), ("2003-03-01", True)),
+        (("2004", None, None, None), ("2004-01-01", True)),
+        ((None, None, None, None), ("1900-01-01", True)),
+        ((None, None, None, "1998 Dec-1999 Jan"), ("1998-12-01", True)),
+        ((None, None, None, "1999 Nov 15-Dec 2"), ("1999-11-15", True)),
+        ((None, None, None, "2000 Winter"), ("2000-12-01", True)),
+        ((None, None, None, "1890"), ("1900-01-01", True)),
+    ],
+)
+def test_normalize_pub_date(parts, expected):
+    assert normalize_pub_date(*parts) == expected
+
+
+@pytest.mark.parametrize(
+    "parts, expected",
+    [
+        (("01", "Jan", "1", None), "1900-01-01"),
+        (("2001", "Foo", "1", None), "2001-01-01"),
+        (("2001", "Jan", "1st", None), "2001-01-01"),
+        (("2001", "Feb", "30", None), "2001-02-28"),
+        (("2000", "Feb", "30", None), "2000-02-29"),
+        ((None, None, None, "Unknown"), "1900-01-01"),
+    ],
+)
+def test_normalize_pub_date_invalid(parts, expected):
+    assert normalize_pub_date(*parts) == (expected, False)
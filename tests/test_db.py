@@ -0,0 +1,45 @@
+import sqlite3
+
+import pm.db
+import pm.settings as settings
+import pm.storage
+import pm.xml
+import pytest
+
+
+@pytest.fixture
+def writer_env(pubmed_env, monkeypatch):
+    monkeypatch.setattr(settings, "SQLITE_WRITER", True)
+    return pubmed_env
+
+
+def test_writer_delete_count(writer_env):
+    fn = writer_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3])
+
+    pm.storage.start()
+    pm.xml.parse_pubmed_file(fn)
+    assert pm.storage.delete_many(["2", "3", "99"]) == 2
+    pm.storage.stop()
+
+    assert pm.db.get_json_doc("1") is not None
+    assert pm.db.get_json_doc("2") is None
+
+
+def test_writer_error_stops_mark_file_done(writer_env, monkeypatch):
+    fn = writer_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3])
+
+    write_msgs = pm.db.write_msgs
+
+    def failing(msgs):
+        if any(op == "json" for op, items, reply in msgs):
+            raise sqlite3.OperationalError("disk I/O error")
+        return write_msgs(msgs)
+
+    monkeypatch.setattr(pm.db, "write_msgs", failing)  # inherited by the writer process
+
+    pm.storage.start()
+    with pytest.raises(sqlite3.OperationalError):
+        pm.xml.parse_pubmed_file(fn)
+    pm.storage.stop()
+
+    assert pm.storage.get_manifest() == {}
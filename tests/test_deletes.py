@@ -0,0 +1,27 @@
+import pm.db
+import pm.hashes
+import pm.xml
+
+from conftest import processed_file, stored_pmids
+
+
+def test_deletes_after_articles(pubmed_env):
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", range(1, 8), deletes=[2, 6, 99])
+
+    assert pm.xml.parse_pubmed_file(fn)[0] == 7
+
+    assert stored_pmids() == [1, 3, 4, 5, 7]
+    assert pm.db.get_json_doc("5")["title"] == "Title 5"  # book
+    assert pm.hashes.get_hash("2") is None
+    assert processed_file(fn)["deleted_cnt"] == 2
+
+
+def test_updatefile_deletes_earlier_articles(pubmed_env):
+    baseline_fn = pubmed_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3])
+    update_fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [4], deletes=[1, 3])
+
+    pm.xml.parse_pubmed_file(baseline_fn)
+    pm.xml.parse_pubmed_file(update_fn)
+
+    assert stored_pmids() == [2, 4]
+    assert processed_file(update_fn)["deleted_cnt"] == 2
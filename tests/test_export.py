@@ -0,0 +1,25 @@
+import pm.export
+import pytest
+
+
+def test_export_no_files():
+    assert pm.export.export_files([], None) == 0
+
+
+def test_parquet_year_partitions(tmp_path):
+    dataset = pytest.importorskip("pyarrow.dataset")
+
+    partitions = pm.export.ParquetPartitions("pubmed20n0001.xml.gz", str(tmp_path), "year")
+    partitions.add(pm.export.parquet_row({"pmid": "1", "pub_date": "2001-02-03"}))
+    partitions.add(pm.export.parquet_row({"pmid": "2", "pub_date": ""}))
+
+    assert sorted(partitions.close()) == [
+        f"{tmp_path}/pub_year=2001/pubmed20n0001.parquet",
+        f"{tmp_path}/pub_year=__HIVE_DEFAULT_PARTITION__/pubmed20n0001.parquet",
+    ]
+
+    table = dataset.dataset(str(tmp_path), partitioning="hive").to_table()
+    assert sorted(table.select(["pmid", "pub_year"]).to_pylist(), key=lambda row: row["pmid"]) == [
+        {"pmid": 1, "pub_year": 2001},
+        {"pmid": 2, "pub_year": None},
+    ]
@@ -0,0 +1,86 @@
+import gzip
+import os
+
+import pm.fileindex
+import pm.reader
+import pm.settings as settings
+import pm.xml
+
+
+def test_index_written_while_parsing(pubmed_env):
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", [10, 11, 12], deletes=[11])
+
+    pm.xml.parse_pubmed_file(fn)
+
+    summary = pm.fileindex.load_summary(fn)
+    assert summary["article_cnt"] == 3
+    assert summary["deleted_cnt"] == 1
+    assert (summary["pmid_min"], summary["pmid_max"]) == (10, 12)
+
+    with gzip.open(f"{settings.PUBMED_DATA_DIR}/{fn}") as f:
+        data = f.read()
+    assert summary["uncompressed_size"] == len(data)
+
+    spans = list(pm.reader.iter_record_spans(data))
+    offsets = pm.fileindex.load_offsets(fn)
+    assert sorted(zip(offsets[0::3], offsets[1::3], offsets[2::3])) == sorted(
+        [
+            (10, spans[0][1], spans[0][2] - spans[0][1]),
+            (11, spans[1][1], spans[1][2] - spans[1][1]),
+            (12, spans[2][1], spans[2][2] - spans[2][1]),
+            (11, spans[3][1], 0),
+        ]
+    )
+
+    assert pm.fileindex.get_article_xml(fn, "12") == data[spans[2][1] : spans[2][2]]
+    assert pm.fileindex.get_article_xml(fn, "11") is None
+    assert pm.fileindex.get_article_xml(fn, "99") is None
+
+
+def test_estimate_articles(pubmed_env):
+    indexed_fn = pubmed_env("baseline/pubmed20n0001.xml.gz", range(1, 21))
+    unindexed_fn = pubmed_env("baseline/pubmed20n0002.xml.gz", range(21, 81))
+
+    assert pm.fileindex.estimate_articles([indexed_fn, unindexed_fn]) is None
+
+    pm.fileindex.index_file(indexed_fn)
+    estimates = pm.fileindex.estimate_articles([indexed_fn, unindexed_fn])
+
+    assert estimates[indexed_fn] == 20
+    assert 20 < estimates[unindexed_fn] < 80  # from compressed size - compresses better
+
+
+def test_find_article_sorted_index(pubmed_env):
+    fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [30, 10, 20, 10], deletes=[20])
+    pm.fileindex.index_file(fn)
+
+    offsets = pm.fileindex.load_offsets(fn)
+    assert list(offsets[0::3]) == [10, 10, 20, 20, 30]
+
+    with gzip.open(f"{settings.PUBMED_DATA_DIR}/{fn}") as f:
+        spans = list(pm.reader.iter_record_spans(f.read()))
+    assert pm.fileindex.find_article(fn, 10) == (spans[3][1], spans[3][2] - spans[3][1])
+    assert pm.fileindex.find_article(fn, 20) is None
+    assert pm.fileindex.find_article(fn, 5) is None
+    assert pm.fileindex.find_article(fn, 99) is None
+
+
+def test_read_from_seek_points(pubmed_env, monkeypatch):
+    monkeypatch.setattr(pm.fileindex, "SEEK_POINT_BYTES", 500)
+    monkeypatch.setattr(pm.fileindex, "SEEK_READ_BYTES", 100)
+    pm.fileindex.seek_points.cache_clear()
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", range(1, 41))
+
+    # Two gzip members - the second starts mid-file
+    path_fn = f"{settings.PUBMED_DATA_DIR}/{fn}"
+    with gzip.open(path_fn) as f:
+        data = f.read()
+    with open(path_fn, "wb") as f:
+        f.write(gzip.compress(data[:3000]) + gzip.compress(data[3000:]))
+    pm.fileindex.index_file(fn)
+
+    stat = os.stat(path_fn)
+    positions, points = pm.fileindex.seek_points(path_fn, stat.st_size, stat.st_mtime)
+    assert len(positions) > 3
+    for tag, start, end in pm.reader.iter_record_spans(data):
+        assert pm.fileindex.read_article(fn, start, end - start) == data[start:end]
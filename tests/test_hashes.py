@@ -0,0 +1,47 @@
+import pm.db
+import pm.hashes
+import pm.settings as settings
+import pm.xml
+
+from conftest import processed_file, stored_pmids
+
+
+def test_unchanged_records_skipped(pubmed_env):
+    baseline_fn = pubmed_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3])
+    update_fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [1, 2, 3], title="New {pmid}")
+
+    pm.xml.parse_pubmed_file(baseline_fn)
+    pm.xml.parse_pubmed_file(baseline_fn)
+    assert processed_file(baseline_fn)["skipped_cnt"] == 3
+
+    pm.xml.parse_pubmed_file(update_fn)
+    assert processed_file(update_fn)["skipped_cnt"] == 0
+    assert pm.db.get_json_doc("2")["title"] == "New 2"
+
+
+def test_deleted_record_sent_again_is_written(pubmed_env):
+    baseline_fn = pubmed_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3])
+    delete_fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [], deletes=[2])
+    readd_fn = pubmed_env("updatefiles/pubmed20n1002.xml.gz", [2])
+
+    for fn in (baseline_fn, delete_fn, readd_fn):
+        pm.xml.parse_pubmed_file(fn)
+
+    assert processed_file(readd_fn)["skipped_cnt"] == 0
+    assert stored_pmids() == [1, 2, 3]
+
+
+def test_index_scoped_to_storage_target(pubmed_env, monkeypatch, tmp_path):
+    pm.hashes.set_hashes([("1", "abc")])
+    assert pm.hashes.get_hash("1") == "abc"
+
+    # Same index file opened for another database - its hashes do not describe it
+    monkeypatch.setattr(settings, "SQLITE_DB_FN", str(tmp_path / "other.db"))
+    monkeypatch.setattr(pm.hashes, "index_conn", None)
+    assert pm.hashes.get_hash("1") is None
+
+    # Without HASH_INDEX_FN each target has its own index file
+    monkeypatch.setattr(settings, "HASH_INDEX_FN", None)
+    other_fn = pm.hashes.index_filename()
+    monkeypatch.setattr(settings, "SQLITE_DB_FN", str(tmp_path / "pubmed.db"))
+    assert pm.hashes.index_filename() != other_fn
@@ -0,0 +1,18 @@
+import pm.lookup
+
+
+def test_lookup_latest_version(pubmed_env):
+    pubmed_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3, 4])
+    pubmed_env("updatefiles/pubmed20n1001.xml.gz", [3], deletes=[4], title="New {pmid}")
+
+    assert pm.lookup.update_index() == 2
+
+    assert pm.lookup.get_location("1")[0] == "baseline/pubmed20n0001.xml.gz"
+    assert pm.lookup.get_location("3")[0] == "updatefiles/pubmed20n1001.xml.gz"
+    assert pm.lookup.get_location("4") is None
+    assert pm.lookup.get_xml("3").startswith(b"<PubmedArticle>")
+    assert pm.lookup.get_record("3")["title"] == "New 3"
+    assert pm.lookup.get_record("2")["title"] == "Title 2"
+    assert pm.lookup.get_record("99") is None
+
+    assert pm.lookup.update_index() == 0
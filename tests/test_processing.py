@@ -0,0 +1,71 @@
+import datetime
+import os
+import queue
+
+import pm.db
+import pm.processing
+import pm.settings as settings
+import pm.storage
+
+from conftest import stored_pmids
+
+
+def test_files_without_articles_finished(pubmed_env, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "INSTRUMENT", True)
+    monkeypatch.setattr(settings, "STATS_FN", str(tmp_path / "stats.json"))
+    delete_fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [], deletes=[1, 2])
+    articles_fn = pubmed_env("updatefiles/pubmed20n1002.xml.gz", [3, 4, 5])
+
+    task_queue, done_queue = queue.Queue(), queue.Queue()
+    for fn in (delete_fn, articles_fn, None):
+        task_queue.put(fn)
+    pm.processing.pubmed_file_worker(task_queue, done_queue)
+
+    done = [done_queue.get() for _ in range(done_queue.qsize())]
+    assert [(d["fn"], d["article_cnt"]) for d in done] == [(delete_fn, 0), (articles_fn, 3)]
+
+    for d in done + [None]:
+        done_queue.put(d)
+    pm.processing.finished_tasks(done_queue, 2)
+
+    with open("processed_files.txt") as f:
+        assert [line for line in f.read().splitlines() if not line.startswith("Baseline")] == [
+            delete_fn,
+            articles_fn,
+        ]
+    assert os.path.exists(settings.STATS_FN)
+
+
+def test_pipeline_write_error_not_marked(pubmed_env, monkeypatch):
+    failed_fn = pubmed_env("updatefiles/pubmed20n1001.xml.gz", [1])
+    written_fn = pubmed_env("updatefiles/pubmed20n1002.xml.gz", [2])
+
+    put_many = pm.storage.put_many
+
+    def failing(json_docs, xml_docs):
+        if json_docs[0]["_key"] == "1":
+            raise RuntimeError("bulk insert failed")
+        put_many(json_docs, xml_docs)
+
+    monkeypatch.setattr(pm.storage, "put_many", failing)
+
+    doc_queue = queue.Queue()
+    for pmid, fn in (("1", failed_fn), ("2", written_fn)):
+        doc_queue.put((fn, 1, [(pmid, {"pmid": pmid}, None, None)], None, {}))
+        doc_queue.put(
+            {
+                "fn": fn,
+                "article_cnt": 1,
+                "deleted_pmids": [],
+                "start_time": datetime.datetime.now(),
+                "error": False,
+                "stats": None,
+            }
+        )
+    doc_queue.put(None)
+    pm.processing.pipeline_writer(doc_queue, 1, 2)
+
+    assert stored_pmids() == [2]
+    assert [fn for fn, in pm.db.get_conn().execute("SELECT fn FROM processed_files")] == [
+        written_fn
+    ]
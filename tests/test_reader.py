@@ -0,0 +1,61 @@
+import io
+
+import pm.reader
+import pytest
+
+from conftest import pubmed_xml
+
+DATA = pubmed_xml([1, 2, 3, 4, 5, 6], deletes=[7, 8])
+
+
+def record_bytes(data: bytes, chunk_size: int) -> tuple:
+    """(records, uncompressed size) from iter_record_bytes"""
+
+    records = pm.reader.iter_record_bytes(io.BytesIO(data), chunk_size)
+    result = []
+    while True:
+        try:
+            result.append(next(records))
+        except StopIteration as e:
+            return result, e.value
+
+
+def test_iter_record_spans():
+    spans = list(pm.reader.iter_record_spans(DATA))
+
+    assert [tag for tag, start, end in spans] == [
+        "PubmedArticle",
+        "PubmedArticle",
+        "PubmedArticle",
+        "PubmedArticle",
+        "PubmedBookArticle",
+        "PubmedArticle",
+        "DeleteCitation",
+    ]
+    for tag, start, end in spans:
+        assert DATA[start:end].startswith(f"<{tag}>".encode())
+        assert DATA[start:end].endswith(f"</{tag}>".encode())
+
+
+def test_iter_record_spans_skips_article_set_tag():
+    data = b"<PubmedArticleSet><PubmedArticleSetX/></PubmedArticleSet>"
+    assert list(pm.reader.iter_record_spans(data)) == []
+
+
+# Chunks smaller than a start tag split tags and records across reads
+@pytest.mark.parametrize("chunk_size", [1, 7, 20, 64, 1_000_000])
+def test_iter_record_bytes_matches_spans(chunk_size):
+    records, uncompressed_size = record_bytes(DATA, chunk_size)
+
+    assert [(tag, offset, raw_xml) for tag, offset, raw_xml in records] == [
+        (tag, start, DATA[start:end]) for tag, start, end in pm.reader.iter_record_spans(DATA)
+    ]
+    assert uncompressed_size == len(DATA)
+
+
+def test_iter_record_bytes_unfinished_record():
+    with pytest.raises(ValueError):
+        record_bytes(DATA[:-40], 64)
+
+    with pytest.raises(ValueError):
+        list(pm.reader.iter_record_spans(DATA[:-40]))
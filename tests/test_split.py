@@ -0,0 +1,52 @@
+import pm.db
+import pm.settings as settings
+import pm.split
+import pm.xml
+import pytest
+
+from conftest import processed_file, stored_pmids
+
+
+@pytest.fixture
+def split_env(pubmed_env, monkeypatch):
+    monkeypatch.setattr(settings, "SKIP_UNCHANGED", False)
+    monkeypatch.setattr(settings, "SPLIT_PROCESSES", 2)
+    monkeypatch.setattr(settings, "SPLIT_BATCH_SIZE", 7)
+    return pubmed_env
+
+
+def test_split_processes_match_sequential(split_env):
+    fn = split_env("baseline/pubmed20n0001.xml.gz", range(1, 31), deletes=[4])
+
+    pm.xml.parse_pubmed_file(fn)
+    sequential = {pmid: pm.db.get_json_doc(pmid) for pmid in stored_pmids()}
+    pm.db.get_conn().execute("DELETE FROM json")
+    pm.db.get_conn().commit()
+
+    pm.split.parse_pubmed_file(fn)
+    split = {pmid: pm.db.get_json_doc(pmid) for pmid in stored_pmids()}
+
+    assert len(split) == 29
+    assert split == sequential
+
+
+@pytest.mark.parametrize(
+    "parse_pubmed_file", [pm.xml.parse_pubmed_file, pm.split.parse_pubmed_file]
+)
+def test_conversion_errors_counted(split_env, monkeypatch, parse_pubmed_file):
+    fn = split_env("baseline/pubmed20n0001.xml.gz", range(1, 11))
+
+    convert_xml_record = pm.xml.convert_xml_record
+
+    def failing(record, **kwargs):
+        if pm.xml.get_pmid(record) == "5":
+            raise ValueError("bad record")
+        return convert_xml_record(record, **kwargs)
+
+    monkeypatch.setattr(pm.xml, "convert_xml_record", failing)  # inherited by the pool workers
+
+    assert parse_pubmed_file(fn)[0] == 10
+
+    doc = processed_file(fn)
+    assert (doc["error_cnt"], doc["skipped_cnt"]) == (1, 0)
+    assert stored_pmids() == [pmid for pmid in range(1, 11) if pmid != 5]
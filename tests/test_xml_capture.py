@@ -0,0 +1,24 @@
+import pm.db
+import pm.settings as settings
+import pm.xml
+import pytest
+from lxml import etree as ET
+
+from conftest import pubmed_xml
+
+
+@pytest.mark.parametrize("xml_capture", ["raw", "serialize"])
+def test_stored_xml(pubmed_env, monkeypatch, xml_capture):
+    monkeypatch.setattr(settings, "STORE_XML", True)
+    monkeypatch.setattr(settings, "XML_CAPTURE", xml_capture)
+    fn = pubmed_env("baseline/pubmed20n0001.xml.gz", [1, 2, 3, 4, 5])
+
+    pm.xml.parse_pubmed_file(fn)
+
+    for record in ET.fromstring(pubmed_xml([1, 2, 3, 4, 5])):
+        stored = pm.db.get_xml_doc(pm.xml.get_pmid(record))
+        original = ET.tostring(record, with_tail=False)
+        if xml_capture == "raw":
+            assert stored == original.decode("utf-8")
+        else:
+            assert ET.tostring(ET.fromstring(stored.encode("utf-8"))) == original